@@ -0,0 +1,113 @@
+"""
+Lotes de XML para Cavali acotados por cantidad de archivos y por tamaño
+codificado (base64), con límites que se adaptan a Cavali (AIMD):
+
+- si el bloqueo de un lote falla por timeout, conexión, 5xx o 429, o tarda más
+  que CAVALI_BATCH_TARGET_SECONDS, ambos límites se reducen a la mitad. Como
+  los lotes viajan en paralelo, un mal momento de Cavali hace fallar varios a
+  la vez: solo reduce el primero de cada generación de límites (los lotes
+  armados antes de la última reducción ya no cuentan);
+- si responde a tiempo un lote que llegó cerca de algún límite, los límites
+  crecen en un paso fijo.
+
+Cada lote queda registrado en BatchStats (tamaño, archivos y latencias) para
+afinar los valores; se consulta en GET /batch-stats.
+"""
+import math
+import os
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Sequence, TypeVar
+
+import httpx
+
+T = TypeVar("T")
+
+CAVALI_BATCH_FILES_INITIAL = int(os.getenv("CAVALI_BATCH_FILES_INITIAL", "30"))
+CAVALI_BATCH_FILES_MIN = int(os.getenv("CAVALI_BATCH_FILES_MIN", "5"))
+CAVALI_BATCH_FILES_MAX = int(os.getenv("CAVALI_BATCH_FILES_MAX", "100"))
+CAVALI_BATCH_FILES_STEP = int(os.getenv("CAVALI_BATCH_FILES_STEP", "5"))
+CAVALI_BATCH_BYTES_INITIAL = int(os.getenv("CAVALI_BATCH_BYTES_INITIAL", str(2 * 1024 * 1024)))
+CAVALI_BATCH_BYTES_MIN = int(os.getenv("CAVALI_BATCH_BYTES_MIN", str(256 * 1024)))
+CAVALI_BATCH_BYTES_MAX = int(os.getenv("CAVALI_BATCH_BYTES_MAX", str(8 * 1024 * 1024)))
+CAVALI_BATCH_BYTES_STEP = int(os.getenv("CAVALI_BATCH_BYTES_STEP", str(512 * 1024)))
+CAVALI_BATCH_TARGET_SECONDS = float(os.getenv("CAVALI_BATCH_TARGET_SECONDS", "20"))
+CAVALI_BATCH_STATS_WINDOW = int(os.getenv("CAVALI_BATCH_STATS_WINDOW", "500"))
+
+# Un lote "llegó cerca del límite" si usó al menos esta fracción de archivos o de bytes
+_UMBRAL_CRECIMIENTO = 0.8
+
+def encoded_size(raw_size: int) -> int:
+    """Tamaño en base64 de un contenido de raw_size bytes."""
+    return 4 * math.ceil(raw_size / 3)
+
+def is_overload(error: Exception) -> bool:
+    """Errores que indican que el lote fue demasiado para Cavali (y no un problema del contenido)."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+def plan_batches(files: Sequence[T], max_files: int, max_bytes: int, size_of: Callable[[T], int]) -> List[List[T]]:
+    """Agrupa en orden sin pasar ninguno de los dos límites; un archivo más grande que max_bytes va solo."""
+    lotes, actual, bytes_actual = [], [], 0
+    for f in files:
+        tamano = size_of(f)
+        if actual and (len(actual) >= max_files or bytes_actual + tamano > max_bytes):
+            lotes.append(actual)
+            actual, bytes_actual = [], 0
+        actual.append(f)
+        bytes_actual += tamano
+    if actual:
+        lotes.append(actual)
+    return lotes
+
+class AdaptiveBatchLimits:
+    def __init__(self):
+        self.max_files = CAVALI_BATCH_FILES_INITIAL
+        self.max_bytes = CAVALI_BATCH_BYTES_INITIAL
+        # Sube en cada reducción; cada lote recuerda con qué generación se armó
+        self.generation = 0
+
+    def observe(self, files: int, size: int, seconds: float, error: Optional[Exception] = None, generation: Optional[int] = None):
+        if (error is not None and is_overload(error)) or seconds > CAVALI_BATCH_TARGET_SECONDS:
+            if generation is not None and generation < self.generation:
+                # Lote armado con límites que ya se redujeron por este mismo episodio
+                return
+            self.max_files = max(CAVALI_BATCH_FILES_MIN, self.max_files // 2)
+            self.max_bytes = max(CAVALI_BATCH_BYTES_MIN, self.max_bytes // 2)
+            self.generation += 1
+        elif error is None and (files >= self.max_files * _UMBRAL_CRECIMIENTO or size >= self.max_bytes * _UMBRAL_CRECIMIENTO):
+            self.max_files = min(CAVALI_BATCH_FILES_MAX, self.max_files + CAVALI_BATCH_FILES_STEP)
+            self.max_bytes = min(CAVALI_BATCH_BYTES_MAX, self.max_bytes + CAVALI_BATCH_BYTES_STEP)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {"max_files": self.max_files, "max_bytes": self.max_bytes, "generation": self.generation}
+
+class BatchStats:
+    """Últimos CAVALI_BATCH_STATS_WINDOW lotes enviados a Cavali."""
+    def __init__(self, window: int):
+        self._lotes = deque(maxlen=window)
+
+    def record(self, files: int, size: int, block_seconds: float, total_seconds: float, result: str, limits: Dict[str, int]):
+        self._lotes.append({
+            "at": time.time(), "files": files, "bytes": size,
+            "block_seconds": round(block_seconds, 3), "total_seconds": round(total_seconds, 3),
+            "result": result, "limits": limits,
+        })
+
+    def snapshot(self, limit: int = 100) -> dict:
+        lotes = list(self._lotes)
+        latencias = sorted(l["block_seconds"] for l in lotes)
+
+        def percentil(p: float) -> Optional[float]:
+            return latencias[min(len(latencias) - 1, int(len(latencias) * p))] if latencias else None
+
+        return {
+            "batches": len(lotes),
+            "error_rate": round(sum(1 for l in lotes if l["result"] != "ok") / len(lotes), 4) if lotes else 0.0,
+            "block_seconds_p50": percentil(0.5),
+            "block_seconds_p95": percentil(0.95),
+            "avg_bytes": round(sum(l["bytes"] for l in lotes) / len(lotes)) if lotes else 0,
+            "avg_files": round(sum(l["files"] for l in lotes) / len(lotes), 1) if lotes else 0,
+            "recent": lotes[-limit:],
+        }
@@ -0,0 +1,44 @@
+"""
+Cuerpo JSON del bloqueo de Cavali generado por partes:
+
+    {"invoiceXMLDetail": {"invoiceXML": [{"name": ..., "fileXml": "<base64>"}, ...]}}
+
+El base64 de cada XML se codifica por bloques mientras httpx envía el cuerpo,
+así que nunca existen a la vez el string base64 completo ni el JSON completo.
+Como el largo se conoce de antemano (base64 tiene tamaño exacto) se envía con
+Content-Length y no con transferencia chunked.
+"""
+import base64
+import json
+from typing import AsyncIterator, List, Tuple
+
+from batching import encoded_size
+
+# Múltiplo de 3 para que cada bloque codifique sin relleno intermedio
+CHUNK_RAW_BYTES = 48 * 1024
+
+_INICIO = b'{"invoiceXMLDetail": {"invoiceXML": ['
+_FIN = b']}}'
+_CIERRE = b'"}'
+
+def _cabecera(filename: str, primero: bool) -> bytes:
+    return (("" if primero else ", ") + '{"name": ' + json.dumps(filename) + ', "fileXml": "').encode("utf-8")
+
+def block_body(files: List[Tuple[str, bytes]]) -> Tuple[int, AsyncIterator[bytes]]:
+    """Recibe [(nombre, contenido)] y devuelve (Content-Length, iterador del cuerpo)."""
+    largo = len(_INICIO) + len(_FIN) + sum(
+        len(_cabecera(nombre, i == 0)) + encoded_size(len(contenido)) + len(_CIERRE)
+        for i, (nombre, contenido) in enumerate(files)
+    )
+
+    async def partes() -> AsyncIterator[bytes]:
+        yield _INICIO
+        for i, (nombre, contenido) in enumerate(files):
+            yield _cabecera(nombre, i == 0)
+            vista = memoryview(contenido)
+            for inicio in range(0, len(vista), CHUNK_RAW_BYTES):
+                yield base64.b64encode(vista[inicio:inicio + CHUNK_RAW_BYTES])
+            yield _CIERRE
+        yield _FIN
+
+    return largo, partes()
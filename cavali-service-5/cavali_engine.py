@@ -0,0 +1,350 @@
+"""
+Motor asíncrono de validación en Cavali, compartido por /pubsub-handler y
+/validate-direct.
+
+Por cada lote de XML: envía el bloqueo a CAVALI_BLOCK_URL y consulta
+CAVALI_STATUS_URL con backoff exponencial hasta que el proceso termina, en
+lugar de dormir un tiempo fijo y leer el estado una sola vez. Los lotes de una
+operación se envían en paralelo, acotados por los cupos de procesos y el token
+bucket de rate_limit.py (compartidos por todas las rutas del servicio), y el
+token se reutiliza desde memoria (cavali_token.py). Las facturas ya validadas con el
+mismo XML se responden desde result_cache.py sin volver a Cavali. Toda la E/S es
+asíncrona (httpx) o corre en hilos (GCS), así que el event loop queda
+libre y una instancia puede validar muchas operaciones a la vez.
+
+Los lotes se arman con los tamaños de los metadatos de GCS; cada XML se
+descarga recién cuando su lote se va a enviar, el base64 se genera mientras se
+sube el cuerpo (block_payload.py) y el contenido se descarta al terminar la
+subida, así que la memoria de una operación es la de un lote, no la de todos
+sus XML.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+from google.cloud import storage
+
+import tracing
+from batching import CAVALI_BATCH_STATS_WINDOW, AdaptiveBatchLimits, BatchStats, encoded_size, is_overload, plan_batches
+from block_payload import block_body
+from cavali_token import CavaliTokenHolder
+from invoice_keys import invoice_key, key_from_result
+from rate_limit import CAVALI_THROTTLE_RETRIES, CavaliRateLimiter, RateLimitExceeded, retry_after_seconds
+from result_cache import CAVALI_RESULT_CACHE_MAX_ENTRIES, CavaliResultCache, cache_key
+
+CAVALI_API_KEY = os.getenv("CAVALI_API_KEY")
+CAVALI_BLOCK_URL = os.getenv("CAVALI_BLOCK_URL")
+CAVALI_STATUS_URL = os.getenv("CAVALI_STATUS_URL")
+
+# Consulta de estado: primera espera, factor de crecimiento, espera máxima entre consultas y tiempo total máximo
+CAVALI_POLL_INITIAL_SECONDS = float(os.getenv("CAVALI_POLL_INITIAL_SECONDS", "1.5"))
+CAVALI_POLL_FACTOR = float(os.getenv("CAVALI_POLL_FACTOR", "1.6"))
+CAVALI_POLL_MAX_INTERVAL_SECONDS = float(os.getenv("CAVALI_POLL_MAX_INTERVAL_SECONDS", "10"))
+CAVALI_POLL_MAX_SECONDS = float(os.getenv("CAVALI_POLL_MAX_SECONDS", "180"))
+# Lotes de una misma operación descargados y subiéndose a la vez (cada uno ocupa su tamaño en memoria)
+CAVALI_UPLOADS_PER_OPERATION = int(os.getenv("CAVALI_UPLOADS_PER_OPERATION", "1"))
+CAVALI_HTTP_TIMEOUT_SECONDS = float(os.getenv("CAVALI_HTTP_TIMEOUT_SECONDS", "300"))
+
+storage_client = storage.Client()
+
+def _headers(token: str) -> Dict[str, str]:
+    return {"Authorization": f"Bearer {token}", "x-api-key": CAVALI_API_KEY}
+
+def _facturas_del_estado(cavali_response_data: dict) -> List[dict]:
+    return cavali_response_data.get("response", {}).get("Process", {}).get("ProcessInvoiceDetail", {}).get("Invoice", []) or []
+
+def _proceso_terminado(invoices: List[dict], esperadas: int) -> bool:
+    """El proceso terminó cuando reporta una fila con resultCode por cada XML del lote."""
+    return len(invoices) >= esperadas and all(str(inv.get("resultCode") or "").strip() for inv in invoices)
+
+class _Proceso:
+    """Un lote bloqueado en Cavali cuyo estado aún se está consultando."""
+    __slots__ = ("id_proceso", "batch", "size", "inicio", "token", "cupo", "block_seconds", "espera", "siguiente", "limite", "consultas")
+
+    def __init__(self, id_proceso: str, batch: List[dict], size: int, inicio: float, token: str, cupo: Optional[str], block_seconds: float):
+        ahora = time.monotonic()
+        self.id_proceso = id_proceso
+        self.token = token
+        self.cupo = cupo
+        self.batch = batch
+        self.size = size
+        self.inicio = inicio
+        self.block_seconds = block_seconds
+        self.espera = CAVALI_POLL_INITIAL_SECONDS
+        self.siguiente = ahora + CAVALI_POLL_INITIAL_SECONDS
+        self.limite = ahora + CAVALI_POLL_MAX_SECONDS
+        self.consultas = 0
+
+class CavaliEngine:
+    def __init__(self):
+        self._http: Optional[httpx.AsyncClient] = None
+        self.limiter = CavaliRateLimiter()
+        self.tokens = CavaliTokenHolder(storage_client)
+        self.results = CavaliResultCache(storage_client, CAVALI_RESULT_CACHE_MAX_ENTRIES)
+        self.batch_limits = AdaptiveBatchLimits()
+        self.batch_stats = BatchStats(CAVALI_BATCH_STATS_WINDOW)
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        # Un solo cliente por proceso: reutiliza las conexiones TLS con Cavali
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=CAVALI_HTTP_TIMEOUT_SECONDS)
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _describe(self, gcs_path: str) -> dict:
+        """Solo metadatos (tamaño) del XML: alcanzan para armar los lotes sin descargarlo."""
+        bucket_name, blob_name = gcs_path.replace("gs://", "").split("/", 1)
+        blob = await asyncio.to_thread(storage_client.bucket(bucket_name).get_blob, blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"No existe el XML {gcs_path}")
+        return {"path": gcs_path, "filename": os.path.basename(gcs_path), "size": encoded_size(blob.size or 0)}
+
+    async def _download(self, f: dict):
+        """Descarga el XML de un lote justo antes de enviarlo y calcula su identidad."""
+        bucket_name, blob_name = f["path"].replace("gs://", "").split("/", 1)
+        blob = storage_client.bucket(bucket_name).blob(blob_name)
+        with tracing.span("gcs.download", path=f["path"]):
+            content_bytes = await asyncio.to_thread(blob.download_as_bytes)
+        f["content"] = content_bytes
+        f["size"] = encoded_size(len(content_bytes))
+        f["key"] = invoice_key(f["filename"], content_bytes)
+        f["cache_key"] = cache_key(f["key"], content_bytes)
+
+    async def _post(self, url: str, request: Callable[[], dict]) -> Tuple[httpx.Response, float]:
+        """
+        POST a Cavali dentro del límite de tráfico: espera turno en el token
+        bucket y, si Cavali igual responde 429, pausa todas las llamadas durante
+        Retry-After y reintenta (request() arma de nuevo los argumentos, porque
+        un cuerpo por partes no se puede reenviar). Devuelve la respuesta y los
+        segundos del último intento, sin contar la cola.
+        """
+        intento = 0
+        while True:
+            await self.limiter.acquire()
+            inicio = time.monotonic()
+            response = await self.http.post(url, **request())
+            if response.status_code != 429 or intento >= CAVALI_THROTTLE_RETRIES:
+                return response, time.monotonic() - inicio
+            intento += 1
+            espera = retry_after_seconds(response, intento)
+            logging.warning(f"CAVALI RATE: Cavali respondió 429 en {url}; se pausan las llamadas {espera}s (reintento {intento}/{CAVALI_THROTTLE_RETRIES}).")
+            await self.limiter.pause(espera)
+
+    async def _submit_batch(self, batch: List[dict], headers: Dict[str, str]) -> Tuple[str, float]:
+        """Envía el bloqueo de un lote (cuerpo generado por partes) y devuelve el idProceso asignado por Cavali y lo que tardó."""
+        archivos = [(f["filename"], f["content"]) for f in batch]
+
+        def peticion() -> dict:
+            largo, cuerpo = block_body(archivos)
+            return {"content": cuerpo, "headers": dict(headers, **{"Content-Type": "application/json", "Content-Length": str(largo)})}
+
+        with tracing.span("cavali.block", "client", archivos=len(batch)):
+            response_bloqueo, segundos = await self._post(CAVALI_BLOCK_URL, peticion)
+        response_bloqueo.raise_for_status()
+        bloqueo_data = response_bloqueo.json()
+        id_proceso = bloqueo_data.get("response", {}).get("idProceso")
+
+        if not id_proceso:
+            raise ValueError(f"Cavali no retornó un idProceso para el lote. Respuesta: {bloqueo_data}")
+        return id_proceso, segundos
+
+    async def _poll(self, proceso: _Proceso, log_prefix: str) -> Optional[List[dict]]:
+        """Consulta el estado de un proceso; devuelve sus facturas si terminó (o se agotó el plazo) y None si hay que seguir esperando."""
+        proceso.consultas += 1
+        with tracing.span("cavali.status", "client", id_proceso=proceso.id_proceso, consulta=proceso.consultas):
+            response_estado, _ = await self._post(CAVALI_STATUS_URL, lambda: {"json": {"ProcessFilter": {"idProcess": proceso.id_proceso}}, "headers": _headers(proceso.token)})
+        response_estado.raise_for_status()
+        invoices = _facturas_del_estado(response_estado.json())
+        if _proceso_terminado(invoices, len(proceso.batch)):
+            return invoices
+        if time.monotonic() + proceso.espera > proceso.limite:
+            logging.warning(f"{log_prefix}: Proceso {proceso.id_proceso} sin terminar tras {proceso.consultas} consultas; se usan {len(invoices)} resultados parciales.")
+            return invoices
+        self._reprogramar(proceso)
+        return None
+
+    @staticmethod
+    def _reprogramar(proceso: _Proceso):
+        proceso.siguiente = time.monotonic() + proceso.espera
+        proceso.espera = min(proceso.espera * CAVALI_POLL_FACTOR, CAVALI_POLL_MAX_INTERVAL_SECONDS)
+
+    def _reintentar_consulta(self, proceso: _Proceso, error: Exception, log_prefix: str) -> bool:
+        """
+        Un 5xx, 429 o error de red al consultar no dice nada del lote, que Cavali
+        ya aceptó: se vuelve a consultar con el mismo backoff mientras quede plazo.
+        """
+        if not (is_overload(error) or isinstance(error, RateLimitExceeded)):
+            return False
+        if time.monotonic() + proceso.espera > proceso.limite:
+            return False
+        motivo = f"HTTP {error.response.status_code}" if isinstance(error, httpx.HTTPStatusError) else type(error).__name__
+        logging.warning(f"{log_prefix}: Consulta {proceso.consultas} del proceso {proceso.id_proceso} falló ({motivo}); se reintenta en {proceso.espera:.1f}s.")
+        self._reprogramar(proceso)
+        return True
+
+    @staticmethod
+    def _map_results(invoices: List[dict], batch: List[dict], id_proceso: str, log_prefix: str) -> Dict[str, dict]:
+        # Índice del lote por (ruc, serie, número): cada fila de Cavali se cruza con una sola búsqueda
+        por_clave = {}
+        for f in batch:
+            if f["key"] is not None:
+                por_clave.setdefault(f["key"], f["filename"])
+
+        resultados = {}
+        for invoice in invoices:
+            nombre_archivo_original = por_clave.get(key_from_result(invoice))
+            if nombre_archivo_original is None:
+                logging.warning(f"{log_prefix}: Fila de Cavali sin archivo en el lote {id_proceso}: {invoice.get('ruc')}-{invoice.get('serie')}-{invoice.get('numeration')}")
+                nombre_archivo_original = "desconocido"
+
+            resultados[nombre_archivo_original] = {
+                "message": invoice.get("message"), "process_id": id_proceso, "result_code": invoice.get("resultCode")
+            }
+        return resultados
+
+    def _batch_error(self, error: Exception, batch: List[dict], tracking_id: str, log_prefix: str, token: str) -> Dict[str, dict]:
+        """Marca todos los archivos de un lote como fallidos."""
+        batch_filenames = [f['filename'] for f in batch]
+        if isinstance(error, httpx.HTTPStatusError):
+            if error.response.status_code == 401:
+                # Token revocado o vencido antes de tiempo: la siguiente validación pide otro
+                self.tokens.invalidate(token)
+            logging.error(f"{log_prefix}: Error HTTP procesando el lote para {tracking_id}. Archivos: {batch_filenames}. Error: {error} - Respuesta: {error.response.text}")
+            logging.error(f"{log_prefix}: URL usada: {error.request.url}")
+            return {f['filename']: {"message": f"Error en lote: {error}", "process_id": None, "result_code": "BATCH_ERROR"} for f in batch}
+        logging.error(f"{log_prefix}: Error inesperado procesando el lote para {tracking_id}. Archivos: {batch_filenames}. Error: {error}")
+        return {f['filename']: {"message": f"Error inesperado en lote: {error}", "process_id": None, "result_code": "UNEXPECTED_BATCH_ERROR"} for f in batch}
+
+    async def validate(self, tracking_id: str, xml_paths: List[str], log_prefix: str = "CAVALI",
+                       on_results: Optional[Callable[[Dict[str, dict]], None]] = None) -> Dict[str, dict]:
+        """
+        Valida los XML de una operación y devuelve {nombre de archivo: resultado de Cavali}.
+
+        Los lotes se arman por cantidad y tamaño según los límites adaptativos
+        (batching.py) y cada uno se descarga justo antes de subirse. Todos se
+        envían a la vez (dentro de los cupos de procesos y del token bucket de
+        rate_limit.py) y un único bucle consulta juntos los idProceso
+        pendientes que ya tocan; cada lote se incorpora a final_results_map en
+        cuanto termina (y se informa a on_results, si se pasa, para reportar
+        avance parcial).
+        """
+        logging.info(f"{log_prefix}: Procesando {tracking_id} con {len(xml_paths)} XMLs.")
+
+        # Mapa para consolidar los resultados de todos los lotes
+        final_results_map = {}
+        nuevos_resultados = []
+        pendientes: Dict[str, _Proceso] = {}
+        cambio = asyncio.Event()
+        limiter = self.limiter
+        # Solo CAVALI_UPLOADS_PER_OPERATION lotes de la operación tienen su contenido en memoria a la vez
+        subidas = asyncio.Semaphore(CAVALI_UPLOADS_PER_OPERATION)
+
+        def incorporar(resultados: Dict[str, dict]):
+            final_results_map.update(resultados)
+            if on_results is not None and resultados:
+                on_results(resultados)
+
+        async def enviar(numero: int, batch: List[dict]):
+            async with subidas:
+                try:
+                    cupo = await limiter.acquire_process(CAVALI_POLL_MAX_SECONDS + CAVALI_HTTP_TIMEOUT_SECONDS)
+                except RateLimitExceeded as e:
+                    incorporar(self._batch_error(e, batch, tracking_id, log_prefix, None))
+                    cambio.set()
+                    return
+                registrado = False
+                token = None
+                inicio = time.monotonic()
+                try:
+                    await asyncio.gather(*(self._download(f) for f in batch))
+
+                    # Las facturas ya validadas con el mismo XML no vuelven a Cavali
+                    en_cache = await self.results.get_many(f["cache_key"] for f in batch)
+                    if en_cache:
+                        incorporar({f["filename"]: dict(en_cache[f["cache_key"]], cached=True) for f in batch if f["cache_key"] in en_cache})
+                        batch = [f for f in batch if f["cache_key"] not in en_cache]
+                        logging.info(f"{log_prefix}: Lote {numero} de {tracking_id}: {len(en_cache)} facturas resueltas desde caché; {len(batch)} van a Cavali.")
+                    if not batch:
+                        return
+
+                    token = await self.tokens.get(self.http)
+                    size = sum(f["size"] for f in batch)
+                    inicio = time.monotonic()
+                    logging.info(f"{log_prefix}: Enviando lote {numero} para {tracking_id} con {len(batch)} archivos ({size} bytes): {[f['filename'] for f in batch]}")
+                    id_proceso, block_seconds = await self._submit_batch(batch, _headers(token))
+                    proceso = _Proceso(id_proceso, batch, size, inicio, token, cupo, block_seconds)
+                    self.batch_limits.observe(len(batch), size, proceso.block_seconds, generation=generacion)
+                    pendientes[id_proceso] = proceso
+                    registrado = True
+                except Exception as e:
+                    size = sum(f["size"] for f in batch)
+                    segundos = time.monotonic() - inicio
+                    if not isinstance(e, RateLimitExceeded):
+                        # Esperar en la cola del límite no dice nada sobre el tamaño del lote
+                        self.batch_limits.observe(len(batch), size, segundos, e, generation=generacion)
+                    self.batch_stats.record(len(batch), size, segundos, segundos, "block_error", self.batch_limits.snapshot())
+                    incorporar(self._batch_error(e, batch, tracking_id, log_prefix, token))
+                finally:
+                    # El contenido ya viajó (o el lote falló): se libera antes de esperar el estado
+                    for f in batch:
+                        f.pop("content", None)
+                    if not registrado:
+                        limiter.release_process(cupo)
+                    cambio.set()
+
+        def cerrar(proceso: _Proceso, resultado: str):
+            del pendientes[proceso.id_proceso]
+            limiter.release_process(proceso.cupo)
+            self.batch_stats.record(len(proceso.batch), proceso.size, proceso.block_seconds,
+                                    time.monotonic() - proceso.inicio, resultado, self.batch_limits.snapshot())
+
+        archivos = list(await asyncio.gather(*(self._describe(gcs_path) for gcs_path in xml_paths)))
+        generacion = self.batch_limits.generation
+        lotes = plan_batches(archivos, self.batch_limits.max_files, self.batch_limits.max_bytes, lambda f: f["size"])
+        envios = [asyncio.ensure_future(enviar(numero, batch)) for numero, batch in enumerate(lotes, start=1)]
+        try:
+            while pendientes or not all(envio.done() for envio in envios):
+                cambio.clear()
+                espera = max(0.0, min(p.siguiente for p in pendientes.values()) - time.monotonic()) if pendientes else None
+                try:
+                    await asyncio.wait_for(cambio.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
+
+                ahora = time.monotonic()
+                vencidos = [p for p in pendientes.values() if p.siguiente <= ahora]
+                if not vencidos:
+                    continue
+                respuestas = await asyncio.gather(*(self._poll(p, log_prefix) for p in vencidos), return_exceptions=True)
+                for proceso, respuesta in zip(vencidos, respuestas):
+                    if isinstance(respuesta, Exception):
+                        if self._reintentar_consulta(proceso, respuesta, log_prefix):
+                            continue
+                        incorporar(self._batch_error(respuesta, proceso.batch, tracking_id, log_prefix, proceso.token))
+                        cerrar(proceso, "status_error")
+                    elif respuesta is not None:
+                        resultados = self._map_results(respuesta, proceso.batch, proceso.id_proceso, log_prefix)
+                        incorporar(resultados)
+                        nuevos_resultados += [(f["cache_key"], resultados[f["filename"]]) for f in proceso.batch if f["filename"] in resultados]
+                        cerrar(proceso, "ok" if len(respuesta) >= len(proceso.batch) else "partial")
+        finally:
+            # Si la validación se cancela, libera los cupos que aún ocupa
+            for envio in envios:
+                envio.cancel()
+            for proceso in pendientes.values():
+                limiter.release_process(proceso.cupo)
+            pendientes.clear()
+
+        await self.results.put_many(nuevos_resultados)
+        return final_results_map
+
+# Singleton instance
+cavali_engine = CavaliEngine()
@@ -0,0 +1,135 @@
+"""
+Token OAuth de Cavali en memoria, con renovación anticipada y de vuelo único.
+
+Cada instancia guarda el token en memoria y lo renueva antes de que venza
+(CAVALI_TOKEN_REFRESH_MARGIN_SECONDS): mientras aún es válido se sigue usando y
+la renovación corre en segundo plano. Un asyncio.Lock garantiza que solo haya
+una renovación en curso aunque lleguen muchas validaciones a la vez.
+
+GCS (cavali_token.json) solo se usa como respaldo compartido entre instancias:
+antes de pedir un token nuevo se lee el de GCS por si otra instancia ya lo
+renovó, y cada token nuevo se guarda ahí.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import httpx
+from google.api_core.exceptions import NotFound
+
+import tracing
+
+CAVALI_CLIENT_ID = os.getenv("CAVALI_CLIENT_ID")
+CAVALI_CLIENT_SECRET = os.getenv("CAVALI_CLIENT_SECRET")
+CAVALI_SCOPE = os.getenv("CAVALI_SCOPE")
+CAVALI_TOKEN_URL = os.getenv("CAVALI_TOKEN_URL")
+CAVALI_API_KEY = os.getenv("CAVALI_API_KEY")
+GCS_BUCKET_NAME_TOKEN = os.getenv("GCS_BUCKET_NAME")
+TOKEN_FILE_NAME = "cavali_token.json"
+
+# Se renueva cuando le quedan menos de estos segundos; por debajo de TOKEN_MIN_VALIDITY_SECONDS ya no se usa
+CAVALI_TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("CAVALI_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+TOKEN_MIN_VALIDITY_SECONDS = 60
+
+class CavaliTokenHolder:
+    def __init__(self, storage_client):
+        self.storage_client = storage_client
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+        self._renovacion: Optional[asyncio.Task] = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # Se crea dentro del event loop (en Python 3.9 el lock se ata al loop al construirse)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _restante(self) -> float:
+        return self._expires_at - time.time() if self._token else 0.0
+
+    async def get(self, http: httpx.AsyncClient) -> str:
+        """Devuelve un token válido; solo espera a Cavali/GCS si no hay ninguno utilizable en memoria."""
+        restante = self._restante()
+        if restante > CAVALI_TOKEN_REFRESH_MARGIN_SECONDS:
+            return self._token
+        if restante > TOKEN_MIN_VALIDITY_SECONDS:
+            if self._renovacion is None or self._renovacion.done():
+                self._renovacion = asyncio.ensure_future(self._refresh(http))
+                self._renovacion.add_done_callback(self._log_renovacion_fallida)
+            return self._token
+        return await self._refresh(http)
+
+    def invalidate(self, token: str):
+        """Descarta el token en memoria (p. ej. tras un 401) para que la siguiente llamada lo renueve."""
+        if token == self._token:
+            self._token = None
+            self._expires_at = 0.0
+
+    @staticmethod
+    def _log_renovacion_fallida(tarea: asyncio.Task):
+        if not tarea.cancelled() and tarea.exception() is not None:
+            logging.error(f"CAVALI: Falló la renovación anticipada del token: {tarea.exception()}")
+
+    async def _refresh(self, http: httpx.AsyncClient) -> str:
+        async with self.lock:
+            # Otra corrutina pudo renovarlo mientras se esperaba el lock
+            if self._restante() > CAVALI_TOKEN_REFRESH_MARGIN_SECONDS:
+                return self._token
+
+            token_data = await asyncio.to_thread(self._read_gcs)
+            if token_data and token_data.get("expires_at", 0) - time.time() > CAVALI_TOKEN_REFRESH_MARGIN_SECONDS:
+                logging.info("Token válido obtenido desde GCS.")
+            else:
+                token_data = await self._request_token(http)
+                await asyncio.to_thread(self._write_gcs, token_data)
+                logging.info(f"Nuevo token de Cavali guardado en GCS.")
+
+            self._token = token_data["access_token"]
+            self._expires_at = token_data["expires_at"]
+            return self._token
+
+    def _blob(self):
+        if not GCS_BUCKET_NAME_TOKEN:
+            logging.error("La variable de entorno GCS_BUCKET_NAME para el token no está configurada.")
+            raise ValueError("Configuración de GCS para token incompleta.")
+        return self.storage_client.bucket(GCS_BUCKET_NAME_TOKEN).blob(TOKEN_FILE_NAME)
+
+    def _read_gcs(self) -> Optional[dict]:
+        blob = self._blob()
+        try:
+            return json.loads(blob.download_as_bytes())
+        except NotFound:
+            return None
+        except Exception as e:
+            logging.error(f"No se pudo leer el token desde GCS, se solicitará uno nuevo. Error: {e}")
+            return None
+
+    def _write_gcs(self, token_data: dict):
+        self._blob().upload_from_string(json.dumps(token_data), content_type="application/json")
+
+    async def _request_token(self, http: httpx.AsyncClient) -> dict:
+        logging.info(f"Solicitando nuevo token de Cavali desde URL: {CAVALI_TOKEN_URL}")
+        data = {
+            "grant_type": "client_credentials", "client_id": CAVALI_CLIENT_ID,
+            "client_secret": CAVALI_CLIENT_SECRET, "scope": CAVALI_SCOPE,
+        }
+        headers = {"Content-Type": "application/x-www-form-urlencoded",
+                   "x-api-key": CAVALI_API_KEY}
+        try:
+            with tracing.span("cavali.token", "client"):
+                response = await http.post(CAVALI_TOKEN_URL, data=data, headers=headers, timeout=30)
+            response.raise_for_status()
+            new_token_data = response.json()
+        except httpx.HTTPError as e:
+            logging.error(f"Error al obtener token de Cavali: {e}")
+            if isinstance(e, httpx.HTTPStatusError):
+                logging.error(f"Respuesta de error: {e.response.text}")
+            raise
+
+        expires_at = time.time() + new_token_data.get("expires_in", 3600)
+        return {"access_token": new_token_data["access_token"], "expires_at": expires_at}
@@ -0,0 +1,58 @@
+"""
+Identidad de una factura electrónica para cruzar las filas de Cavali con los
+archivos enviados: (RUC del emisor, serie, número).
+
+Se toma del propio XML (UBL 2.1 de SUNAT) y, si no se puede leer, del nombre
+del archivo según la nomenclatura de SUNAT: RUC-TIPO-SERIE-NUMERO.xml
+(p. ej. 20123456789-01-F001-00001234.xml).
+"""
+import logging
+import re
+import xml.etree.ElementTree as ET
+from typing import Optional, Tuple
+
+InvoiceKey = Tuple[str, str, str]
+
+_NS = {
+    "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
+    "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
+}
+_NOMBRE_SUNAT = re.compile(r"^(?P<ruc>\d{11})-(?P<tipo>\d{2})-(?P<serie>[A-Z0-9]{4})-(?P<numero>\d{1,8})\.xml$", re.IGNORECASE)
+_DOCUMENTO = re.compile(r"^(?P<serie>[A-Z0-9]{4})-(?P<numero>\d{1,8})$", re.IGNORECASE)
+
+def normalize_key(ruc, serie, numero) -> Optional[InvoiceKey]:
+    """Normaliza la clave: serie en mayúsculas y número sin ceros a la izquierda (Cavali lo devuelve como entero)."""
+    ruc, serie, numero = str(ruc or "").strip(), str(serie or "").strip().upper(), str(numero or "").strip()
+    if not (ruc and serie and numero.isdigit()):
+        return None
+    return ruc, serie, str(int(numero))
+
+def key_from_xml(content: bytes) -> Optional[InvoiceKey]:
+    try:
+        root = ET.fromstring(content.lstrip(b"\xef\xbb\xbf"))
+    except ET.ParseError:
+        return None
+    documento = root.find("./cbc:ID", _NS)
+    ruc = root.find(".//cac:AccountingSupplierParty//cac:PartyIdentification/cbc:ID", _NS)
+    if documento is None or ruc is None:
+        return None
+    coincidencia = _DOCUMENTO.match((documento.text or "").strip())
+    if not coincidencia:
+        return None
+    return normalize_key(ruc.text, coincidencia["serie"], coincidencia["numero"])
+
+def key_from_filename(filename: str) -> Optional[InvoiceKey]:
+    coincidencia = _NOMBRE_SUNAT.match(filename)
+    if not coincidencia:
+        return None
+    return normalize_key(coincidencia["ruc"], coincidencia["serie"], coincidencia["numero"])
+
+def invoice_key(filename: str, content: bytes) -> Optional[InvoiceKey]:
+    clave = key_from_xml(content) or key_from_filename(filename)
+    if clave is None:
+        logging.warning(f"CAVALI: No se pudo identificar la factura de {filename} (ni por XML ni por nombre SUNAT).")
+    return clave
+
+def key_from_result(invoice: dict) -> Optional[InvoiceKey]:
+    """Clave de una fila de ProcessInvoiceDetail.Invoice de Cavali."""
+    return normalize_key(invoice.get("ruc"), invoice.get("serie"), invoice.get("numeration"))
@@ -0,0 +1,219 @@
+"""
+Límite de tráfico hacia la API de Cavali, compartido por /validate-direct,
+/pubsub-handler y /validate-jobs (todos pasan por CavaliEngine):
+
+- token bucket de CAVALI_RATE_PER_SECOND requests/s con ráfagas de hasta
+  CAVALI_RATE_BURST para los POST de bloqueo y de estado. Si no hay token, la
+  llamada espera en cola hasta CAVALI_RATE_MAX_WAIT_SECONDS antes de fallar;
+- a lo sumo CAVALI_MAX_IN_FLIGHT procesos (idProceso) abiertos por instancia;
+- un 429 de Cavali pausa el bucket durante Retry-After para todas las llamadas.
+
+Con CAVALI_RATE_REDIS_URL el bucket, la pausa y un tope global de procesos
+(CAVALI_GLOBAL_MAX_IN_FLIGHT) se coordinan entre instancias en Redis (requiere
+el paquete `redis`, que se importa solo en ese caso). Si Redis falla, se sigue
+con el límite local y se vuelve a probar Redis tras
+CAVALI_RATE_REDIS_RETRY_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Optional
+
+CAVALI_RATE_PER_SECOND = float(os.getenv("CAVALI_RATE_PER_SECOND", "5"))
+CAVALI_RATE_BURST = float(os.getenv("CAVALI_RATE_BURST", "10"))
+CAVALI_RATE_MAX_WAIT_SECONDS = float(os.getenv("CAVALI_RATE_MAX_WAIT_SECONDS", "30"))
+# Máximo de idProceso abiertos a la vez en Cavali por instancia (entre todas las operaciones)
+CAVALI_MAX_IN_FLIGHT = int(os.getenv("CAVALI_MAX_IN_FLIGHT", "8"))
+# Espera máxima por un cupo de proceso (local y global) antes de fallar con RateLimitExceeded
+CAVALI_PROCESS_SLOT_MAX_WAIT_SECONDS = float(os.getenv("CAVALI_PROCESS_SLOT_MAX_WAIT_SECONDS", "600"))
+CAVALI_RATE_REDIS_URL = os.getenv("CAVALI_RATE_REDIS_URL")
+CAVALI_RATE_REDIS_PREFIX = os.getenv("CAVALI_RATE_REDIS_PREFIX", "cavali:rate")
+CAVALI_GLOBAL_MAX_IN_FLIGHT = int(os.getenv("CAVALI_GLOBAL_MAX_IN_FLIGHT", "0"))  # 0 = sin tope global
+CAVALI_RATE_REDIS_RETRY_SECONDS = float(os.getenv("CAVALI_RATE_REDIS_RETRY_SECONDS", "30"))
+# Reintentos de una llamada que Cavali rechazó con 429 antes de darla por fallida
+CAVALI_THROTTLE_RETRIES = int(os.getenv("CAVALI_THROTTLE_RETRIES", "3"))
+THROTTLE_MAX_PAUSE_SECONDS = 30.0
+GLOBAL_SLOT_POLL_SECONDS = 0.5
+
+# Devuelve los segundos a esperar (0 si se tomó un token). Usa el reloj de Redis para que todas las instancias coincidan.
+_LUA_TOKEN = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local d = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'pause')
+local tokens = tonumber(d[1]) or burst
+local ts = tonumber(d[2]) or now
+local pause = tonumber(d[3]) or 0
+if now < pause then return tostring(pause - now) end
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'pause', pause)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+_LUA_PAUSE = """
+local t = redis.call('TIME')
+local hasta = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[1])
+local actual = tonumber(redis.call('HGET', KEYS[1], 'pause')) or 0
+if hasta > actual then redis.call('HSET', KEYS[1], 'pause', hasta) end
+return 1
+"""
+
+# Reserva un cupo global si hay lugar; los cupos vencen solos (score = vencimiento) por si una instancia muere.
+_LUA_SLOT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+  redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+  return 1
+end
+return 0
+"""
+
+def retry_after_seconds(response, attempt: int) -> float:
+    """Pausa pedida por Cavali en Retry-After (en segundos) o, si no la indica, backoff exponencial."""
+    try:
+        segundos = float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        segundos = 2.0 ** attempt
+    return min(max(segundos, 0.0), THROTTLE_MAX_PAUSE_SECONDS)
+
+class RateLimitExceeded(Exception):
+    """No hubo capacidad hacia Cavali dentro de la espera máxima (token o cupo de proceso)."""
+
+class CavaliRateLimiter:
+    def __init__(self, rate: float = CAVALI_RATE_PER_SECOND, burst: float = CAVALI_RATE_BURST, max_in_flight: int = CAVALI_MAX_IN_FLIGHT):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self._tokens = self.burst
+        self._ts = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._procesos: Optional[asyncio.Semaphore] = None
+        self._redis = None
+        self._redis_reintento_en = 0.0  # monotonic; mientras no llegue se usa solo el límite local
+        self.esperas = 0
+        self.segundos_esperados = 0.0
+        self.throttled = 0
+
+    @property
+    def procesos(self) -> asyncio.Semaphore:
+        # Se crea dentro del event loop (en Python 3.9 el semáforo se ata al loop al construirse)
+        if self._procesos is None:
+            self._procesos = asyncio.Semaphore(self.max_in_flight)
+        return self._procesos
+
+    def _redis_client(self):
+        if not CAVALI_RATE_REDIS_URL or time.monotonic() < self._redis_reintento_en:
+            return None
+        if self._redis is None:
+            try:
+                import redis.asyncio as aioredis
+                self._redis = aioredis.from_url(CAVALI_RATE_REDIS_URL)
+            except Exception as e:
+                self._sin_redis(e)
+                return None
+        return self._redis
+
+    def _sin_redis(self, e: Exception):
+        # Un Redis caído no debe frenar las validaciones: se sigue solo con el límite local
+        logging.error(f"CAVALI RATE: Redis no disponible, se usa el límite local por {CAVALI_RATE_REDIS_RETRY_SECONDS}s. Error: {e}")
+        self._redis_reintento_en = time.monotonic() + CAVALI_RATE_REDIS_RETRY_SECONDS
+
+    def _reservar_local(self) -> float:
+        ahora = time.monotonic()
+        if ahora < self._pausa_hasta:
+            return self._pausa_hasta - ahora
+        self._tokens = min(self.burst, self._tokens + (ahora - self._ts) * self.rate)
+        self._ts = ahora
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def _reservar(self) -> float:
+        redis = self._redis_client()
+        if redis is not None:
+            try:
+                return float(await redis.eval(_LUA_TOKEN, 1, f"{CAVALI_RATE_REDIS_PREFIX}:bucket", self.rate, self.burst))
+            except Exception as e:
+                self._sin_redis(e)
+        return self._reservar_local()
+
+    async def acquire(self):
+        """Espera un token del bucket; lanza RateLimitExceeded si la cola supera CAVALI_RATE_MAX_WAIT_SECONDS."""
+        inicio = time.monotonic()
+        limite = inicio + CAVALI_RATE_MAX_WAIT_SECONDS
+        while True:
+            espera = await self._reservar()
+            if espera <= 0:
+                if time.monotonic() > inicio:
+                    self.segundos_esperados += time.monotonic() - inicio
+                return
+            if time.monotonic() + espera > limite:
+                raise RateLimitExceeded(f"sin capacidad hacia Cavali tras {CAVALI_RATE_MAX_WAIT_SECONDS}s en cola")
+            self.esperas += 1
+            await asyncio.sleep(espera)
+
+    async def pause(self, seconds: float):
+        """Cavali respondió 429: nadie llama durante `seconds`."""
+        self.throttled += 1
+        self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + seconds)
+        redis = self._redis_client()
+        if redis is not None:
+            try:
+                await redis.eval(_LUA_PAUSE, 1, f"{CAVALI_RATE_REDIS_PREFIX}:bucket", seconds)
+            except Exception as e:
+                self._sin_redis(e)
+
+    async def acquire_process(self, lease_seconds: float) -> Optional[str]:
+        """Reserva un cupo de proceso (local y, si aplica, global). Devuelve el id del cupo global o None.
+
+        Lanza RateLimitExceeded si no hay cupo en CAVALI_PROCESS_SLOT_MAX_WAIT_SECONDS.
+        """
+        limite = time.monotonic() + CAVALI_PROCESS_SLOT_MAX_WAIT_SECONDS
+        try:
+            await asyncio.wait_for(self.procesos.acquire(), CAVALI_PROCESS_SLOT_MAX_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise RateLimitExceeded(f"sin cupo de proceso en Cavali tras {CAVALI_PROCESS_SLOT_MAX_WAIT_SECONDS}s") from None
+        redis = self._redis_client()
+        if redis is None or CAVALI_GLOBAL_MAX_IN_FLIGHT <= 0:
+            return None
+        lease = uuid.uuid4().hex
+        try:
+            while not await redis.eval(_LUA_SLOT, 1, f"{CAVALI_RATE_REDIS_PREFIX}:procesos", CAVALI_GLOBAL_MAX_IN_FLIGHT, lease_seconds, lease):
+                if time.monotonic() + GLOBAL_SLOT_POLL_SECONDS > limite:
+                    raise RateLimitExceeded(f"sin cupo global de proceso en Cavali tras {CAVALI_PROCESS_SLOT_MAX_WAIT_SECONDS}s")
+                await asyncio.sleep(GLOBAL_SLOT_POLL_SECONDS)
+        except (asyncio.CancelledError, RateLimitExceeded):
+            self.procesos.release()
+            raise
+        except Exception as e:
+            self._sin_redis(e)
+            return None
+        return lease
+
+    def release_process(self, lease: Optional[str]):
+        self.procesos.release()
+        redis = self._redis_client()
+        if lease is not None and redis is not None:
+            asyncio.ensure_future(self._liberar_global(redis, lease))
+
+    async def _liberar_global(self, redis, lease: str):
+        try:
+            await redis.zrem(f"{CAVALI_RATE_REDIS_PREFIX}:procesos", lease)
+        except Exception as e:
+            logging.warning(f"CAVALI RATE: No se pudo liberar el cupo global {lease}; vencerá solo. Error: {e}")
+
+    def snapshot(self) -> dict:
+        return {
+            "rate_per_second": self.rate, "burst": self.burst,
+            "max_in_flight": self.max_in_flight, "global_max_in_flight": CAVALI_GLOBAL_MAX_IN_FLIGHT or None,
+            "redis": bool(CAVALI_RATE_REDIS_URL) and time.monotonic() >= self._redis_reintento_en,
+            "waits": self.esperas, "seconds_waited": round(self.segundos_esperados, 3), "throttled": self.throttled,
+        }
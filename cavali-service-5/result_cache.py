@@ -0,0 +1,123 @@
+"""
+Caché de resultados de Cavali por identidad de factura.
+
+La clave es (RUC, serie, número, sha256 del XML): si la factura se reenvía
+(reintento o reenvío de la operación) con el mismo XML, se devuelve el
+process_id y el mensaje guardados sin volver a bloquearla en Cavali. Un XML
+distinto para el mismo número es otra clave.
+
+Cada entrada vive según su resultCode (CAVALI_RESULT_CACHE_TTLS, JSON
+{resultCode: segundos}; "*" aplica a los códigos no listados). Los códigos sin
+TTL no se guardan, y los errores de lote o de red nunca se guardan.
+
+Se guarda en GCS (un objeto JSON por factura bajo CAVALI_RESULT_CACHE_PREFIX)
+para que lo compartan todas las instancias y sobreviva a reinicios, con un LRU
+en memoria delante.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from google.api_core.exceptions import NotFound
+
+from invoice_keys import InvoiceKey
+
+CacheKey = Tuple[str, str, str, str]
+
+CAVALI_RESULT_CACHE_ENABLED = os.getenv("CAVALI_RESULT_CACHE_ENABLED", "true").lower() == "true"
+CAVALI_RESULT_CACHE_BUCKET = os.getenv("CAVALI_RESULT_CACHE_BUCKET") or os.getenv("GCS_BUCKET_NAME")
+CAVALI_RESULT_CACHE_PREFIX = os.getenv("CAVALI_RESULT_CACHE_PREFIX", "cavali_results/")
+CAVALI_RESULT_CACHE_MAX_ENTRIES = int(os.getenv("CAVALI_RESULT_CACHE_MAX_ENTRIES", "5000"))
+CAVALI_RESULT_CACHE_TTLS: Dict[str, float] = json.loads(os.getenv("CAVALI_RESULT_CACHE_TTLS", '{"0": 2592000}'))
+
+# Resultados que genera este servicio cuando falla un lote: nunca se cachean
+ERROR_RESULT_CODES = {"BATCH_ERROR", "UNEXPECTED_BATCH_ERROR"}
+
+def cache_key(invoice_key: Optional[InvoiceKey], content: bytes) -> Optional[CacheKey]:
+    if invoice_key is None:
+        return None
+    return invoice_key + (hashlib.sha256(content).hexdigest(),)
+
+def ttl_for(result_code) -> float:
+    codigo = str(result_code or "").strip()
+    if not codigo or codigo in ERROR_RESULT_CODES:
+        return 0
+    return float(CAVALI_RESULT_CACHE_TTLS.get(codigo, CAVALI_RESULT_CACHE_TTLS.get("*", 0)))
+
+class CavaliResultCache:
+    def __init__(self, storage_client, max_entries: int):
+        self.storage_client = storage_client
+        self.max_entries = max_entries
+        self._entradas: "OrderedDict[CacheKey, dict]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return CAVALI_RESULT_CACHE_ENABLED
+
+    def _blob(self, key: CacheKey):
+        ruc, serie, numero, sha = key
+        return self.storage_client.bucket(CAVALI_RESULT_CACHE_BUCKET).blob(f"{CAVALI_RESULT_CACHE_PREFIX}{ruc}/{serie}-{numero}-{sha}.json")
+
+    def _recordar(self, key: CacheKey, entrada: dict):
+        self._entradas[key] = entrada
+        self._entradas.move_to_end(key)
+        while len(self._entradas) > self.max_entries:
+            self._entradas.popitem(last=False)
+
+    def _read_gcs(self, key: CacheKey) -> Optional[dict]:
+        try:
+            return json.loads(self._blob(key).download_as_bytes())
+        except NotFound:
+            return None
+        except Exception as e:
+            logging.warning(f"CAVALI CACHE: No se pudo leer {key[:3]} desde GCS: {e}")
+            return None
+
+    def _write_gcs(self, key: CacheKey, entrada: dict):
+        try:
+            self._blob(key).upload_from_string(json.dumps(entrada), content_type="application/json")
+        except Exception as e:
+            logging.warning(f"CAVALI CACHE: No se pudo guardar {key[:3]} en GCS: {e}")
+
+    async def _get(self, key: CacheKey) -> Optional[dict]:
+        entrada = self._entradas.get(key)
+        if entrada is None and CAVALI_RESULT_CACHE_BUCKET:
+            entrada = await asyncio.to_thread(self._read_gcs, key)
+        if entrada is None:
+            return None
+        if entrada.get("expires_at", 0) <= time.time():
+            self._entradas.pop(key, None)
+            return None
+        self._recordar(key, entrada)
+        return entrada["result"]
+
+    async def get_many(self, keys: Iterable[CacheKey]) -> Dict[CacheKey, dict]:
+        """Devuelve los resultados vigentes de las claves que estén en caché."""
+        if not self.enabled:
+            return {}
+        claves = list(dict.fromkeys(k for k in keys if k is not None))
+        resultados = await asyncio.gather(*(self._get(k) for k in claves))
+        return {k: r for k, r in zip(claves, resultados) if r is not None}
+
+    async def put_many(self, items: Iterable[Tuple[CacheKey, dict]]):
+        """Guarda los resultados cuyo resultCode tiene TTL; los demás se descartan."""
+        if not self.enabled:
+            return
+        escrituras = []
+        for key, result in items:
+            ttl = ttl_for(result.get("result_code"))
+            if key is None or ttl <= 0 or not result.get("process_id"):
+                continue
+            entrada = {"result": result, "expires_at": time.time() + ttl}
+            self._recordar(key, entrada)
+            if CAVALI_RESULT_CACHE_BUCKET:
+                escrituras.append(asyncio.to_thread(self._write_gcs, key, entrada))
+        await asyncio.gather(*escrituras)
+
+    def clear(self):
+        self._entradas.clear()
@@ -0,0 +1,180 @@
+"""
+Doble local de la API de Cavali (token, bloqueo y estado) para medir
+throughput y probar el backoff sin tocar Cavali.
+
+Cada lote bloqueado queda "procesándose" un tiempo proporcional a sus
+archivos; mientras tanto el estado devuelve filas sin resultCode, igual que
+Cavali. Se pueden configurar latencias, facturas que nunca terminan
+(resultados parciales), errores HTTP y un límite de requests/s que responde
+429 con Retry-After.
+
+Uso suelto (la configuración se lee de variables SIM_*):
+
+    SIM_PROCESSING_SECONDS=3 SIM_RATE_LIMIT_RPS=5 uvicorn simulator.app:app --port 8090
+
+y en cavali-service-5: CAVALI_TOKEN_URL=http://localhost:8090/token,
+CAVALI_BLOCK_URL=http://localhost:8090/block, CAVALI_STATUS_URL=http://localhost:8090/status.
+"""
+import asyncio
+import base64
+import os
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass, field, fields
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from invoice_keys import invoice_key
+
+@dataclass
+class SimulatorConfig:
+    """Tiempos en segundos; *_rate son probabilidades entre 0 y 1."""
+    block_latency: float = 0.3
+    block_latency_per_file: float = 0.005
+    status_latency: float = 0.05
+    processing_seconds: float = 2.0
+    processing_seconds_per_file: float = 0.05
+    jitter: float = 0.3
+    partial_rate: float = 0.0
+    reject_rate: float = 0.1
+    error_rate: float = 0.0
+    error_status: int = 503
+    rate_limit_rps: float = 0.0  # 0 = sin límite
+    rate_limit_burst: float = 5.0
+    max_open_processes: int = 0  # 0 = sin límite
+    token_ttl: int = 3600
+
+    @classmethod
+    def from_env(cls) -> "SimulatorConfig":
+        valores = {}
+        for campo in fields(cls):
+            crudo = os.getenv(f"SIM_{campo.name.upper()}")
+            if crudo is not None:
+                valores[campo.name] = type(campo.default)(crudo)
+        return cls(**valores)
+
+@dataclass
+class SimulatorStats:
+    tokens: int = 0
+    blocks: int = 0
+    status_calls: int = 0
+    invoices: int = 0
+    throttled: int = 0
+    errors: int = 0
+    by_endpoint: Dict[str, int] = field(default_factory=dict)
+
+class _Proceso:
+    def __init__(self, filas: List[dict], listo_en: float):
+        self.filas = filas
+        self.listo_en = listo_en
+
+class CavaliSimulator:
+    def __init__(self, config: SimulatorConfig):
+        self.config = config
+        self.stats = SimulatorStats()
+        self._procesos: Dict[str, _Proceso] = {}
+        self._tokens = config.rate_limit_burst
+        self._ts = time.monotonic()
+
+    def _variar(self, segundos: float) -> float:
+        return max(0.0, segundos * random.uniform(1 - self.config.jitter, 1 + self.config.jitter))
+
+    def _limitar(self, endpoint: str) -> Optional[JSONResponse]:
+        """Token bucket y errores simulados; devuelve la respuesta de rechazo o None si la llamada sigue."""
+        self.stats.by_endpoint[endpoint] = self.stats.by_endpoint.get(endpoint, 0) + 1
+        if self.config.rate_limit_rps > 0:
+            ahora = time.monotonic()
+            self._tokens = min(self.config.rate_limit_burst, self._tokens + (ahora - self._ts) * self.config.rate_limit_rps)
+            self._ts = ahora
+            if self._tokens < 1:
+                self.stats.throttled += 1
+                espera = (1 - self._tokens) / self.config.rate_limit_rps
+                return JSONResponse({"message": "Too Many Requests"}, status_code=429, headers={"Retry-After": f"{espera:.2f}"})
+            self._tokens -= 1
+        if random.random() < self.config.error_rate:
+            self.stats.errors += 1
+            return JSONResponse({"message": "Error simulado"}, status_code=self.config.error_status)
+        return None
+
+    def _abiertos(self) -> int:
+        ahora = time.monotonic()
+        return sum(1 for p in self._procesos.values() if p.listo_en > ahora)
+
+    def _fila(self, nombre: str, contenido: bytes) -> dict:
+        clave = invoice_key(nombre, contenido)
+        if clave is None:
+            return {"ruc": None, "serie": None, "numeration": None, "message": "XML no reconocido", "resultCode": "2"}
+        ruc, serie, numero = clave
+        if random.random() < self.config.reject_rate:
+            codigo, mensaje = "1", "Factura observada (simulada)"
+        else:
+            codigo, mensaje = "0", "Factura registrada (simulada)"
+        # Las que caen en partial_rate nunca reciben resultCode: el proceso queda incompleto
+        if random.random() < self.config.partial_rate:
+            codigo, mensaje = None, "En proceso"
+        return {"ruc": ruc, "serie": serie, "numeration": int(numero), "message": mensaje, "resultCode": codigo}
+
+    async def token(self) -> dict:
+        self.stats.tokens += 1
+        return {"access_token": f"sim-{uuid.uuid4().hex}", "token_type": "Bearer", "expires_in": self.config.token_ttl}
+
+    async def block(self, body: dict):
+        rechazo = self._limitar("block")
+        if rechazo is not None:
+            return rechazo
+        archivos = body.get("invoiceXMLDetail", {}).get("invoiceXML", [])
+        if self.config.max_open_processes and self._abiertos() >= self.config.max_open_processes:
+            self.stats.throttled += 1
+            return JSONResponse({"message": "Demasiados procesos abiertos"}, status_code=429, headers={"Retry-After": "1"})
+        await asyncio.sleep(self._variar(self.config.block_latency + self.config.block_latency_per_file * len(archivos)))
+
+        filas = [self._fila(a.get("name", ""), base64.b64decode(a.get("fileXml", ""))) for a in archivos]
+        id_proceso = uuid.uuid4().hex
+        procesamiento = self.config.processing_seconds + self.config.processing_seconds_per_file * len(archivos)
+        self._procesos[id_proceso] = _Proceso(filas, time.monotonic() + self._variar(procesamiento))
+        self.stats.blocks += 1
+        self.stats.invoices += len(archivos)
+        return {"response": {"idProceso": id_proceso}}
+
+    async def status(self, body: dict):
+        rechazo = self._limitar("status")
+        if rechazo is not None:
+            return rechazo
+        await asyncio.sleep(self._variar(self.config.status_latency))
+        self.stats.status_calls += 1
+        proceso = self._procesos.get(body.get("ProcessFilter", {}).get("idProcess"))
+        if proceso is None:
+            return JSONResponse({"message": "Proceso no encontrado"}, status_code=404)
+        if time.monotonic() < proceso.listo_en:
+            filas = [dict(f, resultCode=None, message="En proceso") for f in proceso.filas]
+        else:
+            filas = proceso.filas
+        return {"response": {"Process": {"ProcessInvoiceDetail": {"Invoice": filas}}}}
+
+def create_app(config: Optional[SimulatorConfig] = None) -> FastAPI:
+    simulador = CavaliSimulator(config or SimulatorConfig.from_env())
+    sim_app = FastAPI(title="Cavali API (simulada)")
+    sim_app.state.simulator = simulador
+
+    @sim_app.post("/token")
+    async def token():
+        return await simulador.token()
+
+    @sim_app.post("/block")
+    async def block(request: Request):
+        return await simulador.block(await request.json())
+
+    @sim_app.post("/status")
+    async def status(request: Request):
+        return await simulador.status(await request.json())
+
+    @sim_app.get("/stats")
+    async def stats():
+        return {"config": asdict(simulador.config), "stats": asdict(simulador.stats)}
+
+    return sim_app
+
+app = create_app()
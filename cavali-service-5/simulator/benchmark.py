@@ -0,0 +1,208 @@
+"""
+Benchmark de /validate-direct contra el simulador de Cavali (simulator/app.py).
+
+Corre la app real en proceso (ASGI, sin red) con GCS y Pub/Sub en memoria y
+el cliente HTTP del motor apuntando al simulador. Para cada combinación de
+archivos por lote y procesos en vuelo lanza --operations validaciones
+concurrentes y reporta facturas validadas por minuto:
+
+    cd cavali-service-5
+    python -m simulator.benchmark --invoices 600 --operations 4 \\
+        --batch-files 10,30,60 --in-flight 2,8 --sim-rate-limit 5
+
+Los lotes quedan fijos en --batch-files salvo con --adaptive, que parte de
+ese valor y deja actuar a AdaptiveBatchLimits. El sondeo usa los
+CAVALI_POLL_* del entorno, igual que en producción.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+SIM_BASE_URL = "http://cavali.simulator"
+RUC = "20100000001"
+ERRORES = ("BATCH_ERROR", "UNEXPECTED_BATCH_ERROR")
+
+def _parse_ints(valor: str) -> List[int]:
+    return [int(v) for v in valor.split(",") if v.strip()]
+
+# --- GCS / Pub/Sub en memoria ---
+
+class _FakeBlob:
+    def __init__(self, datos: Dict[str, bytes], name: str):
+        self._datos = datos
+        self.name = name
+        self.size = len(datos[name]) if name in datos else None
+
+    def download_as_bytes(self) -> bytes:
+        from google.api_core.exceptions import NotFound
+        if self.name not in self._datos:
+            raise NotFound(self.name)
+        return self._datos[self.name]
+
+    def upload_from_string(self, data, content_type=None):
+        self._datos[self.name] = data.encode("utf-8") if isinstance(data, str) else data
+
+class _FakeBucket:
+    def __init__(self, datos: Dict[str, bytes]):
+        self._datos = datos
+
+    def blob(self, name: str) -> _FakeBlob:
+        return _FakeBlob(self._datos, name)
+
+    def get_blob(self, name: str):
+        return _FakeBlob(self._datos, name) if name in self._datos else None
+
+class _FakeStorageClient:
+    def __init__(self, *args, **kwargs):
+        self.datos: Dict[str, bytes] = {}
+
+    def bucket(self, name: str) -> _FakeBucket:
+        return _FakeBucket(self.datos)
+
+class _FakePublisher:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def topic_path(self, project: str, topic: str) -> str:
+        return f"projects/{project}/topics/{topic}"
+
+def _configurar_entorno():
+    os.environ.update(
+        CAVALI_TOKEN_URL=f"{SIM_BASE_URL}/token", CAVALI_BLOCK_URL=f"{SIM_BASE_URL}/block",
+        CAVALI_STATUS_URL=f"{SIM_BASE_URL}/status", GCS_BUCKET_NAME="benchmark",
+        CAVALI_API_KEY="benchmark", CAVALI_RESULT_CACHE_ENABLED="false",
+    )
+    # Los clientes de Google se crean al importar los módulos: se reemplazan antes
+    from google.cloud import pubsub_v1, storage
+    storage.Client = _FakeStorageClient
+    pubsub_v1.PublisherClient = _FakePublisher
+
+def _xml(numero: int, relleno: int) -> bytes:
+    return (
+        '<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2" '
+        'xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">'
+        f'<cbc:ID>F001-{numero:08d}</cbc:ID><!-- {"x" * relleno} --></Invoice>'
+    ).encode("utf-8")
+
+class _LimitesFijos:
+    """Límites de lote que no se adaptan, para comparar tamaños de lote entre sí."""
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self.max_bytes = 1 << 40
+        self.generation = 0
+
+    def observe(self, *args, **kwargs):
+        pass
+
+    def snapshot(self) -> Dict[str, int]:
+        return {"max_files": self.max_files, "max_bytes": self.max_bytes}
+
+async def _corrida(client, engine, args, batch_files: int, in_flight: int, rutas: List[List[str]]) -> Tuple[float, Counter]:
+    from batching import AdaptiveBatchLimits
+    from rate_limit import CavaliRateLimiter
+
+    if args.adaptive:
+        engine.batch_limits = AdaptiveBatchLimits()
+        engine.batch_limits.max_files = batch_files
+    else:
+        engine.batch_limits = _LimitesFijos(batch_files)
+    engine.limiter = CavaliRateLimiter(args.rate, args.burst, in_flight)
+
+    async def operacion(indice: int, xml: List[str]) -> Dict[str, dict]:
+        respuesta = await client.post("/validate-direct", json={"tracking_id": f"BENCH-{indice:03d}", "gcs_paths": {"xml": xml}})
+        respuesta.raise_for_status()
+        return respuesta.json()["cavali_results"]
+
+    inicio = time.perf_counter()
+    resultados = await asyncio.gather(*(operacion(i, xml) for i, xml in enumerate(rutas)), return_exceptions=True)
+    duracion = time.perf_counter() - inicio
+
+    codigos = Counter()
+    for resultado in resultados:
+        if isinstance(resultado, Exception):
+            codigos["operacion_fallida"] += 1
+            continue
+        codigos.update(str(r.get("result_code")) for r in resultado.values())
+    return duracion, codigos
+
+async def main(args):
+    _configurar_entorno()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import httpx
+    import cavali_engine as engine_module
+    import main as app_module
+    from simulator.app import SimulatorConfig, create_app
+
+    logging.getLogger().setLevel(args.log_level)
+    engine = engine_module.cavali_engine
+
+    # XML del benchmark: un juego distinto por operación
+    datos = engine_module.storage_client.datos
+    por_operacion = max(1, args.invoices // args.operations)
+    rutas = []
+    for op in range(args.operations):
+        xml = []
+        for n in range(por_operacion):
+            numero = op * por_operacion + n + 1
+            nombre = f"{RUC}-01-F001-{numero:08d}.xml"
+            datos[f"xml/{nombre}"] = _xml(numero, args.xml_kb * 1024)
+            xml.append(f"gs://benchmark/xml/{nombre}")
+        rutas.append(xml)
+
+    config = SimulatorConfig(
+        processing_seconds=args.processing, processing_seconds_per_file=args.processing_per_file,
+        partial_rate=args.partial_rate, error_rate=args.error_rate,
+        rate_limit_rps=args.sim_rate_limit, max_open_processes=args.sim_max_open,
+    )
+    total = por_operacion * args.operations
+    print(f"BENCHMARK: {total} facturas en {args.operations} operaciones concurrentes; "
+          f"simulador: procesamiento {config.processing_seconds}s + {config.processing_seconds_per_file}s/archivo, "
+          f"límite {config.rate_limit_rps or '-'} req/s, errores {config.error_rate:.0%}, parciales {config.partial_rate:.0%}")
+    print(f"\n{'lote':>6}{'en vuelo':>10}{'segundos':>10}{'fact/min':>10}{'validadas':>11}{'errores':>9}"
+          f"{'sin código':>12}{'bloqueos':>10}{'estados':>9}{'429':>6}{'esperas':>9}")
+
+    transport = httpx.ASGITransport(app=app_module.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://cavali.benchmark", timeout=None) as client:
+        for batch_files in args.batch_files:
+            for in_flight in args.in_flight:
+                sim_app = create_app(config)
+                simulador = sim_app.state.simulator
+                await engine.close()
+                engine._http = httpx.AsyncClient(transport=httpx.ASGITransport(app=sim_app), timeout=None)
+
+                duracion, codigos = await _corrida(client, engine, args, batch_files, in_flight, rutas)
+                validadas = sum(n for codigo, n in codigos.items() if codigo not in ERRORES + ("None", "operacion_fallida"))
+                errores = sum(codigos[c] for c in ERRORES) + codigos["operacion_fallida"]
+                stats = simulador.stats
+                print(f"{batch_files:>6}{in_flight:>10}{duracion:>10.1f}{validadas / duracion * 60:>10.0f}{validadas:>11}"
+                      f"{errores:>9}{codigos['None']:>12}{stats.blocks:>10}{stats.status_calls:>9}"
+                      f"{stats.throttled:>6}{engine.limiter.esperas:>9}")
+    await engine.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Facturas validadas por minuto de /validate-direct contra el simulador de Cavali")
+    parser.add_argument("--invoices", type=int, default=300, help="Total de facturas, repartidas entre las operaciones")
+    parser.add_argument("--operations", type=int, default=3, help="Validaciones /validate-direct concurrentes")
+    parser.add_argument("--batch-files", type=_parse_ints, default=[10, 30, 60], help="Archivos por lote a probar, p.ej. 10,30,60")
+    parser.add_argument("--in-flight", type=_parse_ints, default=[2, 8], help="Procesos abiertos por instancia a probar, p.ej. 2,8")
+    parser.add_argument("--adaptive", action="store_true", help="Deja que los límites de lote se adapten durante la corrida")
+    parser.add_argument("--rate", type=float, default=20.0, help="Requests/s del limitador del servicio")
+    parser.add_argument("--burst", type=float, default=10.0)
+    parser.add_argument("--xml-kb", type=int, default=8, help="Tamaño aproximado de cada XML")
+    parser.add_argument("--processing", type=float, default=2.0, help="Segundos base de procesamiento de un lote en el simulador")
+    parser.add_argument("--processing-per-file", type=float, default=0.05)
+    parser.add_argument("--partial-rate", type=float, default=0.0, help="Fracción de facturas que nunca terminan")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de error HTTP por llamada")
+    parser.add_argument("--sim-rate-limit", type=float, default=0.0, help="Requests/s que acepta el simulador (0 = sin límite)")
+    parser.add_argument("--sim-max-open", type=int, default=0, help="Procesos abiertos que acepta el simulador (0 = sin límite)")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(main(_parse_args()))
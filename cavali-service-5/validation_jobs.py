@@ -0,0 +1,152 @@
+"""
+Validaciones como trabajos asíncronos: POST /validate-jobs crea el trabajo y
+responde al instante con su id; la validación corre en segundo plano en esta
+instancia (requiere CPU asignada fuera de los requests en Cloud Run) y
+GET /validate-jobs/{id} devuelve el avance y los resultados parciales.
+
+Al terminar, si el trabajo trae callback_url, se le envía el estado final por
+POST (con reintentos y la cabecera X-Callback-Token si CAVALI_CALLBACK_TOKEN
+está configurado). Solo se aceptan callbacks a hosts de
+CAVALI_CALLBACK_ALLOWED_HOSTS (separados por comas); sin esa lista no se
+envía ningún callback. El estado se guarda en GCS al crear el trabajo
+("running") y al terminar, para que cualquier instancia pueda responder el
+GET aunque el trabajo corra o haya corrido en otra.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import httpx
+from google.api_core.exceptions import NotFound
+
+import tracing
+from cavali_engine import cavali_engine, storage_client
+
+CAVALI_JOBS_BUCKET = os.getenv("CAVALI_JOBS_BUCKET") or os.getenv("GCS_BUCKET_NAME")
+CAVALI_JOBS_PREFIX = os.getenv("CAVALI_JOBS_PREFIX", "cavali_jobs/")
+CAVALI_JOB_TTL_SECONDS = float(os.getenv("CAVALI_JOB_TTL_SECONDS", "3600"))
+CAVALI_CALLBACK_TOKEN = os.getenv("CAVALI_CALLBACK_TOKEN")
+CAVALI_CALLBACK_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv("CAVALI_CALLBACK_ALLOWED_HOSTS", "").split(",") if h.strip()}
+CALLBACK_ATTEMPTS = 4
+CALLBACK_TIMEOUT_SECONDS = 15
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+def callback_allowed(callback_url: str) -> bool:
+    """El callback solo puede ir por http(s) a un host de CAVALI_CALLBACK_ALLOWED_HOSTS."""
+    try:
+        url = urlparse(callback_url)
+    except ValueError:
+        return False
+    return url.scheme in ("http", "https") and (url.hostname or "").lower() in CAVALI_CALLBACK_ALLOWED_HOSTS
+
+class ValidationJob:
+    def __init__(self, tracking_id: str, xml_paths: List[str], callback_url: Optional[str]):
+        self.id = uuid.uuid4().hex
+        self.tracking_id = tracking_id
+        self.xml_paths = xml_paths
+        self.callback_url = callback_url
+        self.status = PENDING
+        self.results: Dict[str, dict] = {}
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> dict:
+        return {
+            "job_id": self.id, "tracking_id": self.tracking_id, "status": self.status,
+            "total": len(self.xml_paths), "completed": len(self.results),
+            "cavali_results": dict(self.results), "error": self.error,
+            "created_at": self.created_at, "finished_at": self.finished_at,
+        }
+
+class ValidationJobRegistry:
+    def __init__(self):
+        self._jobs: Dict[str, ValidationJob] = {}
+
+    def _purge(self):
+        limite = time.time() - CAVALI_JOB_TTL_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < limite]:
+            del self._jobs[job_id]
+
+    async def submit(self, tracking_id: str, xml_paths: List[str], callback_url: Optional[str]) -> ValidationJob:
+        self._purge()
+        job = ValidationJob(tracking_id, xml_paths, callback_url)
+        job.status = RUNNING
+        self._jobs[job.id] = job
+        # Marca en GCS antes de responder: un GET que caiga en otra instancia ya encuentra el trabajo
+        if CAVALI_JOBS_BUCKET:
+            await asyncio.to_thread(self._write_gcs, job.snapshot())
+        job.task = asyncio.ensure_future(self._run(job))
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.snapshot()
+        if not CAVALI_JOBS_BUCKET:
+            return None
+        return await asyncio.to_thread(self._read_gcs, job_id)
+
+    async def _run(self, job: ValidationJob):
+        try:
+            job.results = await cavali_engine.validate(job.tracking_id, job.xml_paths, "CAVALI JOB", job.results.update)
+            job.status = DONE
+            logging.info(f"CAVALI JOB: {job.tracking_id} ({job.id}) validado.")
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e)
+            logging.error(f"CAVALI JOB: Error en {job.tracking_id} ({job.id}): {e}")
+        job.finished_at = time.time()
+        snapshot = job.snapshot()
+        if CAVALI_JOBS_BUCKET:
+            await asyncio.to_thread(self._write_gcs, snapshot)
+        if job.callback_url:
+            await self._notify(job.callback_url, snapshot)
+        job.task = None
+
+    async def _notify(self, callback_url: str, snapshot: dict):
+        if not callback_allowed(callback_url):
+            logging.error(f"CAVALI JOB: Callback de {snapshot['job_id']} descartado; host no permitido en {callback_url}")
+            return
+        headers = {"X-Callback-Token": CAVALI_CALLBACK_TOKEN} if CAVALI_CALLBACK_TOKEN else {}
+        for intento in range(1, CALLBACK_ATTEMPTS + 1):
+            try:
+                with tracing.span("cavali.job.callback", "client", intento=intento):
+                    response = await cavali_engine.http.post(callback_url, json=snapshot, headers=tracing.inject(headers), timeout=CALLBACK_TIMEOUT_SECONDS)
+                response.raise_for_status()
+                return
+            except httpx.HTTPError as e:
+                logging.warning(f"CAVALI JOB: Callback de {snapshot['job_id']} falló (intento {intento}/{CALLBACK_ATTEMPTS}): {e}")
+                if intento < CALLBACK_ATTEMPTS:
+                    await asyncio.sleep(2 ** intento)
+        logging.error(f"CAVALI JOB: Se agotaron los intentos de callback para {snapshot['job_id']}; el orquestador deberá consultar el estado.")
+
+    def _blob(self, job_id: str):
+        return storage_client.bucket(CAVALI_JOBS_BUCKET).blob(f"{CAVALI_JOBS_PREFIX}{job_id}.json")
+
+    def _write_gcs(self, snapshot: dict):
+        try:
+            self._blob(snapshot["job_id"]).upload_from_string(json.dumps(snapshot), content_type="application/json")
+        except Exception as e:
+            logging.error(f"CAVALI JOB: No se pudo guardar {snapshot['job_id']} en GCS: {e}")
+
+    def _read_gcs(self, job_id: str) -> Optional[dict]:
+        try:
+            return json.loads(self._blob(job_id).download_as_bytes())
+        except NotFound:
+            return None
+
+    async def close(self):
+        for job in list(self._jobs.values()):
+            if job.task is not None:
+                job.task.cancel()
+
+# Singleton instance
+validation_jobs = ValidationJobRegistry()
@@ -10,8 +10,10 @@ from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
 from typing import Optional
+import tracing
 
 app = FastAPI(title="Drive Service (Optimizado)")
+tracing.instrument_app(app)
 
 # --- Configuración ---
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "operaciones-peru")
@@ -36,13 +38,15 @@ def upload_files_in_background(all_gcs_paths: list, folder_id: str, tracking_id:
         try:
             bucket_name, blob_name = gcs_path.replace("gs://", "").split("/", 1)
             blob = storage_client.bucket(bucket_name).blob(blob_name)
-            file_bytes = blob.download_as_bytes()
+            with tracing.span("gcs.download", path=gcs_path):
+                file_bytes = blob.download_as_bytes()
             mime_type, _ = mimetypes.guess_type(os.path.basename(gcs_path))
             mime_type = mime_type or 'application/octet-stream'
 
             file_metadata = {'name': os.path.basename(gcs_path), 'parents': [folder_id]}
             media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type, resumable=True)
-            drive_service.files().create(body=file_metadata, media_body=media, fields='id', supportsAllDrives=True).execute()
+            with tracing.span("drive.upload", "client", archivo=file_metadata['name']):
+                drive_service.files().create(body=file_metadata, media_body=media, fields='id', supportsAllDrives=True).execute()
         except Exception as e:
             print(f"WARN-BG: Falló la subida de '{gcs_path}'. Error: {e}")
     print(f"DRIVE-BG: Subida en segundo plano para {tracking_id} completada.")
@@ -59,20 +63,22 @@ async def pubsub_handler(request: Request, background_tasks: BackgroundTasks):
         payload = json.loads(message_data)
         tracking_id = payload["tracking_id"]
 
-        # Crear carpeta y publicar el link
-        operation_id = payload.get("operation_id", tracking_id)
-        folder_name = f"Operacion_{operation_id}"
-        folder_metadata = {'name': folder_name, 'mimeType': 'application/vnd.google-apps.folder', 'parents': [DRIVE_PARENT_FOLDER_ID]}
-        folder = drive_service.files().create(body=folder_metadata, fields='id, webViewLink', supportsAllDrives=True).execute()
-        folder_id = folder.get('id')
-        folder_url = folder.get('webViewLink')
+        with tracing.continue_from_pubsub("drive.pubsub", body["message"], tracking_id):
+            # Crear carpeta y publicar el link
+            operation_id = payload.get("operation_id", tracking_id)
+            folder_name = f"Operacion_{operation_id}"
+            folder_metadata = {'name': folder_name, 'mimeType': 'application/vnd.google-apps.folder', 'parents': [DRIVE_PARENT_FOLDER_ID]}
+            with tracing.span("drive.create_folder", "client"):
+                folder = drive_service.files().create(body=folder_metadata, fields='id, webViewLink', supportsAllDrives=True).execute()
+            folder_id = folder.get('id')
+            folder_url = folder.get('webViewLink')
 
-        print(f"DRIVE: Carpeta '{folder_name}' creada. Publicando link.")
-        
-        # Publicar el mensaje con el link inmediatamente
-        payload["drive_folder_url"] = folder_url
-        next_message_data = json.dumps(payload).encode("utf-8")
-        publisher.publish(TOPIC_FILES_ARCHIVED, next_message_data).result()
+            print(f"DRIVE: Carpeta '{folder_name}' creada. Publicando link.")
+            
+            # Publicar el mensaje con el link inmediatamente
+            payload["drive_folder_url"] = folder_url
+            next_message_data = json.dumps(payload).encode("utf-8")
+            publisher.publish(TOPIC_FILES_ARCHIVED, next_message_data, **tracing.pubsub_attributes()).result()
         
         # Delegar la subida de archivos a un segundo plano
         gcs_paths = payload.get("gcs_paths", {})
@@ -91,6 +97,7 @@ async def archive_direct(request: Request, background_tasks: BackgroundTasks):
     try:
         operation_data = await request.json()
         tracking_id = operation_data["tracking_id"]
+        tracing.set_tracking_id(tracking_id)
         
         print(f"DRIVE DIRECTO: Procesando {tracking_id}")
         
@@ -105,11 +112,12 @@ async def archive_direct(request: Request, background_tasks: BackgroundTasks):
             'mimeType': 'application/vnd.google-apps.folder', 
             'parents': [DRIVE_PARENT_FOLDER_ID]
         }
-        folder = drive_service.files().create(
-            body=folder_metadata, 
-            fields='id, webViewLink', 
-            supportsAllDrives=True
-        ).execute()
+        with tracing.span("drive.create_folder", "client"):
+            folder = drive_service.files().create(
+                body=folder_metadata, 
+                fields='id, webViewLink', 
+                supportsAllDrives=True
+            ).execute()
         
         folder_id = folder.get('id')
         folder_url = folder.get('webViewLink')
@@ -0,0 +1,278 @@
+"""
+Trazas distribuidas mínimas, sin dependencias externas.
+
+Propaga un `traceparent` (W3C Trace Context) y el `tracking_id` del envío por
+cabeceras HTTP y atributos de Pub/Sub, y registra spans que se exportan:
+- TRACE_EXPORTER=file: una línea JSON por span en TRACE_FILE;
+- TRACE_EXPORTER=otlp: lotes OTLP/HTTP en JSON hacia OTLP_ENDPOINT;
+- TRACE_EXPORTER=none (por defecto): solo se propaga el contexto.
+
+La fuente es shared/tracing.py y cada servicio tiene una copia idéntica (cada
+imagen solo ve su carpeta): se edita allí y se copia con
+`python sync_shared.py --write`; `python sync_shared.py` falla si alguna copia difiere.
+Compatible con Python 3.9.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+SERVICE_NAME = os.getenv("SERVICE_NAME") or os.getenv("K_SERVICE") or "unknown"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_BATCH_SIZE = 256
+TRACE_FLUSH_SECONDS = 2.0
+
+TRACEPARENT = "traceparent"
+TRACKING_HEADER = "X-Tracking-Id"
+TRACKING_ATTRIBUTE = "tracking_id"
+
+_KINDS = {"internal": 1, "server": 2, "client": 3, "producer": 4, "consumer": 5}
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "tracking_id", "name", "kind", "attributes", "start_ns")
+
+    def __init__(self, trace_id: str, span_id: Optional[str], parent_id: Optional[str], tracking_id: Optional[str],
+                 name: str = "", kind: str = "internal", attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.tracking_id = tracking_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+_actual: contextvars.ContextVar = contextvars.ContextVar("trace_span", default=None)
+
+def _nuevo_trace_id() -> str:
+    return secrets.token_hex(16)
+
+def _nuevo_span_id() -> str:
+    return secrets.token_hex(8)
+
+def parse_traceparent(value: Optional[str]):
+    """Devuelve (trace_id, parent_span_id) de una cabecera traceparent válida, o None."""
+    if not value:
+        return None
+    partes = value.strip().split("-")
+    if len(partes) != 4 or len(partes[1]) != 32 or len(partes[2]) != 16:
+        return None
+    if set(partes[1]) == {"0"} or set(partes[2]) == {"0"}:
+        return None
+    return partes[1], partes[2]
+
+def current() -> Optional[Span]:
+    return _actual.get()
+
+def current_tracking_id() -> Optional[str]:
+    span_actual = current()
+    return span_actual.tracking_id if span_actual else None
+
+def set_tracking_id(tracking_id: str) -> None:
+    """Asocia el tracking_id al span actual; los spans hijos lo heredan."""
+    span_actual = current()
+    if span_actual is not None:
+        span_actual.tracking_id = tracking_id
+        span_actual.attributes[TRACKING_ATTRIBUTE] = tracking_id
+
+def traceparent() -> Optional[str]:
+    span_actual = current()
+    if span_actual is None or span_actual.span_id is None:
+        return None
+    return f"00-{span_actual.trace_id}-{span_actual.span_id}-01"
+
+def inject(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Copia de `headers` con traceparent y X-Tracking-Id del contexto actual."""
+    resultado = dict(headers or {})
+    valor = traceparent()
+    if valor:
+        resultado[TRACEPARENT] = valor
+    if current_tracking_id():
+        resultado[TRACKING_HEADER] = current_tracking_id()
+    return resultado
+
+def pubsub_attributes() -> Dict[str, str]:
+    """Atributos para publisher.publish(topic, data, **attrs)."""
+    atributos = {}
+    valor = traceparent()
+    if valor:
+        atributos[TRACEPARENT] = valor
+    if current_tracking_id():
+        atributos[TRACKING_ATTRIBUTE] = current_tracking_id()
+    return atributos
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes: Any) -> Iterator[Span]:
+    """Registra un span hijo del span actual (o raíz de una traza nueva)."""
+    padre = current()
+    tracking_id = attributes.get(TRACKING_ATTRIBUTE) or (padre.tracking_id if padre else None)
+    nuevo = Span(
+        trace_id=padre.trace_id if padre else _nuevo_trace_id(),
+        span_id=_nuevo_span_id(),
+        parent_id=padre.span_id if padre else None,
+        tracking_id=tracking_id,
+        name=name, kind=kind, attributes=attributes,
+    )
+    token = _actual.set(nuevo)
+    error = None
+    try:
+        yield nuevo
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _actual.reset(token)
+        _exporter.export(nuevo, time.time_ns(), error)
+
+@contextmanager
+def continue_trace(name: str, traceparent_value: Optional[str] = None, tracking_id: Optional[str] = None,
+                   kind: str = "server", **attributes: Any) -> Iterator[Span]:
+    """Abre el span raíz de una unidad de trabajo continuando la traza remota, si la hay."""
+    remoto = parse_traceparent(traceparent_value)
+    base = Span(remoto[0], remoto[1], None, tracking_id) if remoto else Span(_nuevo_trace_id(), None, None, tracking_id)
+    token = _actual.set(base)
+    try:
+        if tracking_id:
+            attributes.setdefault(TRACKING_ATTRIBUTE, tracking_id)
+        with span(name, kind, **attributes) as nuevo:
+            yield nuevo
+    finally:
+        _actual.reset(token)
+
+def continue_from_pubsub(name: str, message: Dict[str, Any], tracking_id: Optional[str] = None):
+    """continue_trace() a partir de los atributos de un mensaje push de Pub/Sub."""
+    atributos = message.get("attributes") or {}
+    return continue_trace(
+        name, atributos.get(TRACEPARENT), tracking_id or atributos.get(TRACKING_ATTRIBUTE), kind="consumer"
+    )
+
+class TracingMiddleware:
+    """Middleware ASGI: un span 'server' por request, continuando el traceparent entrante."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        with continue_trace(
+            f"{scope['method']} {scope['path']}", headers.get(TRACEPARENT), headers.get(TRACKING_HEADER.lower()),
+        ) as span_servidor:
+            async def send_con_estado(message):
+                if message["type"] == "http.response.start":
+                    span_servidor.attributes["http.status_code"] = message["status"]
+                await send(message)
+            await self.app(scope, receive, send_con_estado)
+
+def instrument_app(app) -> None:
+    app.add_middleware(TracingMiddleware)
+
+class _Exporter:
+    """Exporta spans en lotes desde un hilo de fondo; la ruta caliente solo encola."""
+
+    def __init__(self):
+        self._cola: "queue.Queue" = queue.Queue(maxsize=10000)
+        self._hilo: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def export(self, span_terminado: Span, end_ns: int, error: Optional[str]) -> None:
+        if TRACE_EXPORTER not in ("file", "otlp"):
+            return
+        if self._hilo is None:
+            with self._lock:
+                if self._hilo is None:
+                    self._hilo = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._hilo.start()
+                    atexit.register(self.flush)
+        try:
+            self._cola.put_nowait((span_terminado, end_ns, error))
+        except queue.Full:
+            pass  # nunca bloquear el request por las trazas
+
+    def _run(self) -> None:
+        while True:
+            lote = [self._cola.get()]
+            limite = time.monotonic() + TRACE_FLUSH_SECONDS
+            while len(lote) < TRACE_BATCH_SIZE and time.monotonic() < limite:
+                try:
+                    lote.append(self._cola.get(timeout=max(0.0, limite - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write(lote)
+
+    def flush(self) -> None:
+        lote = []
+        while True:
+            try:
+                lote.append(self._cola.get_nowait())
+            except queue.Empty:
+                break
+        if lote:
+            self._write(lote)
+
+    def _write(self, lote: List) -> None:
+        try:
+            if TRACE_EXPORTER == "file":
+                with self._lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+                    for s, end_ns, error in lote:
+                        f.write(json.dumps(_como_dict(s, end_ns, error), default=str) + "\n")
+            else:
+                cuerpo = json.dumps(_como_otlp(lote), default=str).encode("utf-8")
+                peticion = urllib.request.Request(OTLP_ENDPOINT, data=cuerpo, headers={"Content-Type": "application/json"})
+                urllib.request.urlopen(peticion, timeout=5).close()
+        except Exception as e:
+            logging.warning(f"TRACING: No se pudieron exportar {len(lote)} spans: {e}")
+
+def _como_dict(s: Span, end_ns: int, error: Optional[str]) -> Dict[str, Any]:
+    return {
+        "service": SERVICE_NAME, "trace_id": s.trace_id, "span_id": s.span_id, "parent_id": s.parent_id,
+        "tracking_id": s.tracking_id, "name": s.name, "kind": s.kind,
+        "start_ns": s.start_ns, "duration_ms": round((end_ns - s.start_ns) / 1e6, 3),
+        "attributes": s.attributes, "error": error,
+    }
+
+def _valor_otlp(valor: Any) -> Dict[str, Any]:
+    if isinstance(valor, bool):
+        return {"boolValue": valor}
+    if isinstance(valor, int):
+        return {"intValue": str(valor)}
+    if isinstance(valor, float):
+        return {"doubleValue": valor}
+    return {"stringValue": str(valor)}
+
+def _como_otlp(lote: List) -> Dict[str, Any]:
+    spans = []
+    for s, end_ns, error in lote:
+        atributos = dict(s.attributes)
+        if s.tracking_id:
+            atributos[TRACKING_ATTRIBUTE] = s.tracking_id
+        registro = {
+            "traceId": s.trace_id, "spanId": s.span_id, "name": s.name, "kind": _KINDS.get(s.kind, 1),
+            "startTimeUnixNano": str(s.start_ns), "endTimeUnixNano": str(end_ns),
+            "attributes": [{"key": k, "value": _valor_otlp(v)} for k, v in atributos.items()],
+            "status": {"code": 2, "message": error} if error else {"code": 1},
+        }
+        if s.parent_id:
+            registro["parentSpanId"] = s.parent_id
+        spans.append(registro)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+    }]}
+
+_exporter = _Exporter()
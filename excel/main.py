@@ -4,6 +4,7 @@ import os
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from typing import Optional
+import tracing
 
 class Contacto(BaseModel):
     ruc: str
@@ -11,6 +12,7 @@ class Contacto(BaseModel):
     nombre_deudor: Optional[str] = None
 
 app = FastAPI(title="Microservicio de Google Sheets (Versión Robusta)")
+tracing.instrument_app(app)
 
 try:
     credentials_file = os.getenv("GOOGLE_SHEETS_CREDENTIALS", "operaciones-peru-ef02622bfc3d.json")
@@ -1,9 +1,9 @@
 import os, base64, mimetypes, io, json, traceback, requests
-from fastapi import FastAPI, status, HTTPException
+from fastapi import FastAPI, status, HTTPException, Header
 from email.message import EmailMessage
 from dotenv import load_dotenv
 from collections import defaultdict
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from datetime import datetime
 from google.cloud import storage
 from google.oauth2.credentials import Credentials
@@ -13,6 +13,8 @@ from openpyxl.styles import PatternFill, Font, Border, Side, Alignment
 from openpyxl.utils import get_column_letter
 import PyPDF2
 import google.generativeai as genai
+import tracing
+from utils import claim_send, release_send
 
 load_dotenv()
 
@@ -70,6 +72,7 @@ RUC_GLORIA = [
 ]
 
 app = FastAPI(title="Gmail Service (HTTP Direct)")
+tracing.instrument_app(app)
 
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
@@ -81,7 +84,8 @@ def extract_pdf_data_local(pdf_paths: List[str], storage_client) -> Dict[str, Di
     for pdf_path in pdf_paths:
         try:
             bucket_name, blob_name = pdf_path.replace("gs://", "").split("/", 1)
-            pdf_bytes = storage_client.bucket(bucket_name).blob(blob_name).download_as_bytes()
+            with tracing.span("gcs.download", path=pdf_path):
+                pdf_bytes = storage_client.bucket(bucket_name).blob(blob_name).download_as_bytes()
             
             pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
             full_text = ""
@@ -156,7 +160,8 @@ def classify_pdfs_with_gemini(pdf_data: Dict, invoices_by_ruc: Dict) -> Dict[str
     """
 
     try:
-        response = genai.GenerativeModel('gemini-1.5-flash').generate_content(prompt)
+        with tracing.span("gemini.classify", "client"):
+            response = genai.GenerativeModel('gemini-1.5-flash').generate_content(prompt)
         print(f"DEBUG Gemini response text: {response.text}")
         
         # Limpiar respuesta de markdown si viene con ```json
@@ -361,7 +366,7 @@ def create_html_body(invoice_data_list: List[Dict], operation_id, custom_message
     return mensaje_html
 
 @app.post("/send-email", status_code=status.HTTP_200_OK)
-async def send_email_handler(payload: Dict[str, Any]):
+async def send_email_handler(payload: Dict[str, Any], idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
     operation_id = payload.get("operation_id")
     if not operation_id:
         raise HTTPException(status_code=400, detail="Falta 'operation_id' en el payload")
@@ -404,9 +409,9 @@ async def send_email_handler(payload: Dict[str, Any]):
 
                 for correo in correos_operacion:
                     update_payload = {"ruc": ruc_deudor, "correo": correo, "nombre_deudor": nombre_deudor}
-                    requests.post(f"{EXCEL_SERVICE_URL}/update-contact", json=update_payload, timeout=60).raise_for_status()
+                    requests.post(f"{EXCEL_SERVICE_URL}/update-contact", json=update_payload, headers=tracing.inject(), timeout=60).raise_for_status()
 
-                response = requests.get(f"{EXCEL_SERVICE_URL}/get-emails/{ruc_deudor}", timeout=60)
+                response = requests.get(f"{EXCEL_SERVICE_URL}/get-emails/{ruc_deudor}", headers=tracing.inject(), timeout=60)
                 if response.status_code == 200:
                     correos_finales_str = response.json().get("emails", "")
                 
@@ -432,7 +437,8 @@ async def send_email_handler(payload: Dict[str, Any]):
             for path in relevant_pdfs:
                 try:
                     bucket_name, blob_name = path.replace("gs://", "").split("/", 1)
-                    pdf_bytes = storage_client_user.bucket(bucket_name).blob(blob_name).download_as_bytes()
+                    with tracing.span("gcs.download", path=path):
+                        pdf_bytes = storage_client_user.bucket(bucket_name).blob(blob_name).download_as_bytes()
                     maintype, subtype = (mimetypes.guess_type(os.path.basename(path))[0] or "application/octet-stream").split('/')
                     message.add_attachment(pdf_bytes, maintype=maintype, subtype=subtype, filename=os.path.basename(path))
                     print(f"  ✓ Adjuntado: {os.path.basename(path)}")
@@ -444,8 +450,20 @@ async def send_email_handler(payload: Dict[str, Any]):
                 if filename and excel_bytes:
                     message.add_attachment(excel_bytes, maintype='application', subtype='vnd.openxmlformats-officedocument.spreadsheetml.sheet', filename=filename)
 
+            if idempotency_key and not claim_send(idempotency_key, ruc_deudor):
+                log_msg = f"Correo para deudor {ruc_deudor} (Op: {operation_id}) ya enviado con Idempotency-Key {idempotency_key}; se omite."
+                print(f"GMAIL: {log_msg}")
+                sent_emails_log.append(log_msg)
+                continue
+
             encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-            gmail_service.users().messages().send(userId=SENDER_USER_ID, body={'raw': encoded_message}).execute()
+            try:
+                with tracing.span("gmail.send", "client", ruc_deudor=ruc_deudor):
+                    gmail_service.users().messages().send(userId=SENDER_USER_ID, body={'raw': encoded_message}).execute()
+            except Exception:
+                if idempotency_key:
+                    release_send(idempotency_key, ruc_deudor)
+                raise
             
             log_msg = f"Correo para deudor {ruc_deudor} (Op: {operation_id}) enviado a: {correos_finales_str}"
             print(f"GMAIL: {log_msg}")
@@ -1,3 +1,10 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
 from google.oauth2.credentials import Credentials
 
@@ -10,4 +17,57 @@ def download_blob_as_bytes(gs_path: str, creds: Credentials) -> bytes:
     client = storage.Client(credentials=creds)
     bucket = client.bucket(bucket_name)
     blob = bucket.blob(blob_path)
-    return blob.download_as_bytes()
\ No newline at end of file
+    return blob.download_as_bytes()
+
+# --- Idempotencia de envíos ---
+# El orquestador reintenta un envío si no recibió respuesta, aunque Gmail ya lo haya mandado.
+# Antes de enviar a cada deudor se crea una marca {Idempotency-Key}/{ruc} en GCS solo si no existe
+# (if_generation_match=0): un reintento con la misma clave encuentra la marca y no vuelve a enviar.
+GMAIL_IDEMPOTENCY_BUCKET = os.getenv("GMAIL_IDEMPOTENCY_BUCKET")
+GMAIL_IDEMPOTENCY_PREFIX = os.getenv("GMAIL_IDEMPOTENCY_PREFIX", "gmail_idempotency/")
+# Sin bucket las marcas viven en memoria: se descartan al vencer o, si hay demasiadas, las más viejas
+GMAIL_IDEMPOTENCY_LOCAL_TTL_SECONDS = float(os.getenv("GMAIL_IDEMPOTENCY_LOCAL_TTL_SECONDS", "86400"))
+GMAIL_IDEMPOTENCY_LOCAL_MAX_ENTRIES = int(os.getenv("GMAIL_IDEMPOTENCY_LOCAL_MAX_ENTRIES", "10000"))
+_marcas_locales: "OrderedDict[tuple, float]" = OrderedDict()  # (clave, ruc) -> instante de la marca, en orden de creación
+_marcas_lock = threading.Lock()
+_cliente_marcas = None
+
+def _blob_marca(idempotency_key: str, ruc: str):
+    global _cliente_marcas
+    if _cliente_marcas is None:
+        # Cuenta de servicio: las credenciales de usuario solo tienen lectura sobre GCS
+        _cliente_marcas = storage.Client()
+    return _cliente_marcas.bucket(GMAIL_IDEMPOTENCY_BUCKET).blob(f"{GMAIL_IDEMPOTENCY_PREFIX}{idempotency_key}/{ruc}")
+
+def claim_send(idempotency_key: str, ruc: str) -> bool:
+    """Reserva el envío a un deudor; devuelve False si esa clave ya lo envió (o lo está enviando)."""
+    if not GMAIL_IDEMPOTENCY_BUCKET:
+        # Sin bucket solo se evitan duplicados dentro de esta instancia
+        marca = (idempotency_key, ruc)
+        ahora = time.monotonic()
+        with _marcas_lock:
+            while _marcas_locales:
+                _, creada = next(iter(_marcas_locales.items()))
+                if ahora - creada < GMAIL_IDEMPOTENCY_LOCAL_TTL_SECONDS and len(_marcas_locales) < GMAIL_IDEMPOTENCY_LOCAL_MAX_ENTRIES:
+                    break
+                _marcas_locales.popitem(last=False)
+            if marca in _marcas_locales:
+                return False
+            _marcas_locales[marca] = ahora
+        return True
+    try:
+        _blob_marca(idempotency_key, ruc).upload_from_string(datetime.now(timezone.utc).isoformat(), if_generation_match=0)
+        return True
+    except PreconditionFailed:
+        return False
+
+def release_send(idempotency_key: str, ruc: str):
+    """Libera la reserva si el envío falló, para que un reintento sí lo haga."""
+    if not GMAIL_IDEMPOTENCY_BUCKET:
+        with _marcas_lock:
+            _marcas_locales.pop((idempotency_key, ruc), None)
+        return
+    try:
+        _blob_marca(idempotency_key, ruc).delete()
+    except NotFound:
+        pass
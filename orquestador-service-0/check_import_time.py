@@ -0,0 +1,64 @@
+"""
+Verifica el presupuesto de arranque del orquestador usando `python -X importtime`.
+
+Falla (exit 1) si importar `main` supera IMPORT_TIME_BUDGET_MS o si al importar
+se cargan SDKs que deben inicializarse de forma perezosa (ver core/clients.py).
+
+    python check_import_time.py
+"""
+import os
+import re
+import subprocess
+import sys
+
+IMPORT_TIME_BUDGET_MS = int(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+# Módulos que no deben importarse al cargar main (se cargan en el primer uso)
+MODULOS_PEREZOSOS = (
+    "google.cloud.storage",
+    "google.cloud.pubsub_v1",
+    "google.cloud.sql.connector",
+    "firebase_admin",
+    "asyncpg",
+    "pg8000",
+)
+
+LINEA_IMPORTTIME = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def medir_import(modulo: str = "main"):
+    """Importa `modulo` en un proceso limpio y devuelve (ms acumulados, módulos importados)."""
+    resultado = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {modulo}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True,
+    )
+    if resultado.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {modulo}:\n{resultado.stderr[-2000:]}")
+
+    acumulado_us = None
+    importados = set()
+    for linea in resultado.stderr.splitlines():
+        match = LINEA_IMPORTTIME.match(linea)
+        if not match:
+            continue
+        importados.add(match.group(4))
+        if match.group(4) == modulo and len(match.group(3)) <= 1:
+            acumulado_us = int(match.group(2))
+    return (acumulado_us or 0) / 1000, importados
+
+def main() -> int:
+    total_ms, importados = medir_import()
+    cargados = sorted(m for m in importados if m.startswith(MODULOS_PEREZOSOS))
+
+    print(f"IMPORT: main importado en {total_ms:.0f} ms (presupuesto {IMPORT_TIME_BUDGET_MS} ms)")
+    errores = []
+    if total_ms > IMPORT_TIME_BUDGET_MS:
+        errores.append(f"se excedió el presupuesto por {total_ms - IMPORT_TIME_BUDGET_MS:.0f} ms")
+    if cargados:
+        errores.append(f"módulos que deberían cargarse en el primer uso: {', '.join(cargados[:10])}")
+
+    for error in errores:
+        print(f"IMPORT: ERROR - {error}")
+    return 1 if errores else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
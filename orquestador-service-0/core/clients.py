@@ -0,0 +1,34 @@
+from core.config import config
+from core.lazy import Lazy
+
+# Los SDK de Google se importan dentro de cada factory: solo se pagan en el primer uso.
+
+def _create_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+def _create_publisher():
+    from google.cloud import pubsub_v1
+    return pubsub_v1.PublisherClient()
+
+def _init_firebase():
+    import firebase_admin
+    from firebase_admin import credentials
+    try:
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.ApplicationDefault())
+        return firebase_admin.get_app()
+    except Exception as e:
+        print(f"ADVERTENCIA: Firebase SDK no inicializado: {e}")
+        return None
+
+storage_client = Lazy(_create_storage_client)
+bucket = Lazy(lambda: storage_client.get().bucket(config.BUCKET_NAME))
+publisher = Lazy(_create_publisher)
+firebase_app = Lazy(_init_firebase)
+
+def verify_id_token(token: str) -> dict:
+    """Verifica un ID token de Firebase, inicializando el SDK en la primera llamada."""
+    from firebase_admin import auth
+    firebase_app.get()
+    return auth.verify_id_token(token)
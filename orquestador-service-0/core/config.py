@@ -14,6 +14,14 @@ class Config:
     GMAIL_SERVICE_URL = os.getenv("GMAIL_SERVICE_URL")
     PARSER_SERVICE_URL = os.getenv("PARSER_SERVICE_URL")
     CAVALI_SERVICE_URL = os.getenv("CAVALI_SERVICE_URL")
+
+    # Validación en Cavali como trabajo asíncrono (POST /validate-jobs + callback)
+    CAVALI_JOBS_ENABLED = os.getenv("CAVALI_JOBS_ENABLED", "true").lower() == "true"
+    CAVALI_JOB_POLL_SECONDS = float(os.getenv("CAVALI_JOB_POLL_SECONDS", "15"))
+    CAVALI_JOB_TIMEOUT_SECONDS = float(os.getenv("CAVALI_JOB_TIMEOUT_SECONDS", "600"))
+    CAVALI_CALLBACK_TOKEN = os.getenv("CAVALI_CALLBACK_TOKEN")
+    # URL pública del orquestador con la que Cavali arma el callback; sin ella solo se sondea
+    ORQUESTADOR_PUBLIC_URL = os.getenv("ORQUESTADOR_PUBLIC_URL")
     
     # Database Configuration
     DB_USER = os.getenv("DB_USER")
@@ -21,4 +29,35 @@ class Config:
     DB_NAME = os.getenv("DB_NAME")
     DB_INSTANCE_CONNECTION_NAME = os.getenv("DB_INSTANCE_CONNECTION_NAME")
 
+    # Idempotency-Key en /submit-operation
+    IDEMPOTENCY_ATTACH_TIMEOUT_SECONDS = float(os.getenv("IDEMPOTENCY_ATTACH_TIMEOUT_SECONDS", "25"))
+    IDEMPOTENCY_STALE_SECONDS = int(os.getenv("IDEMPOTENCY_STALE_SECONDS", "1800"))
+
+    # Outbox de notificaciones (Trello, Gmail)
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+    OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+    OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "5"))
+    OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "900"))
+    OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "10"))
+    OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+
+    # Circuit breaker y timeouts adaptativos de MicroserviceClient
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+    CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+    ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "3"))
+    ADAPTIVE_TIMEOUT_MIN_SECONDS = float(os.getenv("ADAPTIVE_TIMEOUT_MIN_SECONDS", "10"))
+    ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.getenv("ADAPTIVE_TIMEOUT_MIN_SAMPLES", "20"))
+    ADAPTIVE_TIMEOUT_WINDOW = int(os.getenv("ADAPTIVE_TIMEOUT_WINDOW", "200"))
+    # Piso del timeout de parser/Cavali según el tamaño de la operación (segundos por XML)
+    PARSER_TIMEOUT_SECONDS_PER_XML = float(os.getenv("PARSER_TIMEOUT_SECONDS_PER_XML", "1"))
+    CAVALI_TIMEOUT_SECONDS_PER_XML = float(os.getenv("CAVALI_TIMEOUT_SECONDS_PER_XML", "2"))
+
+    # Caché de /api/analytics/portfolio
+    ANALYTICS_CACHE_TTL_SECONDS = float(os.getenv("ANALYTICS_CACHE_TTL_SECONDS", "300"))
+    ANALYTICS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYTICS_CACHE_MAX_ENTRIES", "256"))
+
+    # /api/search
+    SEARCH_STATEMENT_TIMEOUT_MS = int(os.getenv("SEARCH_STATEMENT_TIMEOUT_MS", "200"))
+
 config = Config()
\ No newline at end of file
@@ -1,10 +1,12 @@
 from fastapi import HTTPException, Header, Depends
 from sqlalchemy.orm import Session
-import firebase_admin
-from firebase_admin import auth, credentials
+import asyncio
+import database
+from core import clients
 from database import get_db
+from repository import AsyncOperationRepository, ThreadedOperationRepository
 
-# Firebase se inicializa en main.py
+# Firebase se inicializa de forma perezosa en core.clients
 
 async def get_current_user(authorization: str = Header(None)):
     """Dependency para autenticación Firebase"""
@@ -13,7 +15,7 @@ async def get_current_user(authorization: str = Header(None)):
     
     token = authorization.split(" ")[1]
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await asyncio.to_thread(clients.verify_id_token, token)
         return {
             "uid": decoded_token["uid"],
             "email": decoded_token["email"],
@@ -22,4 +24,19 @@ async def get_current_user(authorization: str = Header(None)):
     except Exception as e:
         raise HTTPException(status_code=401, detail="Token inválido")
 
-# get_db_dependency removed - use get_db directly
\ No newline at end of file
+# get_db_dependency removed - use get_db directly
+
+async def get_repository():
+    """
+    Dependency de repositorio con interfaz asíncrona: usa AsyncSession (asyncpg)
+    si DB_ASYNC=true y, si no, la Session síncrona ejecutada en hilos.
+    """
+    if database.DB_ASYNC:
+        async with database.AsyncSessionLocal() as db:
+            yield AsyncOperationRepository(db)
+    else:
+        db = database.SessionLocal()
+        try:
+            yield ThreadedOperationRepository(db)
+        finally:
+            db.close()
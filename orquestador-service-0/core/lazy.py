@@ -0,0 +1,34 @@
+import threading
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+class Lazy(Generic[T]):
+    """
+    Singleton perezoso y thread-safe: construye el valor con `factory` en el
+    primer `get()` y lo reutiliza en adelante. Evita pagar la inicialización de
+    clientes pesados (Cloud SQL, GCS, Pub/Sub, Firebase) al importar el módulo.
+    """
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._ready = False
+
+    def get(self) -> T:
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self._value = self._factory()
+                    self._ready = True
+        return self._value
+
+    def set(self, value: T) -> None:
+        """Reemplaza el valor (p.ej. para inyectar un doble en pruebas locales)."""
+        with self._lock:
+            self._value = value
+            self._ready = True
+
+    @property
+    def initialized(self) -> bool:
+        return self._ready
@@ -0,0 +1,109 @@
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from typing import Callable, List
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import tracing
+
+# Buckets en segundos: desde consultas de DB (ms) hasta Cavali (minutos)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "orquestador_stage_seconds", "Duración de cada etapa del procesamiento de una operación",
+    ["stage"], buckets=BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "orquestador_stage_errors_total", "Etapas que terminaron con excepción", ["stage"],
+)
+MICROSERVICE_SECONDS = Histogram(
+    "orquestador_microservice_seconds", "Duración de las llamadas a otros microservicios",
+    ["service", "outcome"], buckets=BUCKETS,
+)
+CIRCUIT_STATE = Gauge(
+    "orquestador_circuit_state", "Estado del circuit breaker por microservicio (0 cerrado, 1 semiabierto, 2 abierto)",
+    ["service"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "orquestador_db_query_seconds", "Duración de las sentencias SQL, por verbo",
+    ["verb"], buckets=BUCKETS,
+)
+
+# Callbacks (stage, segundos) adicionales a Prometheus; los usa loadtest/ para percentiles exactos
+_stage_observers: List[Callable[[str, float], None]] = []
+
+def add_stage_observer(callback: Callable[[str, float], None]) -> None:
+    _stage_observers.append(callback)
+
+_VERBOS = {"SELECT", "INSERT", "UPDATE", "DELETE", "LOCK", "WITH", "BEGIN", "COMMIT", "ROLLBACK"}
+
+@contextmanager
+def track_stage(stage: str):
+    """Mide un bloque (síncrono o con awaits dentro) como una etapa del pipeline, con su span."""
+    inicio = time.perf_counter()
+    try:
+        with tracing.span(stage):
+            yield
+    except BaseException:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        duracion = time.perf_counter() - inicio
+        STAGE_SECONDS.labels(stage).observe(duracion)
+        for callback in _stage_observers:
+            callback(stage, duracion)
+
+def track_call(service: str):
+    """
+    Decorador para los métodos de MicroserviceClient. Esos métodos capturan sus
+    errores y devuelven {} o False, así que un resultado vacío cuenta como 'error'.
+    """
+    def decorador(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def envoltura_async(*args, **kwargs):
+                inicio = time.perf_counter()
+                with tracing.span(f"call {service}", "client"):
+                    resultado = await func(*args, **kwargs)
+                MICROSERVICE_SECONDS.labels(service, "ok" if resultado else "error").observe(time.perf_counter() - inicio)
+                return resultado
+            return envoltura_async
+
+        @functools.wraps(func)
+        def envoltura(*args, **kwargs):
+            inicio = time.perf_counter()
+            with tracing.span(f"call {service}", "client"):
+                resultado = func(*args, **kwargs)
+            MICROSERVICE_SECONDS.labels(service, "ok" if resultado else "error").observe(time.perf_counter() - inicio)
+            return resultado
+        return envoltura
+    return decorador
+
+# Los eventos se registran sobre la clase Engine: cubren el motor síncrono y el
+# sync_engine interno del motor asyncpg, sin importar cuándo se creen.
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_end(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get("query_start")
+    if not inicios:
+        return
+    partes = statement.lstrip()[:10].split(None, 1)
+    verbo = partes[0].upper() if partes else "OTHER"
+    DB_QUERY_SECONDS.labels(verbo if verbo in _VERBOS else "OTHER").observe(time.perf_counter() - inicios.pop())
+
+@event.listens_for(Engine, "handle_error")
+def _query_error(context):
+    # after_cursor_execute no se llama si la sentencia falla
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+def render_latest():
+    """Devuelve (cuerpo, content-type) en formato de texto de Prometheus."""
+    return generate_latest(), CONTENT_TYPE_LATEST
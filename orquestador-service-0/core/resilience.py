@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import requests
+
+from core.config import config
+from core.metrics import CIRCUIT_STATE
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_ESTADO_NUMERICO = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpenError(Exception):
+    """La llamada se rechazó sin intentarla porque el circuito del servicio está abierto."""
+    def __init__(self, service: str):
+        super().__init__(f"circuito abierto para {service}, llamada omitida")
+        self.service = service
+
+def is_service_failure(exc: Exception) -> bool:
+    """Timeouts, errores de conexión, 5xx y 429 cuentan para el breaker; otros 4xx no (el servicio respondió)."""
+    respuesta = getattr(exc, "response", None)
+    if isinstance(exc, requests.exceptions.HTTPError) and respuesta is not None:
+        return respuesta.status_code >= 500 or respuesta.status_code == 429
+    return True
+
+def is_timeout(exc: Exception) -> bool:
+    """La llamada se cortó por el timeout (no por conexión rechazada ni por respuesta de error)."""
+    return isinstance(exc, (asyncio.TimeoutError, TimeoutError, requests.exceptions.ReadTimeout))
+
+class CircuitBreaker:
+    """
+    Circuit breaker por microservicio (cerrado / abierto / semiabierto).
+    Tras `failure_threshold` fallos seguidos se abre y rechaza llamadas durante
+    `reset_seconds`; luego deja pasar una sola llamada de prueba: si funciona se
+    cierra y si falla vuelve a abrirse.
+    """
+    def __init__(self, service: str, failure_threshold: int, reset_seconds: float):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._estado = CLOSED
+        self._fallos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        CIRCUIT_STATE.labels(service).set(_ESTADO_NUMERICO[CLOSED])
+
+    @property
+    def state(self) -> str:
+        return self._estado
+
+    def _cambiar(self, estado: str):
+        if estado != self._estado:
+            logging.warning(f"CIRCUIT: {self.service} pasa de {self._estado} a {estado}")
+        self._estado = estado
+        CIRCUIT_STATE.labels(self.service).set(_ESTADO_NUMERICO[estado])
+
+    def allow(self) -> bool:
+        """Indica si se puede llamar al servicio ahora. En semiabierto solo pasa una llamada."""
+        with self._lock:
+            if self._estado == OPEN and time.monotonic() - self._abierto_desde >= self.reset_seconds:
+                self._cambiar(HALF_OPEN)
+            if self._estado == CLOSED:
+                return True
+            if self._estado == HALF_OPEN and not self._prueba_en_curso:
+                self._prueba_en_curso = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._fallos = 0
+            self._prueba_en_curso = False
+            self._cambiar(CLOSED)
+
+    def release_trial(self):
+        """La llamada de prueba terminó sin resultado (p.ej. se canceló): la siguiente puede probar de nuevo."""
+        with self._lock:
+            self._prueba_en_curso = False
+
+    def record_failure(self):
+        with self._lock:
+            self._fallos += 1
+            if self._estado == HALF_OPEN or self._fallos >= self.failure_threshold:
+                self._prueba_en_curso = False
+                self._abierto_desde = time.monotonic()
+                self._cambiar(OPEN)
+
+class AdaptiveTimeout:
+    """
+    Timeout derivado de la latencia observada: p99 de las últimas llamadas
+    multiplicado por un margen, acotado entre `minimum` y `maximum`.
+    Mientras no hay suficientes muestras se usa `maximum`. Una llamada cortada
+    por timeout entra como muestra de lo que se esperó: si solo se midieran
+    las exitosas, el p99 nunca vería las lentas y el timeout solo podría bajar.
+    """
+    def __init__(self, minimum: float, maximum: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._muestras = deque(maxlen=config.ADAPTIVE_TIMEOUT_WINDOW)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._muestras.append(seconds)
+
+    def current(self, floor: float = 0.0) -> float:
+        """Timeout a usar; `floor` lo sube para llamadas que se sabe que serán largas (sin pasar de `maximum`)."""
+        with self._lock:
+            muestras = sorted(self._muestras)
+        if len(muestras) < config.ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return self.maximum
+        p99 = muestras[min(len(muestras) - 1, int(len(muestras) * 0.99))]
+        return min(self.maximum, max(self.minimum, floor, p99 * config.ADAPTIVE_TIMEOUT_MULTIPLIER))
+
+class ServiceGuard:
+    """Breaker y timeout adaptativo de un microservicio."""
+    def __init__(self, service: str, max_timeout: float):
+        self.service = service
+        self.breaker = CircuitBreaker(service, config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_SECONDS)
+        self.timeout = AdaptiveTimeout(min(config.ADAPTIVE_TIMEOUT_MIN_SECONDS, max_timeout), max_timeout)
+
+    def before_call(self, min_timeout: float = 0.0) -> float:
+        """Devuelve el timeout a usar, o lanza CircuitOpenError si el circuito no deja pasar la llamada."""
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.service)
+        return self.timeout.current(min_timeout)
+
+    def record(self, error: Optional[Exception], seconds: float):
+        if error is None:
+            self.timeout.observe(seconds)
+            self.breaker.record_success()
+        elif is_service_failure(error):
+            if is_timeout(error):
+                # Tardó al menos `seconds`: la muestra sube el p99 y el siguiente timeout crece
+                self.timeout.observe(seconds)
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def abandon(self):
+        """La llamada se interrumpió (CancelledError, apagado) sin decir nada del servicio."""
+        self.breaker.release_trial()
+
+def build_guards(max_timeouts: Dict[str, float]) -> Dict[str, ServiceGuard]:
+    return {service: ServiceGuard(service, maximo) for service, maximo in max_timeouts.items()}
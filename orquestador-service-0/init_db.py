@@ -0,0 +1,30 @@
+"""
+Crea las tablas y aplica models.SCHEMA_UPGRADES, y después, en una transacción
+aparte que puede fallar sin deshacer lo anterior, models.OPTIONAL_SCHEMA_UPGRADES.
+
+Se ejecuta fuera del camino de las peticiones, antes de desplegar una nueva
+revisión (p.ej. como Cloud Run Job con la misma imagen):
+
+    python init_db.py
+"""
+import logging
+import models
+from database import get_engine
+
+def init_schema():
+    engine = get_engine()
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for ddl in models.SCHEMA_UPGRADES:
+            conn.exec_driver_sql(ddl)
+    try:
+        with engine.begin() as conn:
+            for ddl in models.OPTIONAL_SCHEMA_UPGRADES:
+                conn.exec_driver_sql(ddl)
+    except Exception as e:
+        logging.warning(f"INIT_DB: pg_trgm no disponible, /api/search usará solo ILIKE: {e}")
+    logging.info("INIT_DB: Esquema creado/actualizado")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    init_schema()
@@ -0,0 +1,211 @@
+"""
+Dobles en proceso de las dependencias externas del orquestador, con latencia y
+errores configurables. Reemplazan:
+- GCS (bucket/storage_client) y Pub/Sub (publisher) vía core.clients;
+- Firebase: el token es el email del usuario;
+- Parser, Cavali, Drive, Trello y Gmail (y lo que hay detrás: Cavali API,
+  Google Drive, Trello API, Gmail, Sheets) vía la sesión HTTP de MicroserviceClient.
+"""
+import asyncio
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import requests
+
+@dataclass
+class Dependency:
+    """Latencia media (s) con jitter uniforme ±jitter, y probabilidad de error."""
+    latency: float
+    jitter: float = 0.5
+    error_rate: float = 0.0
+    calls: int = 0
+    errors: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def wait(self) -> bool:
+        """Duerme la latencia simulada; devuelve False si esta llamada debe fallar."""
+        if self.latency > 0:
+            time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        falla = random.random() < self.error_rate
+        with self._lock:
+            self.calls += 1
+            self.errors += int(falla)
+        return not falla
+
+DEFAULT_PROFILE = {
+    "gcs": Dependency(0.02),
+    "pubsub": Dependency(0.01),
+    "firebase": Dependency(0.005),
+    "parser": Dependency(0.3),
+    "cavali": Dependency(1.5),
+    "drive": Dependency(0.4),
+    "trello": Dependency(0.3),
+    "gmail": Dependency(0.5),
+}
+
+def build_profile(latencies: Dict[str, float], error_rates: Dict[str, float]) -> Dict[str, Dependency]:
+    perfil = {nombre: Dependency(dep.latency, dep.jitter, dep.error_rate) for nombre, dep in DEFAULT_PROFILE.items()}
+    for nombre, valor in latencies.items():
+        perfil[nombre].latency = valor
+    for nombre, valor in error_rates.items():
+        perfil[nombre].error_rate = valor
+    return perfil
+
+# --- GCS / Pub/Sub ---
+
+class FakeBlob:
+    def __init__(self, dep: Dependency, name: str):
+        self.dep = dep
+        self.name = name
+
+    def upload_from_file(self, file_obj, **kwargs):
+        file_obj.read()
+        if not self.dep.wait():
+            raise IOError(f"GCS simulado: error subiendo {self.name}")
+
+    def download_as_bytes(self) -> bytes:
+        self.dep.wait()
+        return b"<Invoice/>"
+
+class FakeBucket:
+    def __init__(self, dep: Dependency):
+        self.dep = dep
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self.dep, name)
+
+class FakeStorageClient:
+    def __init__(self, dep: Dependency):
+        self.dep = dep
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(self.dep)
+
+class FakeFuture:
+    def result(self, timeout: Optional[float] = None) -> str:
+        return str(uuid.uuid4())
+
+class FakePublisher:
+    def __init__(self, dep: Dependency):
+        self.dep = dep
+
+    def topic_path(self, project: str, topic: str) -> str:
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic: str, data: bytes, **attrs) -> FakeFuture:
+        self.dep.wait()
+        return FakeFuture()
+
+# --- Microservicios ---
+
+class FakeResponse:
+    def __init__(self, status_code: int, data: dict, url: str):
+        self.status_code = status_code
+        self._data = data
+        self.url = url
+
+    def json(self) -> dict:
+        return self._data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} simulado para {self.url}", response=self)
+
+class FakeMicroservices:
+    """
+    Sesión HTTP que responde como Parser, Cavali, Drive, Trello y Gmail.
+    Los trabajos de /validate-jobs corren en un hilo con la latencia de Cavali
+    y al terminar "llaman" al callback resolviendo cavali_job_waiter en el loop.
+    """
+
+    def __init__(self, profile: Dict[str, Dependency], loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.profile = profile
+        self.headers: Dict[str, str] = {}
+        self.loop = loop
+        self.jobs: Dict[str, dict] = {}
+
+    def _invoice(self, operation_data: dict, gcs_path: str) -> dict:
+        nombre = gcs_path.rsplit("/", 1)[-1]
+        return {
+            "valid": True, "currency": "PEN",
+            "client_ruc": "20100000001", "client_name": "CLIENTE LOADTEST SAC",
+            "debtor_ruc": f"2060000{random.randint(1000, 9999)}", "debtor_name": "DEUDOR LOADTEST SAC",
+            # Folio único para no chocar con la verificación de duplicados
+            "document_id": f"F{uuid.uuid4().hex[:3].upper()}-{uuid.uuid4().int % 10**8:08d}",
+            "total_amount": round(random.uniform(1000, 50000), 2), "net_amount": round(random.uniform(1000, 50000), 2),
+            "issue_date": "2025-01-15T00:00:00", "due_date": "2025-03-15T00:00:00",
+            "xml_filename": nombre,
+        }
+
+    def _cavali_results(self, xml_paths) -> dict:
+        return {
+            p.rsplit("/", 1)[-1]: {"message": "Factura registrada", "process_id": str(uuid.uuid4()), "result_code": "0"}
+            for p in xml_paths
+        }
+
+    def _run_job(self, job_id: str, xml_paths):
+        from services.cavali_jobs import cavali_job_waiter
+
+        ok = self.profile["cavali"].wait()
+        estado = dict(self.jobs[job_id], status="done" if ok else "failed",
+                      cavali_results=self._cavali_results(xml_paths) if ok else {},
+                      error=None if ok else "cavali simulado falló")
+        self.jobs[job_id] = estado
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(cavali_job_waiter.resolve, job_id, estado)
+
+    def request(self, method: str, url: str, **kwargs):
+        if method == "GET":
+            return self.get(url, **kwargs)
+        return self.post(url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        job = self.jobs.get(url.rsplit("/", 1)[-1])
+        return FakeResponse(200, job, url) if job else FakeResponse(404, {}, url)
+
+    def post(self, url: str, json: Optional[dict] = None, headers: Optional[dict] = None, timeout: Optional[float] = None, **kwargs):
+        ruta = url.rsplit("/", 1)[-1]
+        if ruta == "validate-jobs":
+            job_id = uuid.uuid4().hex
+            xml_paths = (json or {}).get("gcs_paths", {}).get("xml", [])
+            self.jobs[job_id] = {"job_id": job_id, "status": "running", "total": len(xml_paths), "completed": 0}
+            threading.Thread(target=self._run_job, args=(job_id, xml_paths), daemon=True).start()
+            return FakeResponse(202, {"job_id": job_id, "status": "pending"}, url)
+        servicio = {
+            "parse-direct": "parser", "validate-direct": "cavali", "archive-direct": "drive",
+            "create-card": "trello", "send-email": "gmail",
+        }.get(ruta)
+        if servicio is None:
+            return FakeResponse(404, {}, url)
+        if not self.profile[servicio].wait():
+            return FakeResponse(500, {"detail": f"{servicio} simulado falló"}, url)
+
+        xml_paths = (json or {}).get("gcs_paths", {}).get("xml", [])
+        if servicio == "parser":
+            return FakeResponse(200, {"parsed_results": [self._invoice(json, p) for p in xml_paths]}, url)
+        if servicio == "cavali":
+            return FakeResponse(200, {"cavali_results": self._cavali_results(xml_paths)}, url)
+        if servicio == "drive":
+            return FakeResponse(200, {"drive_folder_url": f"https://drive.example/{uuid.uuid4().hex[:12]}"}, url)
+        return FakeResponse(200, {"status": "ok"}, url)
+
+def install(profile: Dict[str, Dependency]) -> None:
+    """Instala los dobles. Debe llamarse después de importar main y dentro del event loop."""
+    from core import clients
+    from services.microservice_client import microservice_client
+
+    clients.storage_client.set(FakeStorageClient(profile["gcs"]))
+    clients.bucket.set(FakeBucket(profile["gcs"]))
+    clients.publisher.set(FakePublisher(profile["pubsub"]))
+    clients.firebase_app.set(None)
+
+    def verify_id_token(token: str) -> dict:
+        profile["firebase"].wait()
+        return {"uid": token, "email": token, "name": token.split("@")[0]}
+    clients.verify_id_token = verify_id_token
+
+    microservice_client.session = FakeMicroservices(profile, asyncio.get_running_loop())
@@ -0,0 +1,161 @@
+"""
+Prueba de carga de extremo a extremo del orquestador con dobles en proceso.
+
+Lanza N envíos concurrentes a /submit-operation contra la app real (ASGI en
+proceso, sin red), con GCS, Pub/Sub, Firebase y los microservicios simulados
+por loadtest.fakes, y reporta throughput y percentiles por etapa.
+
+Requiere un Postgres local (el esquema usa JSONB, pg_notify y SKIP LOCKED,
+así que SQLite no sirve):
+
+    createdb orquestador_loadtest
+    DATABASE_URL=postgresql+psycopg2://postgres@localhost/orquestador_loadtest \\
+        python -m loadtest.run --requests 200 --concurrency 20 \\
+        --latency cavali=3,parser=0.5 --error-rate drive=0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+USER_EMAIL = "loadtest@capitalexpress.pe"
+
+def _parse_pairs(valor: str) -> Dict[str, float]:
+    """'cavali=3,parser=0.5' -> {'cavali': 3.0, 'parser': 0.5}"""
+    pares = {}
+    for parte in filter(None, (valor or "").split(",")):
+        nombre, _, numero = parte.partition("=")
+        pares[nombre.strip()] = float(numero)
+    return pares
+
+def _percentil(valores: List[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados))) - 1))
+    return ordenados[indice]
+
+def _configurar_entorno():
+    if not os.getenv("DATABASE_URL"):
+        sys.exit("LOADTEST: define DATABASE_URL apuntando a un Postgres local")
+    # URLs ficticias: las llamadas las atiende la sesión simulada
+    for servicio in ("PARSER", "CAVALI", "DRIVE", "TRELLO", "GMAIL"):
+        os.environ[f"{servicio}_SERVICE_URL"] = f"http://{servicio.lower()}.loadtest"
+    os.environ.setdefault("BUCKET_NAME", "loadtest-bucket")
+    os.environ["DB_INIT_ON_STARTUP"] = "false"
+
+def _metadata() -> str:
+    return json.dumps({
+        "user_email": USER_EMAIL, "tasaOperacion": 1.5, "comision": 100,
+        "solicitudAdelanto": {"porcentaje": 0},
+        "cuentasDesembolso": [{"banco": "BCP", "numero": "191-0000000-0-00", "moneda": "PEN", "tipo": "Corriente"}],
+    })
+
+async def _enviar(client, indice: int, xml_por_envio: int):
+    archivos = [("xml_files", (f"F001-{indice:06d}-{n}.xml", b"<Invoice/>", "application/xml")) for n in range(xml_por_envio)]
+    archivos += [("pdf_files", (f"F001-{indice:06d}.pdf", b"%PDF-1.4", "application/pdf"))]
+    archivos += [("respaldo_files", (f"respaldo-{indice:06d}.pdf", b"%PDF-1.4", "application/pdf"))]
+    inicio = time.perf_counter()
+    try:
+        respuesta = await client.post(
+            "/submit-operation", data={"metadata": _metadata()}, files=archivos,
+            headers={"Authorization": f"Bearer {USER_EMAIL}"},
+        )
+        estado = str(respuesta.status_code)
+    except Exception as e:
+        estado = type(e).__name__
+    return estado, time.perf_counter() - inicio
+
+async def _esperar_outbox(timeout: float) -> int:
+    """Espera a que el outbox no tenga mensajes pendientes; devuelve los que quedan."""
+    import models
+    from database import SessionLocal
+
+    def pendientes() -> int:
+        with SessionLocal() as db:
+            return db.query(models.OutboxMessage).filter(models.OutboxMessage.estado.in_(["pendiente", "enviando"])).count()
+
+    limite = time.monotonic() + timeout
+    restantes = await asyncio.to_thread(pendientes)
+    while restantes and time.monotonic() < limite:
+        await asyncio.sleep(0.5)
+        restantes = await asyncio.to_thread(pendientes)
+    return restantes
+
+async def main(args):
+    _configurar_entorno()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import httpx
+    import main as app_module
+    from core.metrics import add_stage_observer
+    from database import SessionLocal
+    from init_db import init_schema
+    from loadtest import fakes
+    from repository import OperationRepository
+    from services.outbox_dispatcher import outbox_dispatcher
+
+    perfil = fakes.build_profile(_parse_pairs(args.latency), _parse_pairs(args.error_rate))
+    fakes.install(perfil)
+    init_schema()
+    # El usuario se registra antes para que la carga no mida (ni compita por) su primer ingreso
+    with SessionLocal() as db:
+        OperationRepository(db).update_and_get_last_login(USER_EMAIL, "Load Test")
+
+    etapas: Dict[str, List[float]] = defaultdict(list)
+    add_stage_observer(lambda etapa, segundos: etapas[etapa].append(segundos))
+
+    semaforo = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=app_module.app)
+    outbox_dispatcher.start()
+    async with httpx.AsyncClient(transport=transport, base_url="http://orquestador.loadtest", timeout=None) as client:
+        async def limitado(indice: int):
+            async with semaforo:
+                return await _enviar(client, indice, args.xml_per_request)
+
+        print(f"LOADTEST: {args.requests} envíos, concurrencia {args.concurrency}, {args.xml_per_request} XML por envío")
+        inicio = time.perf_counter()
+        resultados = await asyncio.gather(*(limitado(i) for i in range(args.requests)))
+        duracion = time.perf_counter() - inicio
+
+    inicio_outbox = time.perf_counter()
+    restantes = await _esperar_outbox(args.outbox_timeout)
+    duracion_outbox = time.perf_counter() - inicio_outbox
+    await outbox_dispatcher.stop()
+
+    estados = Counter(estado for estado, _ in resultados)
+    latencias = [segundos for _, segundos in resultados]
+    print(f"\nThroughput: {args.requests / duracion:.2f} envíos/s ({duracion:.1f}s)")
+    print("Estados HTTP: " + ", ".join(f"{estado}={n}" for estado, n in sorted(estados.items())))
+    print(f"Outbox drenado en {duracion_outbox:.1f}s (pendientes: {restantes})")
+
+    print(f"\n{'etapa':<22}{'n':>7}{'media':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    filas = [("end_to_end", latencias)] + sorted(etapas.items())
+    for etapa, valores in filas:
+        if not valores:
+            continue
+        print(f"{etapa:<22}{len(valores):>7}{statistics.mean(valores):>9.3f}"
+              f"{_percentil(valores, 50):>9.3f}{_percentil(valores, 90):>9.3f}"
+              f"{_percentil(valores, 99):>9.3f}{max(valores):>9.3f}")
+
+    print(f"\n{'dependencia':<22}{'llamadas':>9}{'errores':>9}")
+    for nombre, dep in perfil.items():
+        print(f"{nombre:<22}{dep.calls:>9}{dep.errors:>9}")
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Prueba de carga de /submit-operation con dependencias simuladas")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--xml-per-request", type=int, default=3)
+    parser.add_argument("--latency", default="", help="Latencia media en segundos, p.ej. cavali=3,parser=0.5")
+    parser.add_argument("--error-rate", default="", help="Probabilidad de error, p.ej. drive=0.05,gmail=0.1")
+    parser.add_argument("--outbox-timeout", type=float, default=120)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(main(_parse_args()))
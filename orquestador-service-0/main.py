@@ -1,35 +1,39 @@
 import uuid
 import json
+import hashlib
+import hmac
+import requests
 import os
 import traceback
-from typing import List, Annotated, Optional
+from typing import Dict, List, Annotated, Optional
 from collections import defaultdict
 from dotenv import load_dotenv
 from datetime import datetime, timezone
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request, Response, status, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session, joinedload, selectinload
+from fastapi.responses import StreamingResponse
 from sqlalchemy.dialects.postgresql import insert as pg_insert
-from google.cloud import storage
-import firebase_admin
-from firebase_admin import credentials, auth
-from database import get_db, engine
+import threading
+from database import SessionLocal
 from repository import OperationRepository
-import models
+from core.dependencies import get_repository
 from pydantic import BaseModel
 import logging
 import asyncio
 from services.microservice_client import microservice_client
+from services.outbox_dispatcher import outbox_dispatcher
+from services.submission_keys import submission_keys
+from services.operation_events import PENDING_STAGES, operation_event_broker, emit as emit_stage
+from services import operation_export
+from services.analytics_cache import analytics_cache
+from services.cavali_jobs import cavali_job_waiter
+from core import clients
+from core.config import config
+from core.metrics import track_stage, render_latest
+import tracing
 
-models.Base.metadata.create_all(bind=engine)
 load_dotenv()
 
-try:
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app(credentials.ApplicationDefault())
-except Exception as e:
-    print(f"ADVERTENCIA: Firebase SDK no inicializado: {e}")
-
 app = FastAPI(title="Orquestador de Operaciones")
 app.add_middleware(
     CORSMiddleware,
@@ -43,6 +47,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+tracing.instrument_app(app)
 
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "operaciones-peru")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
@@ -51,30 +56,51 @@ DRIVE_SERVICE_URL = os.getenv("DRIVE_SERVICE_URL")
 GMAIL_SERVICE_URL = os.getenv("GMAIL_SERVICE_URL")
 PARSER_SERVICE_URL = os.getenv("PARSER_SERVICE_URL")
 CAVALI_SERVICE_URL = os.getenv("CAVALI_SERVICE_URL")
+# Solo para desarrollo local: en producción el esquema se aplica con `python init_db.py`
+DB_INIT_ON_STARTUP = os.getenv("DB_INIT_ON_STARTUP", "false").lower() == "true"
 
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET_NAME)
+@app.on_event("startup")
+async def warm_up():
+    """Inicializa en segundo plano lo que el primer request necesitará, sin retrasar el arranque."""
+    def calentar():
+        try:
+            if DB_INIT_ON_STARTUP:
+                from init_db import init_schema
+                init_schema()
+            clients.firebase_app.get()
+        except Exception as e:
+            logging.error(f"STARTUP: Error en la inicialización en segundo plano: {e}")
+    threading.Thread(target=calentar, name="warm-up", daemon=True).start()
+    outbox_dispatcher.start()
 
+@app.on_event("shutdown")
+async def shutdown():
+    await outbox_dispatcher.stop()
 
-async def get_current_user(authorization: Optional[str] = Header(None), db: Session = Depends(get_db)) -> dict:
+
+async def get_current_user(authorization: Optional[str] = Header(None), repo = Depends(get_repository)) -> dict:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Token de autorización inválido")
     try:
-        decoded_token = auth.verify_id_token(authorization.split("Bearer ")[1])
+        decoded_token = await asyncio.to_thread(clients.verify_id_token, authorization.split("Bearer ")[1])
         email = decoded_token['email']
         
-        user_in_db = db.query(models.Usuario).filter(models.Usuario.email == email).first()
-        
-        if not user_in_db:
-            repo = OperationRepository(db)
-            repo.update_and_get_last_login(email, decoded_token.get('name', ''))
-            user_in_db = db.query(models.Usuario).filter(models.Usuario.email == email).first()
+        user_in_db = await repo.get_or_create_user(email, decoded_token.get('name', ''))
 
         decoded_token['role'] = user_in_db.rol 
         return decoded_token
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Token inválido o error de base de datos: {e}")
 
+def etag_coincide(if_none_match: Optional[str], etag: str) -> bool:
+    """Compara la cabecera If-None-Match con un ETag usando comparación débil (RFC 9110)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaco = etag.removeprefix("W/")
+    return any(candidato.strip().removeprefix("W/") == opaco for candidato in if_none_match.split(","))
+
 # Receptor de operaciones del frontend
 @app.post("/submit-operation", status_code=status.HTTP_202_ACCEPTED)
 async def submit_operation_async(
@@ -82,22 +108,47 @@ async def submit_operation_async(
     xml_files: Annotated[List[UploadFile], File(alias="xml_files")],
     pdf_files: Annotated[List[UploadFile], File(alias="pdf_files")],
     respaldo_files: Annotated[List[UploadFile], File(alias="respaldo_files")],
-    user: dict = Depends(get_current_user), db: Session = Depends(get_db)
+    user: dict = Depends(get_current_user), repo = Depends(get_repository),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    client_tracking_id: Optional[str] = Header(None, alias="X-Tracking-Id")
 ):
+    # El frontend puede fijar el tracking_id para abrir /operations/{tracking_id}/events antes de enviar
+    tracking_id = str(uuid.uuid4())
+    if client_tracking_id:
+        try:
+            tracking_id = str(uuid.UUID(client_tracking_id))
+        except ValueError:
+            raise HTTPException(status_code=422, detail="X-Tracking-Id debe ser un UUID")
+        # Reusarlo mezclaría archivos en GCS, etapas del stream y el /operation-status de otro envío
+        if await repo.tracking_id_in_use(tracking_id, user['email'], idempotency_key):
+            raise HTTPException(status_code=409, detail="X-Tracking-Id ya pertenece a otro envío")
+    tracing.set_tracking_id(tracking_id)
+    if idempotency_key:
+        # Un reintento con la misma clave devuelve (o espera) el resultado del envío original
+        huella = hashlib.sha256(json.dumps(
+            [metadata_str] + [[f.filename, f.size] for f in xml_files + pdf_files + respaldo_files]
+        ).encode("utf-8")).hexdigest()
+        respuesta_previa = await submission_keys.claim(user['email'], idempotency_key, tracking_id, huella)
+        if respuesta_previa is not None:
+            return respuesta_previa
+
     try:
         metadata = json.loads(metadata_str)
-        tracking_id = str(uuid.uuid4())
         
         # GENERAR OPERATION_ID AL INICIO para consistencia total
-        repo = OperationRepository(db)
-        operation_id = repo.generar_siguiente_id_operacion()
+        with track_stage("id_lock"):
+            operation_id = await repo.generar_siguiente_id_operacion()
         logging.info(f"SUBMIT: Generado operation_id {operation_id} para tracking {tracking_id}")
         
         upload_folder = f"operations/{datetime.now(timezone.utc).strftime('%Y-%m-%d')}/{tracking_id}"
         def upload_file(file: UploadFile, subfolder: str) -> str:
-            blob_path = f"{upload_folder}/{subfolder}/{file.filename}"; blob = bucket.blob(blob_path); blob.upload_from_file(file.file); return f"gs://{BUCKET_NAME}/{blob_path}"
+            blob_path = f"{upload_folder}/{subfolder}/{file.filename}"; blob = clients.bucket.get().blob(blob_path); blob.upload_from_file(file.file); return f"gs://{BUCKET_NAME}/{blob_path}"
         
-        gcs_paths = { "xml": [upload_file(f, "xml") for f in xml_files], "pdf": [upload_file(f, "pdf") for f in pdf_files], "respaldo": [upload_file(f, "respaldos") for f in respaldo_files] }
+        def upload_all() -> Dict[str, List[str]]:
+            return { "xml": [upload_file(f, "xml") for f in xml_files], "pdf": [upload_file(f, "pdf") for f in pdf_files], "respaldo": [upload_file(f, "respaldos") for f in respaldo_files] }
+
+        with track_stage("gcs_upload"):
+            gcs_paths = await asyncio.to_thread(upload_all)
         operation_data = { 
             "tracking_id": tracking_id, 
             "operation_id": operation_id,  # ✨ AGREGADO: operation_id desde el inicio
@@ -105,14 +156,28 @@ async def submit_operation_async(
             "metadata": metadata, 
             "gcs_paths": gcs_paths 
         }
+        await emit_stage(tracking_id, "uploaded", {"operation_id": operation_id, "archivos": sum(len(v) for v in gcs_paths.values())})
         
         # Procesar directamente con operation_id ya definido
-        await process_operation_sync(operation_data, db)
-        return {"status": "processing", "tracking_id": tracking_id, "operation_id": operation_id}
+        with track_stage("total"):
+            await process_operation_sync(operation_data)
+        result = {"status": "processing", "tracking_id": tracking_id, "operation_id": operation_id}
+        if idempotency_key:
+            await submission_keys.complete(user['email'], idempotency_key, result)
+        return result
     except Exception as e:
-        traceback.print_exc(); raise HTTPException(status_code=500, detail=str(e))
+        traceback.print_exc()
+        await emit_stage(tracking_id, "failed", {"error": str(e)})
+        if idempotency_key:
+            await submission_keys.fail(user['email'], idempotency_key)
+        raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        # Cancelado (cliente desconectado, apagado): la clave no debe quedar 'en_proceso' hasta vencer
+        if idempotency_key:
+            await submission_keys.fail(user['email'], idempotency_key)
+        raise
 
-async def process_operation_sync(operation_data: dict, db: Session):
+async def process_operation_sync(operation_data: dict):
     """
     Procesa la operación de forma síncrona:
     1. Parser (secuencial)
@@ -125,23 +190,29 @@ async def process_operation_sync(operation_data: dict, db: Session):
         logging.info(f"SYNC: Iniciando procesamiento de {tracking_id}")
         
         # 1. Llamar Parser directamente
-        parsed_results = await microservice_client.call_parser_service(operation_data)
+        with track_stage("parser"):
+            parsed_results = await microservice_client.call_parser_service(operation_data)
         if not parsed_results:
             logging.error(f"SYNC: Parser falló para {tracking_id}")
             raise Exception("Parser service failed")
+        await emit_stage(tracking_id, "parsed", {"facturas": len(parsed_results)})
         
         # 2. Llamar Cavali directamente (con tolerancia a fallos)
-        cavali_results = await microservice_client.call_cavali_service(operation_data)
+        with track_stage("cavali"):
+            cavali_results = await microservice_client.call_cavali_service(operation_data)
         if not cavali_results:
             logging.warning(f"SYNC: Cavali falló para {tracking_id}, continuando sin validación")
             cavali_results = {}
+        await emit_stage(tracking_id, "cavali", {"validadas": len(cavali_results)})
         
         # 3. Llamar Drive directamente (operation_id ya incluido en operation_data)
         operation_id = operation_data["operation_id"]
-        drive_results = await microservice_client.call_drive_service(operation_data)
+        with track_stage("drive"):
+            drive_results = await microservice_client.call_drive_service(operation_data)
         drive_folder_url = drive_results.get("drive_folder_url", "")
         if drive_folder_url:
             logging.info(f"SYNC: Drive folder creado para {tracking_id} como {operation_id}: {drive_folder_url}")
+        await emit_stage(tracking_id, "drive", {"drive_folder_url": drive_folder_url})
         
         # 4. Finalizar operación inmediatamente
         final_payload = {
@@ -150,7 +221,15 @@ async def process_operation_sync(operation_data: dict, db: Session):
             "cavali_results": cavali_results,
             "drive_folder_url": drive_folder_url
         }
-        process_final_operation(final_payload, db)
+        with track_stage("finalize"):
+            operaciones_creadas = await asyncio.to_thread(process_final_operation, final_payload)
+        # Cada operación creada encola una notificación por destino (trello, gmail)
+        await emit_stage(tracking_id, "persisted", {
+            "operation_ids": operaciones_creadas,
+            "notificaciones": 2 * len(operaciones_creadas),
+        })
+        # Se despierta al dispatcher después de 'persisted' para que 'notified' llegue a continuación
+        outbox_dispatcher.wake()
         logging.info(f"SYNC: Operación {tracking_id} completada exitosamente como {operation_id}")
         
     except Exception as e:
@@ -160,8 +239,15 @@ async def process_operation_sync(operation_data: dict, db: Session):
 
 
 
-def process_final_operation(payload: dict, db: Session):
-    repo = OperationRepository(db)
+def process_final_operation(payload: dict) -> List[str]:
+    """
+    Guarda una operación por moneda y devuelve los operation_id creados. Corre en
+    un hilo (asyncio.to_thread) con su propia sesión: son varias consultas y commits.
+    """
+    with SessionLocal() as db:
+        return _process_final_operation(payload, OperationRepository(db))
+
+def _process_final_operation(payload: dict, repo: OperationRepository) -> List[str]:
     original_tracking_id = payload["tracking_id"]
     
     # 1. Filtrar facturas válidas
@@ -170,12 +256,13 @@ def process_final_operation(payload: dict, db: Session):
     
     if not valid_invoices:
         print(f"FINALIZER: No hay facturas válidas para {original_tracking_id}")
-        return
+        return []
     
     print(f"FINALIZER: {len(valid_invoices)} facturas válidas de {len(payload['parsed_results'])} totales")
     
     # 2. Verificar duplicados usando fingerprint
-    duplicate_check = repo.check_duplicate_invoices(valid_invoices)
+    with track_stage("duplicate_check"):
+        duplicate_check = repo.check_duplicate_invoices(valid_invoices)
     
     if duplicate_check['has_duplicates']:
         print(f"FINALIZER: Detectados {len(duplicate_check['duplicates'])} duplicados para {original_tracking_id}:")
@@ -185,7 +272,7 @@ def process_final_operation(payload: dict, db: Session):
         # Decidir qué hacer con duplicados
         if not duplicate_check['new_invoices']:
             print(f"FINALIZER: Todas las facturas son duplicadas, rechazando operación {original_tracking_id}")
-            return  # Rechazar si TODAS son duplicadas
+            return []  # Rechazar si TODAS son duplicadas
         
         print(f"FINALIZER: Procesando solo {len(duplicate_check['new_invoices'])} facturas nuevas")
         valid_invoices = duplicate_check['new_invoices']
@@ -199,30 +286,24 @@ def process_final_operation(payload: dict, db: Session):
     
     if not invoices_by_currency:
         print(f"FINALIZER: No hay facturas con monedas válidas para {original_tracking_id}")
-        return
+        return []
 
     # 4. Crear operaciones por moneda
+    operaciones_creadas = []
     for currency, invoices_in_group in invoices_by_currency.items():
         # Usar operation_id que ya viene definido desde el inicio
         if payload.get("operation_id") and len(invoices_by_currency) == 1:
             operation_id = payload["operation_id"]
         else:
-            operation_id = repo.generar_siguiente_id_operacion()
+            with track_stage("id_lock"):
+                operation_id = repo.generar_siguiente_id_operacion()
             
         print(f"FINALIZER: Creando operación {operation_id} para {len(invoices_in_group)} facturas en {currency}")
-        
-        repo.save_full_operation(
-            operation_id=operation_id,
-            metadata=payload['metadata'], 
-            drive_url=payload['drive_folder_url'],
-            invoices_data=invoices_in_group,
-            cavali_results_map=payload['cavali_results']
-        )
-        print(f"FINALIZER: Operación {operation_id} guardada en DB.")
 
+        idempotency_key = f"{operation_id}_{currency}"
         notification_payload = {
             "operation_id": operation_id,
-            "idempotency_key": f"{operation_id}_{currency}",
+            "idempotency_key": idempotency_key,
             "user_email": payload.get("user_email"), 
             "metadata": payload.get("metadata"),
             "drive_folder_url": payload.get("drive_folder_url"), 
@@ -236,55 +317,125 @@ def process_final_operation(payload: dict, db: Session):
             "original_tracking_id": original_tracking_id
         }
 
-        # Enviar notificaciones directamente (no bloqueante)
-        print(f"FINALIZER: Enviando notificaciones para operación {operation_id}")
-        try:
-            microservice_client.call_trello_service(notification_payload)
-            microservice_client.call_gmail_service(notification_payload)
-            print(f"FINALIZER: Notificaciones enviadas exitosamente para operación {operation_id}")
-        except Exception as e:
-            print(f"FINALIZER: Error enviando notificaciones para {operation_id}: {e}")
+        # Las notificaciones se guardan en el outbox en la misma transacción que la operación
+        with track_stage("persist"):
+            repo.save_full_operation(
+                operation_id=operation_id,
+                metadata=payload['metadata'], 
+                drive_url=payload['drive_folder_url'],
+                invoices_data=invoices_in_group,
+                cavali_results_map=payload['cavali_results'],
+                tracking_id=original_tracking_id,
+                notificaciones=[
+                    {"destino": destino, "idempotency_key": f"{idempotency_key}:{destino}", "payload": notification_payload}
+                    for destino in ("trello", "gmail")
+                ]
+            )
+        print(f"FINALIZER: Operación {operation_id} guardada en DB, notificaciones encoladas en outbox.")
+        operaciones_creadas.append(operation_id)
+    return operaciones_creadas
 
 # ROL 3: ENDPOINTS DE CONSULTA
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Histogramas por etapa, por microservicio y por sentencia SQL en formato Prometheus."""
+    cuerpo, content_type = render_latest()
+    return Response(content=cuerpo, media_type=content_type)
+
+@app.get("/operations/{tracking_id}/events")
+async def stream_operation_events(
+    tracking_id: str,
+    request: Request,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Server-Sent Events con las etapas del envío (uploaded, parsed, cavali, drive,
+    persisted, notified, o failed). Respaldado por LISTEN/NOTIFY, así que
+    cualquier instancia puede servir el stream; al reconectar, EventSource
+    envía Last-Event-ID y solo se repiten las etapas posteriores.
+    """
+    return StreamingResponse(
+        operation_event_broker.stream(tracking_id, last_event_id, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def cavali_job_callback(request: Request, x_callback_token: Optional[str] = Header(None)):
+    """Cavali avisa que terminó un trabajo de /validate-jobs; despierta a quien lo espera en esta instancia."""
+    if not config.CAVALI_CALLBACK_TOKEN or not hmac.compare_digest(x_callback_token or "", config.CAVALI_CALLBACK_TOKEN):
+        raise HTTPException(status_code=401, detail="Token de callback inválido")
+    estado = await request.json()
+    if not isinstance(estado, dict) or "job_id" not in estado:
+        raise HTTPException(status_code=422, detail="Falta job_id")
+    if not cavali_job_waiter.resolve(str(estado["job_id"]), estado):
+        logging.info(f"CAVALI: Callback del trabajo {estado['job_id']} sin espera en esta instancia; lo recogerá el sondeo")
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+# Sin CAVALI_CALLBACK_TOKEN el callback no se expone: las esperas se resuelven solo con el sondeo
+if config.CAVALI_CALLBACK_TOKEN:
+    app.add_api_route("/operations/cavali-callback", cavali_job_callback, methods=["POST"], status_code=status.HTTP_204_NO_CONTENT)
+
 @app.get("/operation-status/{tracking_id}")
-async def get_operation_status(tracking_id: str, db: Session = Depends(get_db)):
+async def get_operation_status(tracking_id: str, repo = Depends(get_repository)):
     """
     Con el nuevo sistema síncrono, las operaciones se completan inmediatamente.
-    Retornamos un status que el frontend entienda para parar el polling.
+    Retornamos un status que el frontend entienda para parar el polling:
+    'processing' mientras el envío sigue en el pipeline y 'completed' en cualquier
+    otro caso, con los operation_id creados (vacío si no se creó ninguna).
     """
-    # Buscar la operación más reciente que puede corresponder a este tracking_id
-    # Como las operaciones se procesan inmediatamente, debería estar en operaciones
-    recent_operation = db.query(models.Operacion).order_by(models.Operacion.fecha_creacion.desc()).first()
-    
-    drive_url = ""
-    if recent_operation and recent_operation.url_carpeta_drive:
-        drive_url = recent_operation.url_carpeta_drive
-    
+    # Las operaciones guardan el tracking_id del envío (columna indexada)
+    operaciones = await repo.get_operations_by_tracking_id(tracking_id)
+    if not operaciones:
+        evento = await repo.get_last_event(tracking_id)
+        if evento is not None and evento.etapa in PENDING_STAGES:
+            return {"status": "processing", "tracking_id": tracking_id, "etapa": evento.etapa}
+        return {
+            "status": "completed",
+            "drive_folder_url": "",
+            "tracking_id": tracking_id,
+            "operation_ids": [],
+            "message": "El envío falló" if evento is not None and evento.etapa == "failed" else "No se creó ninguna operación para este envío",
+            "processed_synchronously": True
+        }
+
     return {
         "status": "completed",
-        "drive_folder_url": drive_url,
+        "drive_folder_url": operaciones[0].url_carpeta_drive or "",
         "tracking_id": tracking_id,
+        "operation_ids": [op.id for op in operaciones],
         "message": "Operación procesada exitosamente",
         "processed_synchronously": True
     }
 
 @app.get("/api/operaciones")
 async def get_user_operations(
+    response: Response,
     user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    repo = Depends(get_repository),
     page: int = Query(1, ge=1),
     limit: int = Query(20, ge=1, le=100),
-    estado: Optional[str] = Query(None, description="Filtrar por estado de operación")
+    estado: Optional[str] = Query(None, description="Filtrar por estado de operación"),
+    if_none_match: Optional[str] = Header(None)
 ):
-    repo = OperationRepository(db)
-    last_login = repo.update_and_get_last_login(user['email'], user.get('name', ''))
-
     user_role = user.get('role')
     offset = (page - 1) * limit
-    
+
+    # ETag débil: cubre solo el contenido de la página dentro del filtro. Se evalúa antes de registrar el
+    # ingreso: un sondeo que recibe 304 no escribe en la base y conserva el last_login de su última respuesta completa.
+    alcance = "admin" if user_role == 'admin' else user['email']
+    fingerprint = await repo.get_dashboard_fingerprint(user['email'], user_role, estado_filter=estado)
+    digest = hashlib.sha1(repr((alcance, estado, page, limit, fingerprint)).encode("utf-8")).hexdigest()[:20]
+    etag = f'W/"{digest}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_coincide(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    response.headers.update(cache_headers)
+
+    last_login = await repo.update_and_get_last_login(user['email'], user.get('name', ''))
+
     # El método ahora devuelve un diccionario con 'operations' y 'total'
-    paginated_result = repo.get_dashboard_operations(user['email'], user_role, offset, limit, estado_filter=estado)
+    paginated_result = await repo.get_dashboard_operations(user['email'], user_role, offset, limit, estado_filter=estado)
 
     return {
         "last_login": last_login.isoformat() if last_login else None,
@@ -294,21 +445,107 @@ async def get_user_operations(
         "limit": limit
     }
 
+@app.get("/api/operaciones/export")
+async def export_operations(
+    user: dict = Depends(get_current_user),
+    formato: str = Query("csv", alias="format", pattern="^(csv|xlsx)$"),
+    estado: Optional[str] = Query(None, description="Filtrar por estado de operación"),
+    desde: Optional[datetime] = Query(None, description="Fecha de ingreso mínima (inclusive)"),
+    hasta: Optional[datetime] = Query(None, description="Fecha de ingreso máxima (exclusiva)")
+):
+    """Exporta una fila por factura, con el mismo alcance por rol que el dashboard, sin cargar todo en memoria."""
+    def filas():
+        # Sesión propia: vive mientras se genera la respuesta, no solo durante el endpoint
+        db = SessionLocal()
+        try:
+            yield from OperationRepository(db).iter_export_rows(user['email'], user.get('role'), estado, desde, hasta)
+        finally:
+            db.close()
+
+    fecha = datetime.now(timezone.utc).strftime('%Y%m%d')
+    if formato == "xlsx":
+        contenido = operation_export.xlsx_chunks(filas())
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        contenido = operation_export.csv_chunks(filas())
+        media_type = "text/csv; charset=utf-8"
+    return StreamingResponse(contenido, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="operaciones_{fecha}.{formato}"',
+    })
+
+@app.get("/api/analytics/portfolio")
+async def get_portfolio_analytics(
+    response: Response,
+    user: dict = Depends(get_current_user),
+    repo = Depends(get_repository),
+    dimension: str = Query("moneda", pattern="^(moneda|estado|deudor|ejecutivo)$"),
+    periodo: Optional[str] = Query(None, pattern="^(day|week|month)$"),
+    desde: Optional[datetime] = Query(None, description="Fecha de ingreso mínima (inclusive)"),
+    hasta: Optional[datetime] = Query(None, description="Fecha de ingreso máxima (exclusiva)"),
+    estado: Optional[str] = Query(None, description="Filtrar por estado de operación"),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Totales de cartera (ROLLUP en SQL), con caché por filtro invalidada por la huella de la base."""
+    user_role = user.get('role')
+    alcance = "admin" if user_role == 'admin' else user['email']
+    clave = (alcance, dimension, periodo, desde, hasta, estado)
+    fingerprint = await repo.get_dashboard_fingerprint(user['email'], user_role)
+    digest = hashlib.sha1(repr((clave, fingerprint)).encode("utf-8")).hexdigest()[:20]
+    etag = f'W/"{digest}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_coincide(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    response.headers.update(cache_headers)
+
+    filas = analytics_cache.get(clave, fingerprint)
+    if filas is None:
+        filas = await repo.get_portfolio_rollup(user['email'], user_role, dimension, periodo, desde, hasta, estado)
+        analytics_cache.put(clave, fingerprint, filas)
+    return {"dimension": dimension, "periodo": periodo, "filas": filas}
+
+@app.get("/api/search")
+async def search(
+    q: str = Query(..., min_length=3, max_length=100, description="Texto, folio, ID de operación o prefijo de RUC"),
+    limite: int = Query(10, ge=1, le=50),
+    user: dict = Depends(get_current_user),
+    repo = Depends(get_repository)
+):
+    """Busca operaciones, facturas y empresas con índices de trigramas, dentro de SEARCH_STATEMENT_TIMEOUT_MS."""
+    texto = q.strip()
+    if len(texto) < 3:
+        raise HTTPException(status_code=422, detail="La búsqueda necesita al menos 3 caracteres")
+    try:
+        return await repo.search(texto, user['email'], user.get('role'), limite, config.SEARCH_STATEMENT_TIMEOUT_MS)
+    except TimeoutError as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
+
 @app.get("/api/operaciones/{op_id}/detalle")
-async def get_operation_detail(op_id: str, user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    operacion = db.query(models.Operacion).options(
-        joinedload(models.Operacion.cliente),
-        selectinload(models.Operacion.facturas).joinedload(models.Factura.deudor),
-        selectinload(models.Operacion.gestiones).joinedload(models.Gestion.analista)
-    ).filter(models.Operacion.id == op_id).first()
-    
-    if not operacion:
+async def get_operation_detail(
+    op_id: str,
+    response: Response,
+    user: dict = Depends(get_current_user),
+    repo = Depends(get_repository),
+    if_none_match: Optional[str] = Header(None)
+):
+    # Primero solo la versión: si el cliente ya tiene esta versión no se carga el grafo
+    cabecera = await repo.get_operation_version(op_id)
+    if not cabecera:
         raise HTTPException(status_code=404, detail="Operación no encontrada")
     
     # Verificar permisos: admins ven todo, ventas solo sus operaciones
-    if user.get('role') != 'admin' and operacion.email_usuario != user['email']:
+    if user.get('role') != 'admin' and cabecera.email_usuario != user['email']:
         raise HTTPException(status_code=403, detail="No tiene permisos para ver esta operación")
-    
+
+    etag = f'"{op_id}-v{cabecera.version}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_coincide(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+
+    operacion = await repo.get_operation_graph(op_id)
+    if not operacion:
+        raise HTTPException(status_code=404, detail="Operación no encontrada")
+
+    response.headers.update(cache_headers)
     return {
         "id": operacion.id,
         "fechaIngreso": operacion.fecha_creacion.isoformat(),
@@ -347,9 +584,8 @@ async def get_operation_detail(op_id: str, user: dict = Depends(get_current_user
 
 
 @app.get("/api/gestiones/operaciones")
-async def get_operaciones_gestion(user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    repo = OperationRepository(db)
-    operaciones_db = repo.get_gestiones_operations(user_email=user['email'], user_role=user.get('role'))
+async def get_operaciones_gestion(user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    operaciones_db = await repo.get_gestiones_operations(user_email=user['email'], user_role=user.get('role'))
     resultado_formateado = []
     for op in operaciones_db:
         alerta_ia = None
@@ -390,19 +626,15 @@ class GestionCreate(BaseModel):
     notas: str | None = None
 
 @app.post("/api/operaciones/{op_id}/gestiones", status_code=status.HTTP_201_CREATED)
-async def registrar_gestion(op_id: str, gestion_data: GestionCreate, user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    operacion = db.query(models.Operacion).filter(models.Operacion.id == op_id).first()
-    if not operacion:
+async def registrar_gestion(op_id: str, gestion_data: GestionCreate, user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    nueva_gestion = await repo.add_gestion(op_id, user['email'], gestion_data.dict())
+    if not nueva_gestion:
         raise HTTPException(status_code=404, detail="Operación no encontrada")
-    nueva_gestion = models.Gestion(id_operacion=op_id, analista_email=user['email'], **gestion_data.dict())
-    db.add(nueva_gestion)
-    db.commit()
-    db.refresh(nueva_gestion)
     return nueva_gestion
 
 @app.delete("/api/gestiones/{gestion_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def eliminar_gestion(gestion_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    gestion = db.query(models.Gestion).filter(models.Gestion.id == gestion_id).first()
+async def eliminar_gestion(gestion_id: int, user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    gestion = await repo.get_gestion(gestion_id)
     if not gestion:
         raise HTTPException(status_code=404, detail="Gestión no encontrada")
     
@@ -410,68 +642,70 @@ async def eliminar_gestion(gestion_id: int, user: dict = Depends(get_current_use
     if user['role'] != 'admin' and gestion.analista_email != user['email']:
         raise HTTPException(status_code=403, detail="No tiene permisos para eliminar esta gestión")
     
-    db.delete(gestion)
-    db.commit()
+    await repo.delete_gestion(gestion)
     return
 
 class FacturaUpdate(BaseModel):
     estado: str
 
+class FacturasBulkUpdate(BaseModel):
+    folios: List[str]
+    estado: str
+
+async def actualizar_estados(op_id: str, folios: List[str], estado: str, user: dict, repo, sin_folios: str) -> dict:
+    """
+    Admins actúan sobre cualquier operación; el resto solo sobre las que ingresó o
+    tiene asignadas. El permiso se evalúa dentro del UPDATE (ver update_invoice_states).
+    """
+    resultado = await repo.update_invoice_states(op_id, folios, estado, user['email'], user.get('role') == 'admin')
+    if not resultado["folios"]:
+        if resultado["motivo"] == "operacion":
+            raise HTTPException(status_code=404, detail="Operación no encontrada")
+        if resultado["motivo"] == "permiso":
+            raise HTTPException(status_code=403, detail="No tiene permisos para modificar esta operación")
+        raise HTTPException(status_code=404, detail=sin_folios)
+    return resultado
+
+@app.patch("/api/operaciones/{op_id}/facturas")
+async def actualizar_facturas_y_operacion(op_id: str, update_data: FacturasBulkUpdate, user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    """Cambia el estado de varias facturas de la operación en una sola sentencia."""
+    folios = list(dict.fromkeys(update_data.folios))
+    if not folios:
+        raise HTTPException(status_code=422, detail="Debe indicar al menos un folio")
+    resultado = await actualizar_estados(op_id, folios, update_data.estado, user, repo, "Facturas no encontradas")
+    actualizados = set(resultado["folios"])
+    return {
+        "folios": resultado["folios"],
+        "noEncontrados": [folio for folio in folios if folio not in actualizados],
+        "nuevoEstadoFactura": update_data.estado,
+        "nuevoEstadoOperacion": resultado["estado_operacion"],
+    }
+
 @app.patch("/api/operaciones/{op_id}/facturas/{folio}")
-async def actualizar_factura_y_operacion(op_id: str, folio: str, update_data: FacturaUpdate, db: Session = Depends(get_db)):
-    factura = db.query(models.Factura).filter(
-        models.Factura.id_operacion == op_id, models.Factura.numero_documento == folio
-    ).first()
-    if not factura:
-        raise HTTPException(status_code=404, detail="Factura no encontrada")
-    factura.estado = update_data.estado
-    operacion = db.query(models.Operacion).filter(models.Operacion.id == op_id).first()
-    facturas_de_operacion = operacion.facturas
-    if any(f.estado == 'Rechazada' for f in facturas_de_operacion):
-        operacion.estado = 'Discrepancia'
-    elif all(f.estado == 'Verificada' for f in facturas_de_operacion):
-        operacion.estado = 'pendiente'
-    else:
-        operacion.estado = 'En Verificación'
-    db.commit()
-    db.refresh(operacion)
-    return {"folio": folio, "nuevoEstadoFactura": factura.estado, "nuevoEstadoOperacion": operacion.estado}
+async def actualizar_factura_y_operacion(op_id: str, folio: str, update_data: FacturaUpdate, user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    resultado = await actualizar_estados(op_id, [folio], update_data.estado, user, repo, "Factura no encontrada")
+    return {"folio": folio, "nuevoEstadoFactura": update_data.estado, "nuevoEstadoOperacion": resultado["estado_operacion"]}
 
 class AdelantoJustificacion(BaseModel):
     justificacion: str
 
 @app.post("/api/operaciones/{op_id}/adelanto-express", status_code=status.HTTP_200_OK)
-async def mover_a_adelanto(op_id: str, data: AdelantoJustificacion, user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    operacion = db.query(models.Operacion).filter(models.Operacion.id == op_id).first()
+async def mover_a_adelanto(op_id: str, data: AdelantoJustificacion, user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    operacion = await repo.mark_adelanto_express(op_id, user['email'], data.justificacion)
     if not operacion:
         raise HTTPException(status_code=404, detail="Operación no encontrada")
-    operacion.adelanto_express = True
-    operacion.estado = 'Adelanto'
-    nueva_gestion = models.Gestion(
-        id_operacion=op_id, analista_email=user['email'], tipo="Adelanto Express",
-        resultado="Movido a cola de Adelanto", notas=data.justificacion
-    )
-    db.add(nueva_gestion)
-    db.commit()
-    db.refresh(operacion)
     return operacion
 
 @app.patch("/api/operaciones/{op_id}/completar", status_code=status.HTTP_200_OK)
-async def completar_operacion(op_id: str, user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    operacion = db.query(models.Operacion).filter(models.Operacion.id == op_id).first()
-    if not operacion:
+async def completar_operacion(op_id: str, user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    if not await repo.update_operation_fields(op_id, {"estado": 'Verificada'}):
         raise HTTPException(status_code=404, detail="Operación no encontrada")
-    operacion.estado = 'Verificada'
-    db.commit()
     return {"status": "ok", "message": f"Operación {op_id} marcada como completada."}
 
 @app.patch("/api/operaciones/{op_id}/assign", status_code=status.HTTP_200_OK)
-async def asignar_operacion(op_id: str, assignee_email: str, user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    operacion = db.query(models.Operacion).filter(models.Operacion.id == op_id).first()
-    if not operacion:
+async def asignar_operacion(op_id: str, assignee_email: str, user: dict = Depends(get_current_user), repo = Depends(get_repository)):
+    if not await repo.update_operation_fields(op_id, {"analista_asignado_email": assignee_email}):
         raise HTTPException(status_code=404, detail="Operación no encontrada")
-    operacion.analista_asignado_email = assignee_email
-    db.commit()
     return {"status": "ok", "message": f"Operación {op_id} asignada a {assignee_email}."}
 
 class SendVerificationRequest(BaseModel):
@@ -483,13 +717,11 @@ async def send_verification_emails(
     op_id: str, 
     request: SendVerificationRequest, 
     user: dict = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    repo = Depends(get_repository)
 ):
     """Envía correos de verificación manual para una operación específica"""
     # Verificar que la operación existe
-    operacion = db.query(models.Operacion).options(
-        selectinload(models.Operacion.facturas)
-    ).filter(models.Operacion.id == op_id).first()
+    operacion = await repo.get_operation_graph(op_id)
     
     if not operacion:
         raise HTTPException(status_code=404, detail="Operación no encontrada")
@@ -529,7 +761,8 @@ async def send_verification_emails(
         }
         
         # Llamar al servicio Gmail
-        response = requests.post(
+        response = await asyncio.to_thread(
+            requests.post,
             f"{GMAIL_SERVICE_URL}/send-email",
             json=gmail_payload,
             timeout=60
@@ -568,12 +801,12 @@ class UserSession(BaseModel):
     ultimo_ingreso: datetime | None = None
 
 @app.get("/api/users/me", response_model=UserSession)
-async def get_current_user_session(user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_current_user_session(user: dict = Depends(get_current_user), repo = Depends(get_repository)):
     """
     Devuelve los detalles del usuario autenticado, incluyendo su rol,
     basado en el token JWT proporcionado.
     """
-    user_in_db = db.query(models.Usuario).filter(models.Usuario.email == user['email']).first()
+    user_in_db = await repo.get_user(user['email'])
     
     if not user_in_db:
         raise HTTPException(status_code=404, detail="Usuario no encontrado en la base de datos.")
@@ -587,8 +820,8 @@ async def get_current_user_session(user: dict = Depends(get_current_user), db: S
 
 
 @app.get("/api/users/analysts")
-async def get_analyst_users(db: Session = Depends(get_db)):
+async def get_analyst_users(repo = Depends(get_repository)):
     roles_permitidos = ['gestion', 'admin']
     
-    analysts = db.query(models.Usuario).filter(models.Usuario.rol.in_(roles_permitidos)).all()
+    analysts = await repo.get_users_by_roles(roles_permitidos)
     return [{"email": u.email, "nombre": u.nombre} for u in analysts]
\ No newline at end of file
@@ -1,6 +1,6 @@
 # app/infrastructure/persistence/models.py
-from sqlalchemy import Column, String, Float, ForeignKey, Integer, DateTime, Text, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Float, ForeignKey, Integer, DateTime, Text, Boolean, Index, event, inspect
+from sqlalchemy.orm import relationship, Session
 from sqlalchemy.sql import func
 from database import Base
 from sqlalchemy.dialects.postgresql import JSONB
@@ -32,6 +32,10 @@ class Operacion(Base):
     estado = Column(String(50), default='En Verificación', nullable=False)
     adelanto_express = Column(Boolean, default=False, nullable=False)
     analista_asignado_email = Column(String(255), ForeignKey("usuarios.email"), nullable=True)
+    # Envío que originó la operación; un envío con varias monedas genera varias operaciones
+    tracking_id = Column(String(64), nullable=True, index=True)
+    # Se incrementa ante cualquier cambio en la operación, sus facturas o sus gestiones (ver _bump_operation_versions)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
 
     cliente = relationship("Empresa", back_populates="operaciones")
     gestiones = relationship("Gestion", back_populates="operacion")
@@ -90,3 +94,102 @@ class Gestion(Base):
     
     analista = relationship("Usuario")
 
+class SubmissionKey(Base):
+    """Idempotency-Key de /submit-operation: asocia la clave del cliente con su tracking_id y respuesta."""
+    __tablename__ = "submission_keys"
+    user_email = Column(String(255), primary_key=True)
+    idempotency_key = Column(String(255), primary_key=True)
+    tracking_id = Column(String(255), nullable=False)
+    request_hash = Column(String(64), nullable=False)
+    estado = Column(String(20), nullable=False, default='en_proceso', server_default='en_proceso')
+    response = Column(JSONB, nullable=True)
+    fecha_creacion = Column(DateTime(timezone=True), server_default=func.now())
+    fecha_actualizacion = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class OutboxMessage(Base):
+    """
+    Notificación pendiente (Trello, Gmail) escrita en la misma transacción que la
+    operación. services/outbox_dispatcher.py la entrega fuera del request.
+    """
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    idempotency_key = Column(String(255), unique=True, nullable=False)
+    destino = Column(String(50), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    estado = Column(String(20), nullable=False, default='pendiente', server_default='pendiente')
+    intentos = Column(Integer, nullable=False, default=0, server_default='0')
+    proximo_intento = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    ultimo_error = Column(Text, nullable=True)
+    fecha_creacion = Column(DateTime(timezone=True), server_default=func.now())
+    fecha_envio = Column(DateTime(timezone=True), nullable=True)
+    # Dueño del lease vigente: solo quien reclamó el mensaje puede registrar su resultado
+    lease_token = Column(String(32), nullable=True)
+
+    __table_args__ = (Index("ix_outbox_estado_proximo_intento", "estado", "proximo_intento"),)
+
+class OperationEvent(Base):
+    """
+    Transición de etapa de un envío (ver services/operation_events.py). Se
+    guarda para repetir el historial a quien se conecte tarde al stream SSE.
+    """
+    __tablename__ = "operation_events"
+    id = Column(Integer, primary_key=True)
+    tracking_id = Column(String(64), nullable=False, index=True)
+    etapa = Column(String(30), nullable=False)
+    detalle = Column(JSONB, nullable=True)
+    fecha_creacion = Column(DateTime(timezone=True), server_default=func.now())
+
+class OperationIdCounter(Base):
+    """Último correlativo OP-YYYYMMDD-NNN emitido por día (ver generar_siguiente_id_operacion)."""
+    __tablename__ = "operation_id_counters"
+    fecha = Column(String(8), primary_key=True)
+    ultimo = Column(Integer, nullable=False)
+
+
+# Cambios sobre tablas ya existentes: create_all no altera tablas creadas previamente
+SCHEMA_UPGRADES = [
+    "ALTER TABLE operaciones ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    "ALTER TABLE operaciones ADD COLUMN IF NOT EXISTS tracking_id VARCHAR(64)",
+    "CREATE INDEX IF NOT EXISTS ix_operaciones_tracking_id ON operaciones (tracking_id)",
+    "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS lease_token VARCHAR(32)",
+    # /api/search: varchar_pattern_ops para prefijos de RUC
+    "CREATE INDEX IF NOT EXISTS ix_empresas_ruc_prefix ON empresas (ruc varchar_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_operaciones_cliente_ruc_prefix ON operaciones (cliente_ruc varchar_pattern_ops)",
+]
+
+# /api/search: trigramas para búsquedas por subcadena y similitud. Requieren la extensión pg_trgm
+# (contrib y permisos para crearla), así que se aplican aparte: si fallan, la búsqueda usa solo ILIKE.
+OPTIONAL_SCHEMA_UPGRADES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_empresas_razon_social_trgm ON empresas USING gin (razon_social gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_facturas_numero_documento_trgm ON facturas USING gin (numero_documento gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_operaciones_id_trgm ON operaciones USING gin (id gin_trgm_ops)",
+]
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_operation_versions(session, flush_context):
+    """
+    Incrementa Operacion.version para toda operación cuyo registro, facturas o
+    gestiones se hayan insertado, modificado o eliminado en este flush.
+    Las operaciones recién creadas conservan la versión inicial.
+    """
+    nuevas = {obj.id for obj in session.new if isinstance(obj, Operacion)}
+    op_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        # Se lee el __dict__ de la instancia para no disparar cargas sobre filas ya eliminadas
+        valores = inspect(obj).dict
+        if isinstance(obj, Operacion):
+            if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+                continue
+            op_ids.add(valores.get("id"))
+        elif isinstance(obj, (Factura, Gestion)):
+            op_ids.add(valores.get("id_operacion"))
+    op_ids -= nuevas
+    op_ids.discard(None)
+    if op_ids:
+        session.connection().execute(
+            Operacion.__table__.update()
+            .where(Operacion.__table__.c.id.in_(op_ids))
+            .values(version=Operacion.__table__.c.version + 1)
+        )
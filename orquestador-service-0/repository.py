@@ -1,10 +1,27 @@
+import asyncio
 from sqlalchemy.orm import Session
-from typing import List, Dict, Any, Optional
-from sqlalchemy import case, func
+from typing import List, Dict, Any, Iterable, Optional
+from sqlalchemy import and_, case, func, literal, literal_column, or_, select, tuple_, update
+from sqlalchemy.exc import DBAPIError
 from datetime import datetime, timedelta, timezone
-from models import Gestion, Operacion, Factura, Empresa, Usuario 
+from models import Gestion, Operacion, Factura, Empresa, Usuario, OutboxMessage, SubmissionKey, OperationEvent
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy import text
-from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm import aliased, joinedload, selectinload
+
+# Los periodos de la analítica se cortan en la hora local del negocio
+ZONA_HORARIA_NEGOCIO = "America/Lima"
+PERIODOS_ANALITICA = ("day", "week", "month")
+
+# Se detecta una vez por proceso (ver models.OPTIONAL_SCHEMA_UPGRADES)
+_pg_trgm_disponible: Optional[bool] = None
+
+def _escape_like(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _puntaje_ilike(columna, q: str, prefijo: str):
+    """Puntaje sin pg_trgm: 1 si coincide exacto, 0.5 si empieza con q y 0.1 si solo lo contiene."""
+    return case((func.lower(columna) == q.lower(), 1.0), (columna.ilike(prefijo), 0.5), else_=0.1)
 
 class OperationRepository:
     def __init__(self, db: Session):
@@ -21,26 +38,31 @@ class OperationRepository:
 
     def generar_siguiente_id_operacion(self) -> str:
         """
-        Genera un ID de operación secuencial de forma segura, usando un bloqueo
-        de transacción para prevenir condiciones de carrera.
+        Genera un ID de operación secuencial de forma segura. El correlativo del
+        día se incrementa con un UPSERT atómico y se confirma de inmediato, así
+        el bloqueo de fila dura una sentencia y no todo el procesamiento del envío.
+        El primer ID del día parte del máximo ya existente en operaciones.
         """
         today_str = datetime.now(timezone.utc).strftime('%Y%m%d')
         id_prefix = f"OP-{today_str}-"
-        
-        self.db.execute(text("LOCK TABLE operaciones IN EXCLUSIVE MODE"))
-        
-        last_id_today = self.db.query(func.max(Operacion.id)).filter(Operacion.id.like(f"{id_prefix}%")).scalar()
-        
-        next_number = 1
-        if last_id_today:
-            try:
-                next_number = int(last_id_today.split('-')[-1]) + 1
-            except (ValueError, IndexError):
-                next_number = 1
-                
+
+        next_number = self.db.execute(text("""
+            INSERT INTO operation_id_counters (fecha, ultimo)
+            VALUES (:fecha, COALESCE((
+                SELECT max(substring(id from '([0-9]+)$')::int) FROM operaciones WHERE id LIKE :prefijo
+            ), 0) + 1)
+            ON CONFLICT (fecha) DO UPDATE SET ultimo = operation_id_counters.ultimo + 1
+            RETURNING ultimo
+        """), {"fecha": today_str, "prefijo": f"{id_prefix}%"}).scalar_one()
+        self.db.commit()
+
         return f"{id_prefix}{next_number:03d}"
 
-    def save_full_operation(self, operation_id: str, metadata: dict, drive_url: str, invoices_data: List[Dict], cavali_results_map: Dict) -> str: 
+    def save_full_operation(self, operation_id: str, metadata: dict, drive_url: str, invoices_data: List[Dict], cavali_results_map: Dict, notificaciones: Optional[List[Dict]] = None, tracking_id: Optional[str] = None) -> str: 
+        """
+        Guarda la operación con sus facturas. Las `notificaciones` ({destino, idempotency_key, payload})
+        se escriben en la tabla outbox dentro de la misma transacción.
+        """
         if not invoices_data:
             raise ValueError("No se puede guardar una operación sin datos de facturas.")
 
@@ -76,7 +98,8 @@ class OperationRepository:
             desembolso_banco = cuenta_principal.get('banco'),
             desembolso_tipo = cuenta_principal.get('tipo'),
             desembolso_moneda = cuenta_principal.get('moneda'),
-            desembolso_numero = cuenta_principal.get('numero')
+            desembolso_numero = cuenta_principal.get('numero'),
+            tracking_id=tracking_id
         )
         self.db.add(db_operacion)
         
@@ -97,6 +120,13 @@ class OperationRepository:
                 id_proceso_cavali=cavali_data.get("process_id") 
             )
             self.db.add(db_factura)
+
+        for notificacion in notificaciones or []:
+            self.db.add(OutboxMessage(
+                idempotency_key=notificacion['idempotency_key'],
+                destino=notificacion['destino'],
+                payload=notificacion['payload']
+            ))
             
         self.db.commit()
         return operation_id
@@ -117,15 +147,9 @@ class OperationRepository:
 
         count_query = self.db.query(func.count(Operacion.id)).join(Empresa, Operacion.cliente_ruc == Empresa.ruc)
 
-        # Aplicar filtros de rol
-        if user_role != 'admin':
-            base_query = base_query.filter(Operacion.email_usuario == user_email)
-            count_query = count_query.filter(Operacion.email_usuario == user_email)
-
-        # Aplicar filtro por estado si se proporciona
-        if estado_filter:
-            base_query = base_query.filter(Operacion.estado == estado_filter)
-            count_query = count_query.filter(Operacion.estado == estado_filter)
+        # Aplicar filtros de rol y estado
+        base_query = self._filter_dashboard(base_query, user_email, user_role, estado_filter)
+        count_query = self._filter_dashboard(count_query, user_email, user_role, estado_filter)
 
         query = base_query
 
@@ -148,6 +172,344 @@ class OperationRepository:
         ]
 
         return {"operations": operations_list, "total": total_records}
+
+    def _filter_dashboard(self, query, user_email: str, user_role: str, estado_filter: Optional[str]):
+        """Aplica al query los filtros de rol (ventas solo ve lo suyo) y de estado del dashboard."""
+        if user_role != 'admin':
+            query = query.filter(Operacion.email_usuario == user_email)
+        if estado_filter:
+            query = query.filter(Operacion.estado == estado_filter)
+        return query
+
+    def get_dashboard_fingerprint(self, user_email: str, user_role: str, estado_filter: Optional[str] = None) -> tuple:
+        """
+        Resume en una sola consulta agregada las operaciones visibles con el filtro dado:
+        (total, versión máxima, suma de versiones, última fecha de creación).
+        Cambia ante cualquier alta, baja o modificación dentro del filtro.
+        """
+        query = self.db.query(
+            func.count(Operacion.id), func.max(Operacion.version),
+            func.coalesce(func.sum(Operacion.version), 0), func.max(Operacion.fecha_creacion)
+        )
+        return tuple(self._filter_dashboard(query, user_email, user_role, estado_filter).one())
+
+    def iter_export_rows(self, user_email: str, user_role: str, estado_filter: Optional[str] = None,
+                         desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                         batch_size: int = 1000) -> Iterable:
+        """
+        Recorre una fila por factura (con los datos de su operación, cliente y deudor)
+        con un cursor del lado del servidor: en memoria solo hay `batch_size` filas a la vez.
+        Aplica los mismos filtros de rol y estado que el dashboard.
+        """
+        Deudor = aliased(Empresa)
+        query = self.db.query(
+            Operacion.id.label("operacion"), Operacion.fecha_creacion.label("fecha_ingreso"),
+            Operacion.cliente_ruc, Empresa.razon_social.label("cliente"),
+            Operacion.estado.label("estado_operacion"), Operacion.email_usuario,
+            Operacion.tasa_operacion, Operacion.comision,
+            Factura.numero_documento.label("folio"), Factura.deudor_ruc, Deudor.razon_social.label("deudor"),
+            Factura.fecha_emision, Factura.fecha_vencimiento, Factura.moneda,
+            Factura.monto_total, Factura.monto_neto, Factura.estado.label("estado_factura"),
+        ).join(Empresa, Operacion.cliente_ruc == Empresa.ruc).join(
+            Factura, Factura.id_operacion == Operacion.id
+        ).outerjoin(Deudor, Factura.deudor_ruc == Deudor.ruc)
+
+        query = self._filter_dashboard(query, user_email, user_role, estado_filter)
+        if desde:
+            query = query.filter(Operacion.fecha_creacion >= desde)
+        if hasta:
+            query = query.filter(Operacion.fecha_creacion < hasta)
+
+        query = query.order_by(Operacion.fecha_creacion, Operacion.id, Factura.id)
+        return query.execution_options(stream_results=True, yield_per=batch_size)
+
+    def get_portfolio_rollup(self, user_email: str, user_role: str, dimension: str, periodo: Optional[str] = None,
+                             desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                             estado_filter: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Totales de cartera por moneda y `dimension` (estado, deudor o ejecutivo) con
+        GROUP BY ROLLUP: filas de detalle, subtotal por moneda y total general. Con
+        `periodo` (day/week/month, hora de Lima) los totales se separan por periodo.
+        Los montos del total general quedan en None porque mezclarían monedas.
+        """
+        Deudor = aliased(Empresa)
+        dimensiones = {
+            "moneda": [],
+            "estado": [Operacion.estado],
+            "deudor": [Factura.deudor_ruc, Deudor.razon_social],
+            "ejecutivo": [Operacion.email_usuario],
+        }
+        columnas_dimension = dimensiones[dimension]
+        agrupacion = [Factura.moneda] + ([tuple_(*columnas_dimension)] if columnas_dimension else [])
+        if periodo and periodo not in PERIODOS_ANALITICA:
+            raise ValueError(f"Periodo no soportado: {periodo}")
+        # Literales en el SQL (no parámetros): la misma expresión debe aparecer en SELECT y GROUP BY
+        bucket = (
+            func.date_trunc(literal_column(f"'{periodo}'"), func.timezone(literal_column(f"'{ZONA_HORARIA_NEGOCIO}'"), Operacion.fecha_creacion))
+            if periodo else literal(None)
+        )
+        clave = columnas_dimension[0] if columnas_dimension else literal(None)
+        nombre = columnas_dimension[1] if len(columnas_dimension) > 1 else literal(None)
+
+        query = self.db.query(
+            bucket.label("periodo"),
+            Factura.moneda.label("moneda"),
+            clave.label("clave"),
+            nombre.label("nombre"),
+            func.grouping(Factura.moneda).label("sin_moneda"),
+            (func.grouping(clave) if columnas_dimension else literal(1)).label("sin_clave"),
+            func.count(func.distinct(Operacion.id)).label("operaciones"),
+            func.count(Factura.id).label("facturas"),
+            func.coalesce(func.sum(Factura.monto_total), 0).label("monto_total"),
+            func.coalesce(func.sum(Factura.monto_neto), 0).label("monto_neto"),
+        ).join(Factura, Factura.id_operacion == Operacion.id)
+        if dimension == "deudor":
+            query = query.outerjoin(Deudor, Factura.deudor_ruc == Deudor.ruc)
+
+        query = self._filter_dashboard(query, user_email, user_role, estado_filter)
+        if desde:
+            query = query.filter(Operacion.fecha_creacion >= desde)
+        if hasta:
+            query = query.filter(Operacion.fecha_creacion < hasta)
+
+        # Por periodo; dentro de cada uno, monedas con su subtotal al final y el total general último
+        orden = [func.grouping(Factura.moneda), Factura.moneda]
+        if columnas_dimension:
+            orden += [func.grouping(clave), func.sum(Factura.monto_total).desc()]
+        if periodo:
+            query = query.group_by(bucket, func.rollup(*agrupacion)).order_by(bucket, *orden)
+        else:
+            query = query.group_by(func.rollup(*agrupacion)).order_by(*orden)
+
+        filas = []
+        for r in query.all():
+            if r.sin_moneda:
+                nivel = "total"
+            elif r.sin_clave and columnas_dimension:
+                nivel = "subtotal_moneda"
+            else:
+                nivel = "detalle"
+            filas.append({
+                "periodo": r.periodo.date().isoformat() if r.periodo else None,
+                "nivel": nivel,
+                "moneda": r.moneda,
+                "clave": r.clave if nivel == "detalle" else None,
+                "nombre": r.nombre if nivel == "detalle" else None,
+                "operaciones": r.operaciones,
+                "facturas": r.facturas,
+                "montoTotal": None if nivel == "total" else float(r.monto_total),
+                "montoNeto": None if nivel == "total" else float(r.monto_neto),
+            })
+        return filas
+
+    def search(self, q: str, user_email: str, user_role: str, limit: int = 10, timeout_ms: int = 200) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Busca operaciones (por ID o prefijo de RUC del cliente), facturas (por folio)
+        y empresas (por razón social o prefijo de RUC), ordenadas por similitud de
+        trigramas. Cada consulta usa un índice GIN de pg_trgm o uno varchar_pattern_ops
+        (ver models.SCHEMA_UPGRADES) y corre con statement_timeout; si se excede,
+        lanza TimeoutError. Ventas solo ve sus operaciones y los clientes de ellas.
+        Sin la extensión pg_trgm filtra igual con ILIKE y ordena por _puntaje_ilike.
+        """
+        global _pg_trgm_disponible
+        patron = f"%{_escape_like(q)}%"
+        prefijo = f"{_escape_like(q)}%"
+        es_ruc = q.isdigit()
+        try:
+            if _pg_trgm_disponible is None:
+                _pg_trgm_disponible = self.db.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+            if _pg_trgm_disponible:
+                puntaje_op = func.similarity(Operacion.id, q)
+                puntaje_factura = func.similarity(Factura.numero_documento, q)
+            else:
+                puntaje_op = _puntaje_ilike(Operacion.id, q, prefijo)
+                puntaje_factura = _puntaje_ilike(Factura.numero_documento, q, prefijo)
+            self.db.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+
+            ops_query = self.db.query(
+                Operacion.id, Operacion.fecha_creacion, Operacion.estado, Operacion.cliente_ruc,
+                Empresa.razon_social.label("cliente"),
+                puntaje_op.label("score"),
+            ).join(Empresa, Operacion.cliente_ruc == Empresa.ruc)
+            if es_ruc:
+                ops_query = ops_query.filter(or_(Operacion.cliente_ruc.like(prefijo), Operacion.id.ilike(patron)))
+            else:
+                ops_query = ops_query.filter(Operacion.id.ilike(patron))
+            ops_query = self._filter_dashboard(ops_query, user_email, user_role, None)
+            operaciones = ops_query.order_by(puntaje_op.desc(), Operacion.fecha_creacion.desc()).limit(limit).all()
+
+            facturas_query = self.db.query(
+                Factura.numero_documento, Factura.id_operacion, Factura.moneda, Factura.monto_total, Factura.estado,
+                puntaje_factura.label("score"),
+            ).join(Operacion, Factura.id_operacion == Operacion.id).filter(Factura.numero_documento.ilike(patron))
+            facturas_query = self._filter_dashboard(facturas_query, user_email, user_role, None)
+            facturas = facturas_query.order_by(puntaje_factura.desc(), Factura.id.desc()).limit(limit).all()
+
+            if es_ruc:
+                empresas_query = self.db.query(Empresa.ruc, Empresa.razon_social, literal(1.0).label("score")).filter(
+                    Empresa.ruc.like(prefijo)
+                ).order_by(Empresa.ruc)
+            else:
+                # Cada palabra como subcadena, en cualquier orden ("express capital" encuentra "CAPITAL EXPRESS S.A.C.").
+                # No se usa el operador `%>`: el dialecto pg8000 no escapa el `%` de operadores propios.
+                if _pg_trgm_disponible:
+                    puntaje = func.word_similarity(q, Empresa.razon_social)
+                else:
+                    puntaje = _puntaje_ilike(Empresa.razon_social, q, prefijo)
+                empresas_query = self.db.query(Empresa.ruc, Empresa.razon_social, puntaje.label("score")).filter(
+                    *[Empresa.razon_social.ilike(f"%{_escape_like(palabra)}%") for palabra in q.split()]
+                ).order_by(puntaje.desc(), Empresa.razon_social)
+            if user_role != 'admin':
+                empresas_query = empresas_query.filter(Empresa.operaciones.any(Operacion.email_usuario == user_email))
+            empresas = empresas_query.limit(limit).all()
+        except DBAPIError as e:
+            self.db.rollback()
+            if "statement timeout" in str(e.orig):
+                raise TimeoutError(f"La búsqueda excedió {timeout_ms} ms") from e
+            raise
+        self.db.rollback()
+
+        return {
+            "operaciones": [{
+                "id": r.id, "fechaIngreso": r.fecha_creacion.isoformat() if r.fecha_creacion else None,
+                "estado": r.estado, "clienteRuc": r.cliente_ruc, "cliente": r.cliente, "score": float(r.score),
+            } for r in operaciones],
+            "facturas": [{
+                "folio": r.numero_documento, "operacion": r.id_operacion, "moneda": r.moneda,
+                "monto": r.monto_total, "estado": r.estado, "score": float(r.score),
+            } for r in facturas],
+            "empresas": [{"ruc": r.ruc, "razonSocial": r.razon_social, "score": float(r.score)} for r in empresas],
+        }
+
+    def get_operation_graph(self, op_id: str) -> Optional[Operacion]:
+        """Carga la operación con cliente, facturas (con deudor) y gestiones (con analista)."""
+        return self.db.query(Operacion).options(
+            joinedload(Operacion.cliente),
+            selectinload(Operacion.facturas).joinedload(Factura.deudor),
+            selectinload(Operacion.gestiones).joinedload(Gestion.analista)
+        ).filter(Operacion.id == op_id).first()
+
+    def get_operations_by_tracking_id(self, tracking_id: str) -> List[Operacion]:
+        """Operaciones creadas por un envío (una por moneda), vía el índice de tracking_id."""
+        return self.db.query(Operacion).filter(Operacion.tracking_id == tracking_id).order_by(Operacion.id).all()
+
+    def get_last_event(self, tracking_id: str) -> Optional[OperationEvent]:
+        """Última etapa registrada de un envío (índice de operation_events.tracking_id)."""
+        return self.db.query(OperationEvent).filter(
+            OperationEvent.tracking_id == tracking_id
+        ).order_by(OperationEvent.id.desc()).first()
+
+    def tracking_id_in_use(self, tracking_id: str, user_email: str, idempotency_key: Optional[str] = None) -> bool:
+        """
+        Indica si un tracking_id elegido por el cliente ya pertenece a otro envío:
+        tiene operaciones, etapas registradas o una Idempotency-Key distinta. El
+        reintento de la misma Idempotency-Key con su mismo tracking_id no cuenta.
+        """
+        claves = select(SubmissionKey.tracking_id).where(SubmissionKey.tracking_id == tracking_id)
+        usado = or_(
+            select(Operacion.id).where(Operacion.tracking_id == tracking_id).exists(),
+            select(OperationEvent.id).where(OperationEvent.tracking_id == tracking_id).exists(),
+        )
+        if idempotency_key:
+            propia = and_(SubmissionKey.user_email == user_email, SubmissionKey.idempotency_key == idempotency_key)
+            usado = or_(and_(usado, ~claves.where(propia).exists()), claves.where(~propia).exists())
+        else:
+            usado = or_(usado, claves.exists())
+        return bool(self.db.execute(select(usado)).scalar())
+
+    def update_invoice_states(self, op_id: str, folios: List[str], estado: str, user_email: str, is_admin: bool) -> Dict[str, Any]:
+        """
+        Cambia el estado de varias facturas de una operación y recalcula el estado
+        de la operación con una agregación en SQL: dos sentencias sin importar
+        cuántas facturas se toquen. El permiso (admin, quien ingresó la operación o
+        su analista asignado) va en el WHERE del primer UPDATE. Devuelve los folios
+        actualizados y el nuevo estado de la operación; si no se actualizó nada,
+        "motivo" indica por qué: 'operacion' (no existe), 'permiso' o 'folios'.
+        """
+        facturas = Factura.__table__
+        operaciones = Operacion.__table__
+        acceso = select(operaciones.c.id).where(operaciones.c.id == op_id)
+        if not is_admin:
+            acceso = acceso.where(or_(operaciones.c.email_usuario == user_email, operaciones.c.analista_asignado_email == user_email))
+        actualizados = self.db.execute(
+            update(facturas)
+            .where(facturas.c.id_operacion == op_id, facturas.c.numero_documento.in_(folios), acceso.exists())
+            .values(estado=estado)
+            .returning(facturas.c.numero_documento)
+        ).scalars().all()
+        if not actualizados:
+            self.db.rollback()
+            # Solo en el caso de error se consulta la operación para distinguir 404 de 403
+            cabecera = self.db.query(Operacion.email_usuario, Operacion.analista_asignado_email).filter(Operacion.id == op_id).first()
+            if cabecera is None:
+                motivo = "operacion"
+            elif not is_admin and user_email not in (cabecera.email_usuario, cabecera.analista_asignado_email):
+                motivo = "permiso"
+            else:
+                motivo = "folios"
+            return {"folios": [], "estado_operacion": None, "motivo": motivo}
+
+        # Alguna rechazada -> Discrepancia; todas verificadas -> pendiente; si no, sigue en verificación
+        estado_calculado = select(case(
+            (func.bool_or(facturas.c.estado == 'Rechazada'), 'Discrepancia'),
+            (func.bool_and(facturas.c.estado == 'Verificada'), 'pendiente'),
+            else_='En Verificación',
+        )).where(facturas.c.id_operacion == op_id).scalar_subquery()
+        # Las sentencias Core no pasan por el after_flush que versiona: se incrementa aquí
+        estado_operacion = self.db.execute(
+            update(operaciones)
+            .where(operaciones.c.id == op_id)
+            .values(estado=estado_calculado, version=operaciones.c.version + 1)
+            .returning(operaciones.c.estado)
+        ).scalar_one()
+        self.db.commit()
+        return {"folios": actualizados, "estado_operacion": estado_operacion}
+
+    def get_operation_version(self, op_id: str):
+        """Devuelve (version, email_usuario) de la operación sin cargar facturas ni gestiones."""
+        return self.db.query(Operacion.version, Operacion.email_usuario).filter(Operacion.id == op_id).first()
+
+    def add_gestion(self, op_id: str, analista_email: str, datos: Dict[str, Any]) -> Optional[Gestion]:
+        """Registra una gestión en la operación. Devuelve None si la operación no existe."""
+        if not self.db.query(Operacion.id).filter(Operacion.id == op_id).first():
+            return None
+        gestion = Gestion(id_operacion=op_id, analista_email=analista_email, **datos)
+        self.db.add(gestion)
+        self.db.commit()
+        self.db.refresh(gestion)
+        return gestion
+
+    def get_gestion(self, gestion_id: int) -> Optional[Gestion]:
+        return self.db.query(Gestion).filter(Gestion.id == gestion_id).first()
+
+    def delete_gestion(self, gestion: Gestion) -> None:
+        self.db.delete(gestion)
+        self.db.commit()
+
+    def mark_adelanto_express(self, op_id: str, analista_email: str, justificacion: str) -> Optional[Operacion]:
+        """Pasa la operación a la cola de Adelanto y deja la justificación como gestión. None si no existe."""
+        operacion = self.db.query(Operacion).filter(Operacion.id == op_id).first()
+        if not operacion:
+            return None
+        operacion.adelanto_express = True
+        operacion.estado = 'Adelanto'
+        self.db.add(Gestion(
+            id_operacion=op_id, analista_email=analista_email, tipo="Adelanto Express",
+            resultado="Movido a cola de Adelanto", notas=justificacion
+        ))
+        self.db.commit()
+        self.db.refresh(operacion)
+        return operacion
+
+    def update_operation_fields(self, op_id: str, valores: Dict[str, Any]) -> bool:
+        """Actualiza columnas de la operación (por ORM, así se versiona). False si no existe."""
+        operacion = self.db.query(Operacion).filter(Operacion.id == op_id).first()
+        if not operacion:
+            return False
+        for campo, valor in valores.items():
+            setattr(operacion, campo, valor)
+        self.db.commit()
+        return True
     
     
     def get_gestiones_operations(self, user_email: str, user_role: str) -> List[Operacion]:
@@ -192,6 +554,58 @@ class OperationRepository:
         self.db.commit()
         return previous_login
     
+    def get_user(self, email: str) -> Optional[Usuario]:
+        return self.db.query(Usuario).filter(Usuario.email == email).first()
+
+    def get_or_create_user(self, email: str, name: str) -> Usuario:
+        """Devuelve el usuario; si no existe lo registra con su primer ingreso."""
+        usuario = self.get_user(email)
+        if not usuario:
+            self.update_and_get_last_login(email, name)
+            usuario = self.get_user(email)
+        return usuario
+
+    def get_users_by_roles(self, roles: List[str]) -> List[Usuario]:
+        return self.db.query(Usuario).filter(Usuario.rol.in_(roles)).all()
+
+    def claim_submission_key(self, user_email: str, key: str, tracking_id: str, request_hash: str, stale_after_seconds: int):
+        """
+        Intenta reclamar una Idempotency-Key para procesar un envío.
+        Devuelve (registro, reclamado). Se puede reclamar una clave nueva, una cuyo
+        procesamiento falló, o una 'en_proceso' abandonada hace más de stale_after_seconds.
+        """
+        insertado = self.db.execute(
+            pg_insert(SubmissionKey).values(
+                user_email=user_email, idempotency_key=key, tracking_id=tracking_id, request_hash=request_hash
+            ).on_conflict_do_nothing().returning(SubmissionKey.tracking_id)
+        ).first()
+        if insertado:
+            self.db.commit()
+            return self.db.get(SubmissionKey, (user_email, key)), True
+
+        registro = self.db.query(SubmissionKey).filter(
+            SubmissionKey.user_email == user_email, SubmissionKey.idempotency_key == key
+        ).with_for_update().one()
+        abandonado = (
+            registro.estado == 'en_proceso'
+            and registro.fecha_actualizacion < datetime.now(timezone.utc) - timedelta(seconds=stale_after_seconds)
+        )
+        reclamado = registro.request_hash == request_hash and (registro.estado == 'fallido' or abandonado)
+        if reclamado:
+            registro.estado = 'en_proceso'
+            registro.tracking_id = tracking_id
+            registro.response = None
+            registro.fecha_actualizacion = datetime.now(timezone.utc)
+        self.db.commit()
+        return registro, reclamado
+
+    def finish_submission_key(self, user_email: str, key: str, estado: str, response: Optional[Dict] = None):
+        """Marca la clave como 'completado' (guardando la respuesta) o 'fallido'."""
+        self.db.query(SubmissionKey).filter(
+            SubmissionKey.user_email == user_email, SubmissionKey.idempotency_key == key
+        ).update({"estado": estado, "response": response, "fecha_actualizacion": datetime.now(timezone.utc)})
+        self.db.commit()
+
     def check_duplicate_invoices(self, invoices_data: List[Dict]) -> Dict[str, Any]:
         """
         Verifica si alguna factura ya existe basándose en:
@@ -229,4 +643,106 @@ class OperationRepository:
             'duplicates': duplicates,
             'new_invoices': new_invoices,
             'has_duplicates': len(duplicates) > 0
-        }
\ No newline at end of file
+        }
+
+
+class _AsyncRepositoryInterface:
+    """
+    Métodos de OperationRepository disponibles como corrutinas. Cada uno se
+    declara aquí: usar uno que no tenga envoltorio falla con AttributeError en
+    lugar de ejecutar la consulta en el event loop.
+    """
+    async def _call(self, metodo, *args, **kwargs):
+        raise NotImplementedError
+
+    async def generar_siguiente_id_operacion(self) -> str:
+        return await self._call(OperationRepository.generar_siguiente_id_operacion)
+
+    async def get_dashboard_operations(self, user_email: str, user_role: str, offset: int = 0, limit: int = 20, estado_filter: Optional[str] = None) -> Dict[str, Any]:
+        return await self._call(OperationRepository.get_dashboard_operations, user_email, user_role, offset, limit, estado_filter)
+
+    async def get_dashboard_fingerprint(self, user_email: str, user_role: str, estado_filter: Optional[str] = None) -> tuple:
+        return await self._call(OperationRepository.get_dashboard_fingerprint, user_email, user_role, estado_filter)
+
+    async def get_portfolio_rollup(self, user_email: str, user_role: str, dimension: str, periodo: Optional[str] = None,
+                                   desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                                   estado_filter: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await self._call(OperationRepository.get_portfolio_rollup, user_email, user_role, dimension, periodo, desde, hasta, estado_filter)
+
+    async def search(self, q: str, user_email: str, user_role: str, limit: int = 10, timeout_ms: int = 200) -> Dict[str, List[Dict[str, Any]]]:
+        return await self._call(OperationRepository.search, q, user_email, user_role, limit, timeout_ms)
+
+    async def get_operation_graph(self, op_id: str) -> Optional[Operacion]:
+        return await self._call(OperationRepository.get_operation_graph, op_id)
+
+    async def get_operations_by_tracking_id(self, tracking_id: str) -> List[Operacion]:
+        return await self._call(OperationRepository.get_operations_by_tracking_id, tracking_id)
+
+    async def get_last_event(self, tracking_id: str) -> Optional[OperationEvent]:
+        return await self._call(OperationRepository.get_last_event, tracking_id)
+
+    async def tracking_id_in_use(self, tracking_id: str, user_email: str, idempotency_key: Optional[str] = None) -> bool:
+        return await self._call(OperationRepository.tracking_id_in_use, tracking_id, user_email, idempotency_key)
+
+    async def update_invoice_states(self, op_id: str, folios: List[str], estado: str, user_email: str, is_admin: bool) -> Dict[str, Any]:
+        return await self._call(OperationRepository.update_invoice_states, op_id, folios, estado, user_email, is_admin)
+
+    async def get_operation_version(self, op_id: str):
+        return await self._call(OperationRepository.get_operation_version, op_id)
+
+    async def add_gestion(self, op_id: str, analista_email: str, datos: Dict[str, Any]) -> Optional[Gestion]:
+        return await self._call(OperationRepository.add_gestion, op_id, analista_email, datos)
+
+    async def get_gestion(self, gestion_id: int) -> Optional[Gestion]:
+        return await self._call(OperationRepository.get_gestion, gestion_id)
+
+    async def delete_gestion(self, gestion: Gestion) -> None:
+        return await self._call(OperationRepository.delete_gestion, gestion)
+
+    async def mark_adelanto_express(self, op_id: str, analista_email: str, justificacion: str) -> Optional[Operacion]:
+        return await self._call(OperationRepository.mark_adelanto_express, op_id, analista_email, justificacion)
+
+    async def update_operation_fields(self, op_id: str, valores: Dict[str, Any]) -> bool:
+        return await self._call(OperationRepository.update_operation_fields, op_id, valores)
+
+    async def get_gestiones_operations(self, user_email: str, user_role: str) -> List[Operacion]:
+        return await self._call(OperationRepository.get_gestiones_operations, user_email, user_role)
+
+    async def update_and_get_last_login(self, email: str, name: str) -> Optional[datetime]:
+        return await self._call(OperationRepository.update_and_get_last_login, email, name)
+
+    async def get_user(self, email: str) -> Optional[Usuario]:
+        return await self._call(OperationRepository.get_user, email)
+
+    async def get_or_create_user(self, email: str, name: str) -> Usuario:
+        return await self._call(OperationRepository.get_or_create_user, email, name)
+
+    async def get_users_by_roles(self, roles: List[str]) -> List[Usuario]:
+        return await self._call(OperationRepository.get_users_by_roles, roles)
+
+
+class AsyncOperationRepository(_AsyncRepositoryInterface):
+    """
+    Variante asíncrona de OperationRepository sobre una AsyncSession (asyncpg).
+    Cada método se ejecuta con AsyncSession.run_sync sobre el código de
+    consulta existente, por lo que la E/S no bloquea el event loop.
+    Los resultados solo deben usar relaciones cargadas de forma anticipada.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    async def _call(self, metodo, *args, **kwargs):
+        return await self.db.run_sync(lambda session: metodo(OperationRepository(session), *args, **kwargs))
+
+
+class ThreadedOperationRepository(_AsyncRepositoryInterface):
+    """
+    Misma interfaz asíncrona que AsyncOperationRepository, pero sobre una Session
+    síncrona: cada llamada se ejecuta en un hilo para no bloquear el event loop.
+    """
+    def __init__(self, db: Session):
+        self.db = db
+        self._repo = OperationRepository(db)
+
+    async def _call(self, metodo, *args, **kwargs):
+        return await asyncio.to_thread(metodo, self._repo, *args, **kwargs)
@@ -7,6 +7,7 @@ import base64
 from core.dependencies import get_current_user
 from database import get_db
 from services.operation_service import operation_service
+from repository import OperationRepository
 import models
 
 router = APIRouter(prefix="/operations", tags=["operations"])
@@ -67,13 +68,14 @@ async def get_operation_status(tracking_id: str, db: Session = Depends(get_db)):
         }
     
     # Buscar en operaciones finalizadas
-    operation = db.query(models.Operacion).filter(models.Operacion.id.contains(tracking_id)).first()
-    if operation:
+    operaciones = OperationRepository(db).get_operations_by_tracking_id(tracking_id)
+    if operaciones:
         return {
             "status": "completed",
             "tracking_id": tracking_id,
-            "operation_id": operation.id,
-            "estado": operation.estado
+            "operation_id": operaciones[0].id,
+            "operation_ids": [op.id for op in operaciones],
+            "estado": operaciones[0].estado
         }
     
     return {"status": "not_found", "tracking_id": tracking_id}
\ No newline at end of file
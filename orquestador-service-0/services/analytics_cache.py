@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from core.config import config
+
+class AnalyticsCache:
+    """
+    Caché en memoria (LRU con TTL) para los resultados de /api/analytics/portfolio.
+
+    Cada entrada guarda la huella de la base con la que se calculó
+    (OperationRepository.get_dashboard_fingerprint). Cualquier alta, baja o
+    cambio de una operación, sus facturas o sus gestiones cambia la huella, así
+    que una escritura hecha desde cualquier instancia invalida la entrada en la
+    siguiente lectura. El TTL solo acota cuánto vive una entrada sin consultarse.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entradas: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, fingerprint: tuple) -> Optional[Any]:
+        entrada = self._entradas.get(key)
+        if entrada is None:
+            return None
+        huella, expira, valor = entrada
+        if huella != fingerprint or time.monotonic() >= expira:
+            del self._entradas[key]
+            return None
+        self._entradas.move_to_end(key)
+        return valor
+
+    def put(self, key: Hashable, fingerprint: tuple, value: Any):
+        self._entradas[key] = (fingerprint, time.monotonic() + self.ttl_seconds, value)
+        self._entradas.move_to_end(key)
+        while len(self._entradas) > self.max_entries:
+            self._entradas.popitem(last=False)
+
+    def clear(self):
+        self._entradas.clear()
+
+# Singleton instance
+analytics_cache = AnalyticsCache(config.ANALYTICS_CACHE_TTL_SECONDS, config.ANALYTICS_CACHE_MAX_ENTRIES)
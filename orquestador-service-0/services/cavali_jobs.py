@@ -0,0 +1,50 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+# Cuánto se guarda un callback que llegó antes de que se registrara su espera
+ORPHAN_TTL_SECONDS = 120
+
+class CavaliJobWaiter:
+    """
+    Esperas en curso de trabajos de validación de Cavali (POST /validate-jobs).
+
+    MicroserviceClient registra el job_id y espera su futuro; el endpoint
+    /operations/cavali-callback lo resuelve cuando Cavali avisa que terminó.
+    Si el callback llega a otra instancia (o no llega), la espera lo nota al
+    consultar GET /validate-jobs/{id} en cada intervalo de sondeo.
+    """
+
+    def __init__(self):
+        self._esperas: Dict[str, asyncio.Future] = {}
+        self._huerfanos: Dict[str, Tuple[float, dict]] = {}
+
+    def register(self, job_id: str) -> asyncio.Future:
+        futuro = asyncio.get_running_loop().create_future()
+        huerfano = self._huerfanos.pop(job_id, None)
+        if huerfano is not None:
+            futuro.set_result(huerfano[1])
+        self._esperas[job_id] = futuro
+        return futuro
+
+    def resolve(self, job_id: str, estado: dict) -> bool:
+        """Entrega el estado final a quien espera el trabajo; devuelve False si nadie lo espera en esta instancia."""
+        futuro = self._esperas.get(job_id)
+        if futuro is None:
+            self._purgar_huerfanos()
+            self._huerfanos[job_id] = (time.monotonic(), estado)
+            return False
+        if not futuro.done():
+            futuro.set_result(estado)
+        return True
+
+    def discard(self, job_id: str):
+        self._esperas.pop(job_id, None)
+
+    def _purgar_huerfanos(self):
+        limite = time.monotonic() - ORPHAN_TTL_SECONDS
+        for job_id in [j for j, (llegada, _) in self._huerfanos.items() if llegada < limite]:
+            del self._huerfanos[job_id]
+
+# Singleton instance
+cavali_job_waiter = CavaliJobWaiter()
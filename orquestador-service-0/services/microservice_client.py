@@ -1,8 +1,20 @@
 import requests
 import logging
 import asyncio
+import time
 from typing import Dict, Optional
 from core.config import config
+from core.metrics import track_call
+from core.resilience import build_guards
+from services.cavali_jobs import cavali_job_waiter
+import tracing
+
+# Timeout máximo por servicio; el efectivo se adapta al p99 observado (core/resilience.py)
+MAX_TIMEOUTS = {"parser": 300, "cavali": 600, "drive": 30, "gmail": 30, "trello": 30}
+
+def _timeout_por_xml(operation_data: dict, seconds_per_xml: float) -> float:
+    """Piso del timeout proporcional a los XML: una operación grande no hereda el timeout de las chicas."""
+    return seconds_per_xml * len((operation_data.get("gcs_paths") or {}).get("xml") or [])
 
 class MicroserviceClient:
     """Cliente HTTP para comunicación con microservicios"""
@@ -10,7 +22,58 @@ class MicroserviceClient:
     def __init__(self):
         self.session = requests.Session()
         self.session.headers.update({"Content-Type": "application/json"})
+        self.guards = build_guards(MAX_TIMEOUTS)
+
+    async def _post_async(self, service: str, url: str, payload: dict, min_timeout: float = 0.0) -> dict:
+        """POST en un hilo, con el timeout adaptativo y el circuit breaker del servicio."""
+        return await self._request_async(service, "POST", url, payload, min_timeout)
+
+    async def _get_async(self, service: str, url: str) -> dict:
+        return await self._request_async(service, "GET", url)
+
+    async def _request_async(self, service: str, method: str, url: str, payload: Optional[dict] = None, min_timeout: float = 0.0) -> dict:
+        guard = self.guards[service]
+        timeout = guard.before_call(min_timeout)
+        headers = tracing.inject()  # run_in_executor no copia el contexto
+        inicio = time.perf_counter()
+        try:
+            # Usar asyncio.wait_for en lugar de asyncio.timeout para compatibilidad con Python < 3.11
+            loop = asyncio.get_event_loop()
+            response = await asyncio.wait_for(
+                loop.run_in_executor(None, lambda: self.session.request(method, url, json=payload, headers=headers, timeout=timeout)),
+                timeout=timeout,
+            )
+            response.raise_for_status()
+            result = response.json()
+        except Exception as e:
+            guard.record(e, time.perf_counter() - inicio)
+            raise
+        except BaseException:
+            # Cancelada (cliente desconectado, apagado): no cuenta como fallo pero libera la prueba del semiabierto
+            guard.abandon()
+            raise
+        guard.record(None, time.perf_counter() - inicio)
+        return result
+
+    def _post(self, service: str, url: str, payload: dict, headers: Dict[str, str]) -> requests.Response:
+        """Versión síncrona de _post_async (la usa el outbox desde un hilo)."""
+        guard = self.guards[service]
+        timeout = guard.before_call()
+        inicio = time.perf_counter()
+        try:
+            response = self.session.post(url, json=payload, headers=tracing.inject(headers), timeout=timeout)
+            response.raise_for_status()
+        except Exception as e:
+            guard.record(e, time.perf_counter() - inicio)
+            raise
+        except BaseException:
+            # Cancelada (cliente desconectado, apagado): no cuenta como fallo pero libera la prueba del semiabierto
+            guard.abandon()
+            raise
+        guard.record(None, time.perf_counter() - inicio)
+        return response
     
+    @track_call("parser")
     async def call_parser_service(self, operation_data: dict) -> dict:
         """Llama al parser service directamente"""
         try:
@@ -19,15 +82,7 @@ class MicroserviceClient:
                 return {}
                 
             url = f"{config.PARSER_SERVICE_URL}/parse-direct"
-            
-            # Usar asyncio.wait_for en lugar de asyncio.timeout para compatibilidad con Python < 3.11
-            async def make_request():
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(None, lambda: self.session.post(url, json=operation_data, timeout=300))
-                response.raise_for_status()
-                return response.json()
-            
-            result = await asyncio.wait_for(make_request(), timeout=300)
+            result = await self._post_async("parser", url, operation_data, _timeout_por_xml(operation_data, config.PARSER_TIMEOUT_SECONDS_PER_XML))
             logging.info(f"PARSER: Éxito para {operation_data['tracking_id']}")
             return result.get("parsed_results", {})
                 
@@ -35,6 +90,7 @@ class MicroserviceClient:
             logging.error(f"PARSER: Error para {operation_data['tracking_id']}: {e}")
             return {}
 
+    @track_call("cavali")
     async def call_cavali_service(self, operation_data: dict) -> dict:
         """Llama al cavali service directamente con tolerancia a fallos"""
         try:
@@ -42,24 +98,61 @@ class MicroserviceClient:
                 logging.warning("CAVALI_SERVICE_URL no configurada, continuando sin validación")
                 return {}
                 
-            url = f"{config.CAVALI_SERVICE_URL}/validate-direct"
-            
-            # Usar asyncio.wait_for en lugar de asyncio.timeout para compatibilidad con Python < 3.11
-            async def make_request():
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(None, lambda: self.session.post(url, json=operation_data, timeout=600))
-                response.raise_for_status()
-                return response.json()
-            
-            result = await asyncio.wait_for(make_request(), timeout=600)
+            if config.CAVALI_JOBS_ENABLED:
+                result = await self._run_cavali_job(operation_data)
+            else:
+                url = f"{config.CAVALI_SERVICE_URL}/validate-direct"
+                result = await self._post_async("cavali", url, operation_data, _timeout_por_xml(operation_data, config.CAVALI_TIMEOUT_SECONDS_PER_XML))
             logging.info(f"CAVALI: Éxito para {operation_data['tracking_id']}")
             return result.get("cavali_results", {})
                 
         except Exception as e:
             logging.warning(f"CAVALI: Error para {operation_data['tracking_id']}: {e}, continuando sin validación")
             return {}
+
+    async def _run_cavali_job(self, operation_data: dict) -> dict:
+        """
+        Crea un trabajo en POST /validate-jobs y espera su estado final sin
+        mantener una conexión ni un hilo: lo entrega el callback
+        (/operations/cavali-callback) o, si no llega, el sondeo de
+        GET /validate-jobs/{id} cada CAVALI_JOB_POLL_SECONDS.
+        """
+        tracking_id = operation_data["tracking_id"]
+        payload = dict(operation_data)
+        if config.ORQUESTADOR_PUBLIC_URL and config.CAVALI_CALLBACK_TOKEN:
+            payload["callback_url"] = f"{config.ORQUESTADOR_PUBLIC_URL.rstrip('/')}/operations/cavali-callback"
+        job = await self._post_async("cavali", f"{config.CAVALI_SERVICE_URL}/validate-jobs", payload)
+        job_id = job["job_id"]
+        logging.info(f"CAVALI: {tracking_id} en validación como trabajo {job_id}")
+
+        espera = cavali_job_waiter.register(job_id)
+        limite = time.monotonic() + config.CAVALI_JOB_TIMEOUT_SECONDS
+        try:
+            while True:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise TimeoutError(f"el trabajo {job_id} no terminó en {config.CAVALI_JOB_TIMEOUT_SECONDS}s")
+                try:
+                    estado = await asyncio.wait_for(asyncio.shield(espera), timeout=min(config.CAVALI_JOB_POLL_SECONDS, restante))
+                except asyncio.TimeoutError:
+                    try:
+                        estado = await self._get_async("cavali", f"{config.CAVALI_SERVICE_URL}/validate-jobs/{job_id}")
+                    except Exception as e:
+                        logging.warning(f"CAVALI: No se pudo consultar el trabajo {job_id}: {e}")
+                        continue
+                if estado.get("status") == "failed":
+                    raise RuntimeError(f"el trabajo {job_id} falló: {estado.get('error')}")
+                if estado.get("status") == "done":
+                    return estado
+                logging.info(f"CAVALI: Trabajo {job_id} en curso ({estado.get('completed')}/{estado.get('total')})")
+        finally:
+            cavali_job_waiter.discard(job_id)
     
-    def call_gmail_service(self, payload: dict) -> bool:
+    def _idempotency_headers(self, idempotency_key: Optional[str]) -> Dict[str, str]:
+        return {"Idempotency-Key": idempotency_key} if idempotency_key else {}
+
+    @track_call("gmail")
+    def call_gmail_service(self, payload: dict, idempotency_key: Optional[str] = None) -> bool:
         """Llama al servicio de Gmail"""
         try:
             if not config.GMAIL_SERVICE_URL:
@@ -67,8 +160,7 @@ class MicroserviceClient:
                 return False
                 
             url = f"{config.GMAIL_SERVICE_URL}/send-email"
-            response = self.session.post(url, json=payload, timeout=30)
-            response.raise_for_status()
+            self._post("gmail", url, payload, self._idempotency_headers(idempotency_key))
             logging.info(f"GMAIL: Email enviado exitosamente")
             return True
             
@@ -76,6 +168,7 @@ class MicroserviceClient:
             logging.error(f"GMAIL: Error enviando email: {e}")
             return False
     
+    @track_call("drive")
     async def call_drive_service(self, operation_data: dict) -> dict:
         """Llama al drive service directamente con tolerancia a fallos"""
         try:
@@ -84,15 +177,7 @@ class MicroserviceClient:
                 return {}
                 
             url = f"{config.DRIVE_SERVICE_URL}/archive-direct"
-            
-            # Usar asyncio.wait_for en lugar de asyncio.timeout para compatibilidad con Python < 3.11
-            async def make_request():
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(None, lambda: self.session.post(url, json=operation_data, timeout=30))
-                response.raise_for_status()
-                return response.json()
-            
-            result = await asyncio.wait_for(make_request(), timeout=30)
+            result = await self._post_async("drive", url, operation_data)
             logging.info(f"DRIVE: Éxito para {operation_data['tracking_id']}")
             return result
                 
@@ -100,7 +185,8 @@ class MicroserviceClient:
             logging.warning(f"DRIVE: Error para {operation_data['tracking_id']}: {e}, continuando sin archivado")
             return {}
     
-    def call_trello_service(self, payload: dict) -> bool:
+    @track_call("trello")
+    def call_trello_service(self, payload: dict, idempotency_key: Optional[str] = None) -> bool:
         """Llama al servicio de Trello"""
         try:
             if not config.TRELLO_SERVICE_URL:
@@ -108,8 +194,7 @@ class MicroserviceClient:
                 return False
                 
             url = f"{config.TRELLO_SERVICE_URL}/create-card"
-            response = self.session.post(url, json=payload, timeout=30)
-            response.raise_for_status()
+            self._post("trello", url, payload, self._idempotency_headers(idempotency_key))
             logging.info(f"TRELLO: Card creada exitosamente")
             return True
             
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from sqlalchemy import text
+
+import database
+import models
+
+CHANNEL = "operation_events"
+# Etapas del pipeline, en orden. 'failed' puede llegar en cualquier momento.
+STAGES = ("uploaded", "parsed", "cavali", "drive", "persisted", "notified")
+# Etapas en las que el envío todavía no guardó sus operaciones
+PENDING_STAGES = ("uploaded", "parsed", "cavali", "drive")
+LISTEN_POLL_SECONDS = 0.5
+HEARTBEAT_SECONDS = 15
+STREAM_MAX_SECONDS = 15 * 60
+# Marca interna: el stream debe releer los eventos desde la base
+RESYNC = {"resync": True}
+
+def _serializar(evento: models.OperationEvent) -> Dict:
+    return {
+        "id": evento.id,
+        "tracking_id": evento.tracking_id,
+        "etapa": evento.etapa,
+        "detalle": evento.detalle or {},
+        "fecha": evento.fecha_creacion.isoformat() if evento.fecha_creacion else None,
+    }
+
+def record(tracking_id: str, etapa: str, detalle: Optional[Dict] = None) -> None:
+    """Guarda la transición de etapa y la publica con NOTIFY en la misma transacción."""
+    db = database.SessionLocal()
+    try:
+        evento = models.OperationEvent(tracking_id=tracking_id, etapa=etapa, detalle=detalle or {})
+        db.add(evento)
+        db.flush()
+        db.refresh(evento)
+        db.execute(text("SELECT pg_notify(:canal, :payload)"), {"canal": CHANNEL, "payload": json.dumps(_serializar(evento))})
+        db.commit()
+    finally:
+        db.close()
+
+async def emit(tracking_id: str, etapa: str, detalle: Optional[Dict] = None) -> None:
+    """Versión asíncrona de record(); un fallo aquí nunca interrumpe el pipeline."""
+    try:
+        await asyncio.to_thread(record, tracking_id, etapa, detalle)
+    except Exception as e:
+        logging.error(f"EVENTS: No se pudo registrar la etapa {etapa} de {tracking_id}: {e}")
+
+def get_events(tracking_id: str) -> List[Dict]:
+    db = database.SessionLocal()
+    try:
+        eventos = db.query(models.OperationEvent).filter(
+            models.OperationEvent.tracking_id == tracking_id
+        ).order_by(models.OperationEvent.id).all()
+        return [_serializar(e) for e in eventos]
+    finally:
+        db.close()
+
+class OperationEventBroker:
+    """
+    Reparte los NOTIFY de Postgres a los streams SSE de esta instancia.
+
+    Un único hilo por proceso mantiene una conexión dedicada con LISTEN, y solo
+    consulta mientras haya suscriptores. Cualquier instancia puede servir el
+    stream de cualquier envío, porque todas reciben los NOTIFY.
+    """
+
+    def __init__(self):
+        self._subs: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self._lock = threading.Lock()
+        self._hay_subs = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, tracking_id: str) -> asyncio.Queue:
+        cola: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subs[tracking_id].add(cola)
+            self._hay_subs.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen_forever, name="pg-listen", daemon=True)
+                self._thread.start()
+        return cola
+
+    def unsubscribe(self, tracking_id: str, cola: asyncio.Queue) -> None:
+        with self._lock:
+            self._subs[tracking_id].discard(cola)
+            if not self._subs[tracking_id]:
+                del self._subs[tracking_id]
+            if not self._subs:
+                self._hay_subs.clear()
+
+    def _dispatch(self, payload: str) -> None:
+        try:
+            evento = json.loads(payload)
+        except ValueError:
+            return
+        with self._lock:
+            colas = list(self._subs.get(evento.get("tracking_id"), ()))
+        for cola in colas:
+            self._loop.call_soon_threadsafe(cola.put_nowait, evento)
+
+    def _resync(self) -> None:
+        """Tras (re)conectar el LISTEN, pide a cada stream releer la tabla: pudo perder NOTIFYs."""
+        with self._lock:
+            colas = [cola for colas in self._subs.values() for cola in colas]
+        for cola in colas:
+            self._loop.call_soon_threadsafe(cola.put_nowait, RESYNC)
+
+    def _listen_forever(self) -> None:
+        espera = 1
+        while True:
+            try:
+                self._listen()
+                espera = 1
+            except Exception as e:
+                logging.error(f"EVENTS: Conexión LISTEN perdida, reintentando en {espera}s: {e}")
+                time.sleep(espera)
+                espera = min(espera * 2, 30)
+
+    def _listen(self) -> None:
+        raw = database.get_engine().raw_connection()
+        conn = raw.driver_connection
+        raw.detach()  # conexión dedicada, fuera del pool
+        try:
+            conn.rollback()
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {CHANNEL}")
+            logging.info("EVENTS: Escuchando NOTIFY en el canal operation_events")
+            self._resync()
+            while True:
+                self._hay_subs.wait()
+                # pg8000 y psycopg2 solo leen notificaciones al hablar con el servidor
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+                for payload in self._drain(conn):
+                    self._dispatch(payload)
+                time.sleep(LISTEN_POLL_SECONDS)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _drain(conn):
+        pendientes = getattr(conn, "notifications", None)  # pg8000: deque de (pid, canal, payload)
+        if pendientes is not None:
+            while pendientes:
+                yield pendientes.popleft()[2]
+            return
+        pendientes = getattr(conn, "notifies", None)  # psycopg2: lista de Notify
+        while pendientes:
+            yield pendientes.pop(0).payload
+
+    async def stream(self, tracking_id: str, last_event_id: Optional[str], is_disconnected) -> AsyncIterator[str]:
+        """
+        Genera el stream SSE: repite las etapas ya registradas (después de Last-Event-ID)
+        y luego envía las nuevas a medida que llegan. Termina con 'failed', o cuando
+        se entregaron las notificaciones anunciadas en 'persisted'.
+
+        Los ids se asignan al insertar pero los NOTIFY llegan en orden de commit,
+        por eso se lleva el conjunto de ids vistos y no solo el último.
+        """
+        cola = self.subscribe(tracking_id)
+        try:
+            reconectado_desde = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+            vistos: Set[int] = set()
+            notificaciones_esperadas = None
+            notificadas = 0
+            inicio = time.monotonic()
+            yield "retry: 3000\n\n"
+
+            pendientes = await asyncio.to_thread(get_events, tracking_id)
+            while time.monotonic() - inicio < STREAM_MAX_SECONDS:
+                for evento in pendientes:
+                    if evento["id"] in vistos:
+                        continue
+                    vistos.add(evento["id"])
+                    if evento["id"] > reconectado_desde:
+                        yield f"id: {evento['id']}\nevent: {evento['etapa']}\ndata: {json.dumps(evento)}\n\n"
+                    if evento["etapa"] == "persisted":
+                        notificaciones_esperadas = evento["detalle"].get("notificaciones", 0)
+                    elif evento["etapa"] == "notified":
+                        notificadas += 1
+                    if evento["etapa"] == "failed" or (
+                        notificaciones_esperadas is not None and notificadas >= notificaciones_esperadas
+                    ):
+                        yield "event: end\ndata: {}\n\n"
+                        return
+
+                if await is_disconnected():
+                    return
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    evento = RESYNC
+                    yield ": keep-alive\n\n"
+                if evento is RESYNC:
+                    pendientes = await asyncio.to_thread(get_events, tracking_id)
+                else:
+                    pendientes = [evento]
+        finally:
+            self.unsubscribe(tracking_id, cola)
+
+# Singleton instance
+operation_event_broker = OperationEventBroker()
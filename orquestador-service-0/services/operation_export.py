@@ -0,0 +1,69 @@
+import csv
+import io
+import os
+import tempfile
+from datetime import datetime, timezone
+from typing import Iterable, Iterator
+
+# (encabezado, atributo de la fila de OperationRepository.iter_export_rows)
+EXPORT_COLUMNS = [
+    ("Operación", "operacion"), ("Fecha ingreso", "fecha_ingreso"),
+    ("RUC cliente", "cliente_ruc"), ("Cliente", "cliente"),
+    ("Estado operación", "estado_operacion"), ("Ejecutivo", "email_usuario"),
+    ("Tasa", "tasa_operacion"), ("Comisión", "comision"),
+    ("Folio", "folio"), ("RUC deudor", "deudor_ruc"), ("Deudor", "deudor"),
+    ("Fecha emisión", "fecha_emision"), ("Fecha vencimiento", "fecha_vencimiento"),
+    ("Moneda", "moneda"), ("Monto total", "monto_total"), ("Monto neto", "monto_neto"),
+    ("Estado factura", "estado_factura"),
+]
+
+CSV_FLUSH_ROWS = 500
+XLSX_CHUNK_BYTES = 64 * 1024
+
+def _utc_naive(valor):
+    # Excel no admite zona horaria: las fechas se exportan en UTC
+    if isinstance(valor, datetime) and valor.tzinfo is not None:
+        return valor.astimezone(timezone.utc).replace(tzinfo=None)
+    return valor
+
+def csv_chunks(rows: Iterable) -> Iterator[bytes]:
+    """Genera el CSV por bloques de CSV_FLUSH_ROWS filas; el BOM hace que Excel lo abra como UTF-8."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow([encabezado for encabezado, _ in EXPORT_COLUMNS])
+    for n, row in enumerate(rows, start=1):
+        writer.writerow([
+            valor.isoformat() if isinstance(valor, datetime) else valor
+            for valor in (getattr(row, atributo) for _, atributo in EXPORT_COLUMNS)
+        ])
+        if n % CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+def xlsx_chunks(rows: Iterable) -> Iterator[bytes]:
+    """
+    Escribe un libro en modo write-only (openpyxl vuelca cada fila a disco) en un
+    archivo temporal y lo envía por bloques. El formato zip de XLSX no permite
+    emitir bytes antes de terminar, pero la memoria queda acotada igual que en CSV.
+    """
+    from openpyxl import Workbook
+
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet("Operaciones")
+    hoja.append([encabezado for encabezado, _ in EXPORT_COLUMNS])
+    for row in rows:
+        hoja.append([_utc_naive(getattr(row, atributo)) for _, atributo in EXPORT_COLUMNS])
+
+    descriptor, ruta = tempfile.mkstemp(suffix=".xlsx")
+    os.close(descriptor)
+    try:
+        libro.save(ruta)
+        with open(ruta, "rb") as archivo:
+            while bloque := archivo.read(XLSX_CHUNK_BYTES):
+                yield bloque
+    finally:
+        os.remove(ruta)
@@ -6,23 +6,37 @@ from datetime import datetime, timezone
 from typing import Dict, List
 from sqlalchemy.orm import Session
 from sqlalchemy.dialects.postgresql import insert as pg_insert
-from google.cloud import storage, pubsub_v1
 
 from core.config import config
+from core import clients
 from repository import OperationRepository
 import models
+import tracing
 
 class OperationService:
     """Servicio para procesamiento de operaciones"""
     
-    def __init__(self):
-        self.storage_client = storage.Client()
-        self.publisher = pubsub_v1.PublisherClient()
-        self.bucket = self.storage_client.bucket(config.BUCKET_NAME)
-        
-        # Topics
-        self.TOPIC_OPERATION_SUBMITTED = self.publisher.topic_path(config.GCP_PROJECT_ID, "operation-submitted")
-        self.TOPIC_OPERATION_PERSISTED = self.publisher.topic_path(config.GCP_PROJECT_ID, "operation-persisted")
+    # Los clientes de GCP se resuelven en el primer uso (ver core.clients)
+    @property
+    def storage_client(self):
+        return clients.storage_client.get()
+
+    @property
+    def publisher(self):
+        return clients.publisher.get()
+
+    @property
+    def bucket(self):
+        return clients.bucket.get()
+
+    # Topics
+    @property
+    def TOPIC_OPERATION_SUBMITTED(self):
+        return self.publisher.topic_path(config.GCP_PROJECT_ID, "operation-submitted")
+
+    @property
+    def TOPIC_OPERATION_PERSISTED(self):
+        return self.publisher.topic_path(config.GCP_PROJECT_ID, "operation-persisted")
     
     def upload_file(self, file, upload_folder: str, subfolder: str) -> str:
         """Sube un archivo a GCS y retorna la ruta"""
@@ -88,7 +102,7 @@ class OperationService:
             
             # 3. Publicar a Drive en paralelo
             drive_payload = {**operation_data}
-            self.publisher.publish(self.TOPIC_OPERATION_SUBMITTED, json.dumps(drive_payload).encode("utf-8")).result()
+            self.publisher.publish(self.TOPIC_OPERATION_SUBMITTED, json.dumps(drive_payload).encode("utf-8"), **tracing.pubsub_attributes()).result()
             
             # 4. Esperar resultado de Drive y finalizar
             await self.wait_for_drive_and_finalize(tracking_id, operation_data, parsed_results, cavali_results, db)
@@ -163,7 +177,7 @@ class OperationService:
             invoices_data = payload["parsed_results"]
             cavali_results_map = payload["cavali_results"]
             
-            repo.save_full_operation(operation_id, metadata, drive_url, invoices_data, cavali_results_map)
+            repo.save_full_operation(operation_id, metadata, drive_url, invoices_data, cavali_results_map, tracking_id=original_tracking_id)
             
             logging.info(f"FINALIZER: Operación {original_tracking_id} guardada como {operation_id}")
             
@@ -180,7 +194,7 @@ class OperationService:
             notification_service.send_notifications(notification_payload)
             
             # También enviar por pub/sub para compatibilidad
-            self.publisher.publish(self.TOPIC_OPERATION_PERSISTED, json.dumps(notification_payload).encode("utf-8")).result()
+            self.publisher.publish(self.TOPIC_OPERATION_PERSISTED, json.dumps(notification_payload).encode("utf-8"), **tracing.pubsub_attributes()).result()
             
         except Exception as e:
             logging.error(f"FINALIZER: Error procesando operación final: {e}")
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from core.config import config
+import database
+import models
+from services.microservice_client import microservice_client
+from services import operation_events
+from core.metrics import track_stage
+import tracing
+
+class OutboxDispatcher:
+    """
+    Entrega en segundo plano las notificaciones de la tabla outbox.
+
+    - Reclama lotes con FOR UPDATE SKIP LOCKED, así varias instancias pueden drenar en paralelo.
+    - Un mensaje reclamado queda 'enviando' con un lease: si la instancia muere, vuelve a estar disponible.
+      El resultado solo se registra si el lease sigue siendo de quien lo reclamó (lease_token).
+    - Los fallos se reintentan con backoff exponencial (con jitter) hasta OUTBOX_MAX_ATTEMPTS.
+    - Cada envío lleva su idempotency_key en la cabecera Idempotency-Key; Gmail la usa para no
+      reenviar un correo que ya salió cuando el reintento viene de un timeout ambiguo.
+    """
+
+    def __init__(self):
+        self.senders = {
+            "trello": microservice_client.call_trello_service,
+            "gmail": microservice_client.call_gmail_service,
+        }
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self):
+        """Arranca el bucle de despacho en el event loop actual."""
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="outbox-dispatcher")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Avisa que hay mensajes nuevos. Se puede llamar desde cualquier hilo."""
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        logging.info("OUTBOX: Dispatcher iniciado")
+        semaforo = asyncio.Semaphore(config.OUTBOX_CONCURRENCY)
+
+        async def entregar_limitado(mensaje: Dict):
+            async with semaforo:
+                await self._deliver(mensaje)
+
+        while True:
+            try:
+                mensajes = await asyncio.to_thread(self._claim_batch, config.OUTBOX_BATCH_SIZE)
+                if mensajes:
+                    await asyncio.gather(*(entregar_limitado(m) for m in mensajes))
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"OUTBOX: Error en el bucle de despacho: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=config.OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim_batch(self, limit: int) -> List[Dict]:
+        """Reclama hasta `limit` mensajes vencidos y los marca como 'enviando' bajo un lease."""
+        db = database.SessionLocal()
+        try:
+            ahora = datetime.now(timezone.utc)
+            filas = (
+                db.query(models.OutboxMessage)
+                .filter(
+                    models.OutboxMessage.estado.in_(["pendiente", "enviando"]),
+                    models.OutboxMessage.proximo_intento <= ahora,
+                )
+                .order_by(models.OutboxMessage.id)
+                .with_for_update(skip_locked=True)
+                .limit(limit)
+                .all()
+            )
+            mensajes = []
+            for fila in filas:
+                fila.estado = "enviando"
+                fila.proximo_intento = ahora + timedelta(seconds=config.OUTBOX_LEASE_SECONDS)
+                fila.lease_token = uuid.uuid4().hex
+                mensajes.append({
+                    "id": fila.id,
+                    "destino": fila.destino,
+                    "idempotency_key": fila.idempotency_key,
+                    "payload": fila.payload,
+                    "intentos": fila.intentos,
+                    "lease_token": fila.lease_token,
+                })
+            db.commit()
+            return mensajes
+        finally:
+            db.close()
+
+    async def _deliver(self, mensaje: Dict):
+        sender = self.senders.get(mensaje["destino"])
+        error = None
+        if sender is None:
+            error = f"Destino desconocido: {mensaje['destino']}"
+            ok = False
+        else:
+            try:
+                # Fuera del request: la traza se correlaciona por el tracking_id del envío
+                with tracing.continue_trace(
+                    "outbox.deliver", tracking_id=(mensaje["payload"] or {}).get("original_tracking_id"),
+                    kind="internal", destino=mensaje["destino"],
+                ), track_stage("notification"):
+                    ok = await asyncio.to_thread(sender, mensaje["payload"], mensaje["idempotency_key"])
+                if not ok:
+                    error = f"{mensaje['destino']} respondió con error"
+            except Exception as e:
+                ok, error = False, str(e)
+        await asyncio.to_thread(self._mark_result, mensaje, ok, error)
+
+    def _backoff_seconds(self, intentos: int) -> float:
+        espera = min(config.OUTBOX_BACKOFF_MAX_SECONDS, config.OUTBOX_BACKOFF_BASE_SECONDS * (2 ** (intentos - 1)))
+        return espera * random.uniform(0.8, 1.2)
+
+    def _mark_result(self, mensaje: Dict, ok: bool, error: Optional[str]):
+        db = database.SessionLocal()
+        try:
+            fila = (
+                db.query(models.OutboxMessage)
+                .filter(
+                    models.OutboxMessage.id == mensaje["id"],
+                    models.OutboxMessage.estado == "enviando",
+                    models.OutboxMessage.lease_token == mensaje["lease_token"],
+                )
+                .with_for_update()
+                .first()
+            )
+            if fila is None:
+                # El lease venció y otro intento reclamó el mensaje: su resultado es el que vale
+                logging.warning(f"OUTBOX: {mensaje['idempotency_key']} ya no pertenece a este intento; se descarta su resultado.")
+                return
+            ahora = datetime.now(timezone.utc)
+            fila.intentos = mensaje["intentos"] + 1
+            if ok:
+                fila.estado = "enviado"
+                fila.fecha_envio = ahora
+                fila.ultimo_error = None
+                logging.info(f"OUTBOX: {mensaje['idempotency_key']} entregado a {mensaje['destino']}")
+            elif fila.intentos >= config.OUTBOX_MAX_ATTEMPTS:
+                fila.estado = "fallido"
+                fila.ultimo_error = error
+                logging.error(f"OUTBOX: {mensaje['idempotency_key']} descartado tras {fila.intentos} intentos: {error}")
+            else:
+                fila.estado = "pendiente"
+                fila.ultimo_error = error
+                fila.proximo_intento = ahora + timedelta(seconds=self._backoff_seconds(fila.intentos))
+                logging.warning(f"OUTBOX: {mensaje['idempotency_key']} falló (intento {fila.intentos}): {error}")
+            fila.lease_token = None
+            estado = fila.estado
+            db.commit()
+        finally:
+            db.close()
+        if estado in ("enviado", "fallido"):
+            self._record_notified(mensaje, estado == "enviado")
+
+    def _record_notified(self, mensaje: Dict, ok: bool):
+        tracking_id = (mensaje["payload"] or {}).get("original_tracking_id")
+        if not tracking_id:
+            return
+        try:
+            operation_events.record(tracking_id, "notified", {
+                "operation_id": mensaje["payload"].get("operation_id"),
+                "destino": mensaje["destino"],
+                "ok": ok,
+            })
+        except Exception as e:
+            logging.error(f"OUTBOX: No se pudo registrar la etapa notified de {tracking_id}: {e}")
+
+# Singleton instance
+outbox_dispatcher = OutboxDispatcher()
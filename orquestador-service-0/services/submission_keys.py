@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+
+from core.config import config
+import database
+from repository import OperationRepository
+
+class SubmissionKeys:
+    """
+    Soporte de la cabecera Idempotency-Key en /submit-operation.
+
+    Un reintento con la misma clave no vuelve a ejecutar el pipeline:
+    - si el envío original terminó, se devuelve la respuesta guardada;
+    - si sigue en curso en esta instancia, se espera su resultado (hasta
+      IDEMPOTENCY_ATTACH_TIMEOUT_SECONDS);
+    - si no, se responde 'processing' con el tracking_id original.
+    """
+
+    def __init__(self):
+        self._en_curso: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def _claim(self, user_email: str, key: str, tracking_id: str, request_hash: str) -> Tuple[Dict, bool]:
+        db = database.SessionLocal()
+        try:
+            registro, reclamado = OperationRepository(db).claim_submission_key(
+                user_email, key, tracking_id, request_hash, config.IDEMPOTENCY_STALE_SECONDS
+            )
+            datos = {
+                "tracking_id": registro.tracking_id,
+                "request_hash": registro.request_hash,
+                "estado": registro.estado,
+                "response": registro.response,
+            }
+            return datos, reclamado
+        finally:
+            db.close()
+
+    def _finish(self, user_email: str, key: str, estado: str, response: Optional[Dict]):
+        db = database.SessionLocal()
+        try:
+            OperationRepository(db).finish_submission_key(user_email, key, estado, response)
+        finally:
+            db.close()
+
+    async def claim(self, user_email: str, key: str, tracking_id: str, request_hash: str) -> Optional[JSONResponse]:
+        """
+        Reclama la clave. Devuelve None si este request debe procesar el envío,
+        o la respuesta que corresponde al envío original.
+        """
+        registro, reclamado = await asyncio.to_thread(self._claim, user_email, key, tracking_id, request_hash)
+        if reclamado:
+            self._en_curso[(user_email, key)] = asyncio.get_running_loop().create_future()
+            return None
+
+        if registro["request_hash"] != request_hash:
+            raise HTTPException(
+                status_code=422,
+                detail="La Idempotency-Key ya se usó con un envío distinto"
+            )
+        headers = {"Idempotency-Replayed": "true"}
+        if registro["estado"] == 'completado':
+            logging.info(f"IDEMPOTENCY: Clave {key} ya completada, devolviendo respuesta guardada")
+            return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=registro["response"], headers=headers)
+
+        pendiente = self._en_curso.get((user_email, key))
+        if pendiente is not None:
+            logging.info(f"IDEMPOTENCY: Clave {key} en curso en esta instancia, esperando su resultado")
+            try:
+                response = await asyncio.wait_for(asyncio.shield(pendiente), timeout=config.IDEMPOTENCY_ATTACH_TIMEOUT_SECONDS)
+                if response is None:
+                    raise HTTPException(
+                        status_code=status.HTTP_409_CONFLICT,
+                        detail="El envío original falló; puede reintentarse con la misma Idempotency-Key"
+                    )
+                return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=response, headers=headers)
+            except asyncio.TimeoutError:
+                pass
+
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content={"status": "processing", "tracking_id": registro["tracking_id"]},
+            headers=headers,
+        )
+
+    async def complete(self, user_email: str, key: str, response: Dict):
+        await asyncio.to_thread(self._finish, user_email, key, 'completado', response)
+        self._resolve(user_email, key, response)
+
+    async def fail(self, user_email: str, key: str):
+        try:
+            # shield: si se llama desde un request cancelado, una segunda cancelación no corta el UPDATE
+            await asyncio.shield(asyncio.to_thread(self._finish, user_email, key, 'fallido', None))
+        except Exception as e:
+            logging.error(f"IDEMPOTENCY: No se pudo marcar la clave {key} como fallida: {e}")
+        finally:
+            # Quien espera en esta instancia recibe el fallo aunque el UPDATE no haya terminado
+            self._resolve(user_email, key, None)
+
+    def _resolve(self, user_email: str, key: str, response: Optional[Dict]):
+        pendiente = self._en_curso.pop((user_email, key), None)
+        if pendiente is not None and not pendiente.done():
+            pendiente.set_result(response)
+
+# Singleton instance
+submission_keys = SubmissionKeys()
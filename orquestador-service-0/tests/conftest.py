@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Los tests importan los módulos del servicio igual que main.py (core.*, services.*)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
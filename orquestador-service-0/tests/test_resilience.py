@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+from core.config import config
+from core.resilience import ServiceGuard
+from services.microservice_client import MicroserviceClient, _timeout_por_xml
+
+@pytest.fixture(autouse=True)
+def ventana_chica(monkeypatch):
+    monkeypatch.setattr(config, "ADAPTIVE_TIMEOUT_MIN_SAMPLES", 5)
+    monkeypatch.setattr(config, "ADAPTIVE_TIMEOUT_MIN_SECONDS", 0.05)
+    monkeypatch.setattr(config, "ADAPTIVE_TIMEOUT_MULTIPLIER", 3)
+    monkeypatch.setattr(config, "CIRCUIT_FAILURE_THRESHOLD", 100)
+
+class _Respuesta:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"ok": True}
+
+def _cliente(latencias):
+    """MicroserviceClient cuyo servicio "parser" (máximo 2 s) tarda lo que indique cada elemento de `latencias`."""
+    cliente = MicroserviceClient()
+    cliente.guards["parser"] = ServiceGuard("parser", 2.0)
+    pendientes = iter(latencias)
+
+    def request(method, url, json=None, headers=None, timeout=None):
+        time.sleep(next(pendientes))
+        return _Respuesta()
+
+    cliente.session.request = request
+    return cliente
+
+def test_timeout_recupera_tras_cortar_una_llamada_lenta():
+    cliente = _cliente([0.01] * 5 + [0.3, 0.3, 0.3])
+    guard = cliente.guards["parser"]
+
+    async def correr():
+        for _ in range(5):
+            await cliente._post_async("parser", "http://parser/parse-direct", {})
+        bajo = guard.timeout.current()
+        with pytest.raises(asyncio.TimeoutError):
+            await cliente._post_async("parser", "http://parser/parse-direct", {})
+        return bajo
+
+    bajo = asyncio.run(correr())
+    assert bajo == pytest.approx(0.05)
+    # La llamada cortada entra como muestra: el timeout crece en lugar de quedarse en el piso
+    assert guard.timeout.current() >= 3 * bajo
+
+    async def hasta_que_pase():
+        for _ in range(2):
+            try:
+                return await cliente._post_async("parser", "http://parser/parse-direct", {})
+            except asyncio.TimeoutError:
+                pass
+
+    assert asyncio.run(hasta_que_pase()) == {"ok": True}
+
+def test_piso_por_xml_sube_el_timeout_sin_pasar_del_maximo():
+    guard = ServiceGuard("parser", 2.0)
+    for _ in range(5):
+        guard.record(None, 0.01)
+    operacion = {"gcs_paths": {"xml": ["gs://b/x.xml"] * 30}}
+    assert guard.before_call() == pytest.approx(0.05)
+    assert guard.before_call(_timeout_por_xml(operacion, 0.05)) == pytest.approx(1.5)
+    assert guard.before_call(_timeout_por_xml(operacion, 1.0)) == 2.0
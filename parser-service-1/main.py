@@ -5,8 +5,10 @@ import traceback
 from fastapi import FastAPI, Request, Response, status, HTTPException
 from google.cloud import storage, pubsub_v1
 from parser import extract_invoice_data
+import tracing
 
 app = FastAPI(title="Parser Service (Pub/Sub Enabled)")
+tracing.instrument_app(app)
 
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "operaciones-peru")
 storage_client = storage.Client()
@@ -18,7 +20,8 @@ def read_xml_from_gcs(gcs_path):
     parts = gcs_path.replace("gs://", "").split("/", 1)
     bucket_name, file_path = parts
     blob = storage_client.bucket(bucket_name).blob(file_path)
-    return blob.download_as_bytes()
+    with tracing.span("gcs.download", path=gcs_path):
+        return blob.download_as_bytes()
 
 @app.post("/pubsub-handler", status_code=status.HTTP_204_NO_CONTENT)
 async def pubsub_handler(request: Request):
@@ -35,22 +38,23 @@ async def pubsub_handler(request: Request):
         
         print(f"PARSER: Procesando {tracking_id} con {len(xml_paths)} XMLs.")
 
-        parsed_results = []
-        for xml_path in xml_paths:
-            try:
-                xml_bytes = read_xml_from_gcs(xml_path)
-                invoice_data = extract_invoice_data(xml_bytes)
-                invoice_data['xml_filename'] = os.path.basename(xml_path)
-                parsed_results.append(invoice_data)
-            except Exception as e:
-                print(f"PARSER: Error al procesar {xml_path} para {tracking_id}: {e}")
-                continue
-        
-        payload["parsed_results"] = parsed_results
-        
-        next_message_data = json.dumps(payload).encode("utf-8")
-        future = publisher.publish(TOPIC_INVOICES_PARSED, next_message_data)
-        future.result()
+        with tracing.continue_from_pubsub("parser.pubsub", body["message"], tracking_id):
+            parsed_results = []
+            for xml_path in xml_paths:
+                try:
+                    xml_bytes = read_xml_from_gcs(xml_path)
+                    invoice_data = extract_invoice_data(xml_bytes)
+                    invoice_data['xml_filename'] = os.path.basename(xml_path)
+                    parsed_results.append(invoice_data)
+                except Exception as e:
+                    print(f"PARSER: Error al procesar {xml_path} para {tracking_id}: {e}")
+                    continue
+            
+            payload["parsed_results"] = parsed_results
+            
+            next_message_data = json.dumps(payload).encode("utf-8")
+            future = publisher.publish(TOPIC_INVOICES_PARSED, next_message_data, **tracing.pubsub_attributes())
+            future.result()
 
         print(f"PARSER: {tracking_id} parseado y publicado en '{TOPIC_INVOICES_PARSED}'.")
 
@@ -66,6 +70,7 @@ async def parse_direct(request: Request):
     try:
         operation_data = await request.json()
         tracking_id = operation_data["tracking_id"]
+        tracing.set_tracking_id(tracking_id)
         xml_paths = operation_data.get("gcs_paths", {}).get("xml", [])
         
         print(f"PARSER DIRECTO: Procesando {tracking_id} con {len(xml_paths)} XMLs.")
@@ -3,6 +3,7 @@ import json
 import requests
 import base64
 from google.cloud import pubsub_v1
+import tracing
 
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "operaciones-peru")
 IS_LOCAL = os.getenv("IS_LOCAL", "true").lower() == "true"  # por defecto True
@@ -14,10 +15,10 @@ def publish_message(topic: str, payload: dict):
     if IS_LOCAL:
         # Simulación HTTP para test local
         url = f"http://localhost:8001/{topic}"
-        res = requests.post(url, json=payload)
+        res = requests.post(url, json=payload, headers=tracing.inject())
         print(f"[LOCAL] Enviado a {url} | status={res.status_code}")
     else:
         topic_path = publisher.topic_path(GCP_PROJECT_ID, topic)
         message_bytes = json.dumps(payload).encode("utf-8")
-        publisher.publish(topic_path, message_bytes)
+        publisher.publish(topic_path, message_bytes, **tracing.pubsub_attributes())
         print(f"[PROD] Publicado en Pub/Sub: {topic_path}")
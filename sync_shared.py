@@ -0,0 +1,52 @@
+"""
+Mantiene idénticas las copias de los módulos compartidos entre servicios.
+
+Cada Dockerfile construye con la carpeta de su servicio como contexto, así que
+los módulos comunes no pueden importarse desde fuera: la fuente vive en
+shared/ y cada servicio tiene una copia. Sin argumentos verifica que todas las
+copias coincidan con shared/ (exit 1 si alguna difiere o falta); con --write
+las reescribe desde shared/.
+
+    python sync_shared.py           # verificar (p.ej. antes de desplegar)
+    python sync_shared.py --write   # copiar shared/ a los servicios
+"""
+import os
+import sys
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+COMPARTIDOS = {
+    "tracing.py": [
+        "orquestador-service-0", "parser-service-1", "trello-service-2", "gmail_service-3",
+        "drive-service-4", "cavali-service-5", "excel",
+    ],
+}
+
+def _leer(ruta: str):
+    if not os.path.exists(ruta):
+        return None
+    with open(ruta, "rb") as f:
+        return f.read()
+
+def main(escribir: bool) -> int:
+    distintas = []
+    for modulo, servicios in COMPARTIDOS.items():
+        fuente = _leer(os.path.join(RAIZ, "shared", modulo))
+        for servicio in servicios:
+            ruta = os.path.join(RAIZ, servicio, modulo)
+            if _leer(ruta) == fuente:
+                continue
+            if escribir:
+                with open(ruta, "wb") as f:
+                    f.write(fuente)
+                print(f"SHARED: {servicio}/{modulo} actualizado desde shared/{modulo}")
+            else:
+                distintas.append(f"{servicio}/{modulo}")
+
+    if distintas:
+        print(f"SHARED: copias distintas de shared/: {', '.join(distintas)}. Corre `python sync_shared.py --write`.")
+        return 1
+    print("SHARED: todas las copias coinciden con shared/")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main("--write" in sys.argv[1:]))
@@ -8,9 +8,11 @@ from fastapi import FastAPI, HTTPException
 from typing import Dict, Any
 from dotenv import load_dotenv
 from google.cloud import storage
+import tracing
 
 load_dotenv()
 app = FastAPI(title="Trello Service (HTTP Endpoint)")
+tracing.instrument_app(app)
 
 TRELLO_API_KEY = os.getenv("TRELLO_API_KEY")
 TRELLO_TOKEN = os.getenv("TRELLO_TOKEN")
@@ -33,7 +35,8 @@ def download_blob_as_bytes(gs_path: str) -> bytes:
     bucket_name, blob_path = path_parts[0], path_parts[1]
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_path)
-    return blob.download_as_bytes()
+    with tracing.span("gcs.download", path=gs_path):
+        return blob.download_as_bytes()
 
 def card_exists(operation_id: str) -> bool:
     """Verifica si ya existe una tarjeta que contenga el ID de la operación."""
@@ -45,7 +48,8 @@ def card_exists(operation_id: str) -> bool:
         'modelTypes': 'cards', 'card_fields': 'name', 'cards_limit': 1
     }
     try:
-        response = requests.get(url, params=params, timeout=15)
+        with tracing.span("trello.search", "client"):
+            response = requests.get(url, params=params, timeout=15)
         response.raise_for_status()
         if response.json().get('cards'):
             print(f"TRELLO: Tarjeta encontrada para op {operation_id}. No se creará una nueva.")
@@ -164,7 +168,8 @@ def process_operation_and_create_card(payload: Dict[str, Any]):
     
     print("\n--- 2. Llamando a la API de Trello ---")
     url_card = "https://api.trello.com/1/cards"
-    response = requests.post(url_card, params=auth_params, json=card_payload)
+    with tracing.span("trello.create_card", "client"):
+        response = requests.post(url_card, params=auth_params, json=card_payload)
     response.raise_for_status() 
     
     card_id = response.json()["id"]
@@ -176,7 +181,8 @@ def process_operation_and_create_card(payload: Dict[str, Any]):
             file_bytes = download_blob_as_bytes(path)
             filename = os.path.basename(path)
             files = {"file": (filename, file_bytes)}
-            requests.post(url_attachment, params=auth_params, files=files)
+            with tracing.span("trello.attachment", "client", archivo=filename):
+                requests.post(url_attachment, params=auth_params, files=files)
         except Exception as e:
             print(f"ADVERTENCIA: No se pudo adjuntar {path}. Error: {e}")
             